@@ -1,6 +1,13 @@
+import sys
 from food_dataset import FoodDataset
 
-dataset = FoodDataset()
+# Optional argument: food_samples.json (default) or a dataset store directory
+dataset = FoodDataset(*sys.argv[1:2])
+dataset.load_dataset()
+if dataset.store is None:
+    # food_samples.json is rebuilt from scratch; a store is append-only, so only new dishes are added
+    dataset.samples = []
+existing = {sample["actual_name"] for sample in dataset.samples}
 
 # Dictionary of dishes with their details
 dishes = {
@@ -194,8 +201,10 @@ dishes = {
     }
 }
 
-# Add all dishes to the dataset
+# Add the dishes that are not in the dataset yet
 for dish_data in dishes.values():
+    if dish_data["actual_name"] in existing:
+        continue
     dataset.add_sample(
         actual_name=dish_data["actual_name"],
         image_paths=dish_data["images"],
@@ -0,0 +1,177 @@
+from pathlib import Path
+
+import numpy as np
+
+from similarity import l2_normalize
+
+SEARCH_BACKENDS = ("exact", "ivf")
+
+
+def _top_k(scores, k):
+    """Indices and values of the k largest entries in each row, best first"""
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.zeros((scores.shape[0], 0), dtype=np.int64), np.zeros((scores.shape[0], 0), dtype=np.float32)
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+
+
+def _chunked_argmax(vectors, centroids, chunk_size=65536):
+    """Nearest centroid (by inner product) of every vector, without a full N x nlist matrix"""
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        assignments[start:start + chunk_size] = np.argmax(vectors[start:start + chunk_size] @ centroids.T, axis=1)
+    return assignments
+
+
+def spherical_kmeans(vectors, num_clusters, iterations=20, seed=0):
+    """k-means on unit vectors with cosine similarity; returns (num_clusters, dim) unit centroids"""
+    rng = np.random.default_rng(seed)
+    num_clusters = min(num_clusters, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), num_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _chunked_argmax(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=num_clusters)
+        # Re-seed empty clusters from random points so every list stays useful
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            sums[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+        centroids = l2_normalize(sums)
+    return centroids
+
+
+class FlatIndex:
+    """Exact maximum inner-product search over L2-normalized vectors"""
+
+    exact = True
+
+    def __init__(self, vectors):
+        self.vectors = l2_normalize(vectors)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def search(self, queries, k):
+        """Return (ids, scores) of the k most similar rows per query, best first"""
+        return _top_k(l2_normalize(np.atleast_2d(queries)) @ self.vectors.T, k)
+
+    def save(self, path):
+        np.savez(path, kind="flat", vectors=self.vectors)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays["vectors"])
+
+
+class IVFIndex:
+    """Inverted-file index: spherical k-means coarse quantizer over L2-normalized vectors.
+
+    Every vector is stored in the list of its nearest centroid. A query
+    scans only the `nprobe` lists whose centroids are closest to it, so
+    recall and latency are traded off with nprobe (per search) and nlist
+    (the codebook size, fixed at training time).
+    """
+
+    exact = False
+
+    def __init__(self, centroids, list_offsets, list_ids, list_vectors, nprobe=8):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.list_vectors = list_vectors
+        self.nprobe = nprobe
+
+    @classmethod
+    def train(cls, vectors, nlist=None, nprobe=8, iterations=20, max_training_points=256, seed=0):
+        """Build an index over `vectors`; nlist defaults to about sqrt(N)"""
+        vectors = l2_normalize(vectors)
+        if nlist is None:
+            nlist = max(1, int(np.sqrt(len(vectors))))
+        nlist = max(1, min(nlist, len(vectors)))
+
+        # k-means on a sample keeps training time independent of N
+        rng = np.random.default_rng(seed)
+        sample_size = min(len(vectors), nlist * max_training_points)
+        sample = vectors
+        if sample_size < len(vectors):
+            sample = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+        if len(vectors):
+            centroids = spherical_kmeans(sample, nlist, iterations, seed)
+        else:
+            centroids = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+
+        index = cls(centroids, np.zeros(len(centroids) + 1, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                    np.zeros((0, vectors.shape[1]), dtype=np.float32), nprobe)
+        index.add(vectors)
+        return index
+
+    def __len__(self):
+        return len(self.list_ids)
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    def add(self, vectors, ids=None):
+        """Add vectors (default ids continue from the current size) and rebuild the lists"""
+        vectors = l2_normalize(vectors)
+        if ids is None:
+            ids = np.arange(len(self), len(self) + len(vectors))
+        assignments = np.concatenate([self._list_of_ids(), _chunked_argmax(vectors, self.centroids)])
+        all_ids = np.concatenate([self.list_ids, np.asarray(ids, dtype=np.int64)])
+        all_vectors = np.concatenate([self.list_vectors, vectors])
+
+        order = np.argsort(assignments, kind="stable")
+        self.list_ids = all_ids[order]
+        self.list_vectors = np.ascontiguousarray(all_vectors[order])
+        counts = np.bincount(assignments, minlength=self.nlist)
+        self.list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    def _list_of_ids(self):
+        """List number of every stored vector, in storage order"""
+        return np.repeat(np.arange(self.nlist), np.diff(self.list_offsets))
+
+    def search(self, queries, k, nprobe=None):
+        """Return (ids, scores) of the k best rows found in the nprobe closest lists, best first.
+
+        Queries that find fewer than k rows are padded with id -1 and score -inf.
+        """
+        queries = l2_normalize(np.atleast_2d(queries))
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        if nprobe == 0 or k == 0:
+            return ids, scores
+
+        probes, _ = _top_k(queries @ self.centroids.T, nprobe)
+        for q, query in enumerate(queries):
+            spans = [(self.list_offsets[l], self.list_offsets[l + 1]) for l in probes[q]]
+            candidates = np.concatenate([np.arange(start, end) for start, end in spans])
+            if not len(candidates):
+                continue
+            # Score each list in place; fancy-indexing the candidates would copy them
+            candidate_scores = np.concatenate([self.list_vectors[start:end] @ query for start, end in spans])
+            best, best_scores = _top_k(candidate_scores[None, :], k)
+            ids[q, :best.shape[1]] = self.list_ids[candidates[best[0]]]
+            scores[q, :best.shape[1]] = best_scores[0]
+        return ids, scores
+
+    def save(self, path):
+        np.savez(path, kind="ivf", centroids=self.centroids, list_offsets=self.list_offsets,
+                 list_ids=self.list_ids, list_vectors=self.list_vectors, nprobe=self.nprobe)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays["centroids"], arrays["list_offsets"], arrays["list_ids"], arrays["list_vectors"],
+                   int(arrays["nprobe"]))
+
+
+def load_search_index(path):
+    """Load a FlatIndex or IVFIndex saved with .save()"""
+    with np.load(Path(path)) as arrays:
+        kind = str(arrays["kind"])
+        return {"flat": FlatIndex, "ivf": IVFIndex}[kind].from_arrays(arrays)
@@ -0,0 +1,289 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from image_loader import load_image
+from similarity import SimilarityEngine, l2_normalize
+
+DEFAULT_BATCH_SIZES = [1, 2, 4, 8, 16, 32, 64]
+DEFAULT_GALLERY_SIZES = [100, 1000, 10000, 100000, 1000000]
+DEFAULT_TEST_IMAGES = "images/test/test_*.png"
+DEFAULT_BASELINE = "benchmark_baseline.json"
+# Images per dish in the synthetic galleries, as in food_samples.json
+IMAGES_PER_SAMPLE = 10
+
+def tiny_clip(seed=0):
+    """Randomly initialized (vision_model, processor, text_model) with CLIP's architecture but tiny widths.
+
+    Preprocessing is the real 224x224 CLIP pipeline; the towers have 2 layers
+    and a byte-level tokenizer, so nothing needs to be downloaded.
+    """
+    from transformers import (CLIPImageProcessor, CLIPProcessor, CLIPTextConfig, CLIPTextModelWithProjection,
+                              CLIPTokenizer, CLIPVisionConfig, CLIPVisionModel)
+    from transformers.convert_slow_tokenizer import bytes_to_unicode
+
+    torch.manual_seed(seed)
+    vision_model = CLIPVisionModel(CLIPVisionConfig(hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                                                    num_attention_heads=4, image_size=224, patch_size=32)).eval()
+
+    # Byte-level vocabulary without merges: every character is one token
+    characters = list(bytes_to_unicode().values())
+    tokens = characters + [character + "</w>" for character in characters] + ["<|startoftext|>", "<|endoftext|>"]
+    vocab = {token: i for i, token in enumerate(tokens)}
+    with tempfile.TemporaryDirectory() as tmp:
+        vocab_file, merges_file = Path(tmp) / "vocab.json", Path(tmp) / "merges.txt"
+        vocab_file.write_text(json.dumps(vocab))
+        merges_file.write_text("#version: 0.2\n")
+        tokenizer = CLIPTokenizer(str(vocab_file), str(merges_file))
+
+    text_model = CLIPTextModelWithProjection(CLIPTextConfig(
+        vocab_size=len(vocab), hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4,
+        projection_dim=64, bos_token_id=vocab["<|startoftext|>"], eos_token_id=vocab["<|endoftext|>"],
+        pad_token_id=vocab["<|endoftext|>"])).eval()
+    processor = CLIPProcessor(image_processor=CLIPImageProcessor(), tokenizer=tokenizer)
+    return vision_model, processor, text_model
+
+def measure(fn, repeats, items=1, warmup=1):
+    """Time fn() `repeats` times after `warmup` untimed calls; `items` is the work done per call"""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    median = statistics.median(times)
+    return {
+        "median_ms": median * 1000,
+        "p90_ms": times[min(len(times) - 1, int(0.9 * len(times)))] * 1000,
+        "min_ms": times[0] * 1000,
+        "items": items,
+        "items_per_s": items / median if median > 0 else float("inf"),
+        "repeats": repeats
+    }
+
+def available_memory():
+    """Bytes of memory available without swapping (Linux), or None if unknown"""
+    try:
+        with open("/proc/meminfo", 'r') as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def bench_decode(image_bytes, repeats):
+    def decode():
+        for data in image_bytes:
+            load_image(data).convert("RGB")
+    return {"decode": measure(decode, repeats, items=len(image_bytes))}
+
+def bench_preprocess(processor, images, repeats):
+    return {
+        "preprocess/single": measure(lambda: processor(images=images[0], return_tensors="pt"), repeats),
+        "preprocess/batch": measure(lambda: processor(images=images, return_tensors="pt"), repeats,
+                                    items=len(images))
+    }
+
+def bench_pixel_cache(processor, image_paths, repeats):
+    """Preprocessed pixels read back from a PixelCache built in a tempdir (see pixel_cache.py)"""
+    from pixel_cache import PixelCache, update_pixel_cache
+
+    with tempfile.TemporaryDirectory() as tmp:
+        update_pixel_cache(tmp, processor, image_paths)
+        cache = PixelCache.open(tmp, processor)
+
+        def read():
+            for path in image_paths:
+                cache.get(path)
+        return {"preprocess/pixel_cache": measure(read, repeats, items=len(image_paths))}
+
+def bench_vision(generator, batch_sizes, repeats):
+    size = generator.vision_model.config.image_size
+    results = {}
+    for batch_size in batch_sizes:
+        pixel_values = torch.randn(batch_size, 3, size, size)
+        results[f"vision_forward/batch_{batch_size}"] = measure(lambda: generator.encode_pixels(pixel_values),
+                                                                repeats, items=batch_size)
+    return results
+
+def bench_search(gallery_sizes, dim, num_queries, repeats, seed=0):
+    """Exact search + per-dish max aggregation over synthetic unit vectors"""
+    rng = np.random.default_rng(seed)
+    queries = l2_normalize(rng.standard_normal((num_queries, dim), dtype=np.float32))
+    results = {}
+    for size in gallery_sizes:
+        name = f"search/gallery_{size}"
+        # The gallery, the engine's normalized copy and the score matrix must fit in memory
+        needed = size * dim * 4 * 2 + num_queries * size * 4 * 3
+        memory = available_memory()
+        if memory is not None and needed > memory:
+            print(f"  skipping {name}: needs ~{needed / 2**30:.1f} GiB, {memory / 2**30:.1f} GiB available",
+                  file=sys.stderr)
+            results[name] = {"skipped": "insufficient memory"}
+            continue
+        gallery = rng.standard_normal((size, dim), dtype=np.float32)
+        row_samples = np.arange(size) // IMAGES_PER_SAMPLE
+        engine = SimilarityEngine(gallery, row_samples)
+        del gallery
+        results[name] = measure(lambda: engine.top_k(queries, k=5), repeats, items=num_queries)
+        del engine
+    return results
+
+def bench_titles(generator, titles, repeats):
+    results = {}
+    if generator.text_model is not None:
+        def cold():
+            generator.query_title_embedding.cache_clear()
+            generator.batch_title_similarities(titles)
+        results["titles/clip_cold"] = measure(cold, repeats, items=len(titles))
+        results["titles/clip_cached"] = measure(lambda: generator.batch_title_similarities(titles), repeats,
+                                                items=len(titles))
+    overlap_titles = [sample["vague_title"] for sample in generator.dataset.samples]
+    results["titles/overlap"] = measure(
+        lambda: [[generator.calculate_text_similarity(title, other) for other in overlap_titles] for title in titles],
+        repeats, items=len(titles))
+    return results
+
+def bench_end_to_end(generator, image_paths, titles, repeats):
+    return {"end_to_end/generate_instructions": measure(
+        lambda: generator.generate_instructions(image_paths[0], titles[0]), repeats)}
+
+def run(args):
+    from main import FoodInstructionGenerator
+
+    torch.set_num_threads(args.threads)
+    stages = set(args.stages)
+    results = {}
+
+    image_paths = sorted(glob.glob(args.images))
+    if not image_paths and stages & {"decode", "preprocess", "end_to_end"}:
+        print(f"No images match {args.images}; skipping image stages", file=sys.stderr)
+        stages -= {"decode", "preprocess", "end_to_end"}
+
+    start = time.perf_counter()
+    generator = FoodInstructionGenerator(index_dir=None, feature_cache=None, pixel_cache=None,
+                                         num_workers=args.num_workers, execution_mode=args.execution_mode,
+                                         models=tiny_clip(args.seed))
+    setup_time = time.perf_counter() - start
+    titles = [sample["vague_title"] for sample in generator.dataset.samples] or ["cheesy pasta thing"]
+
+    if "decode" in stages:
+        print("Benchmarking image decode...", file=sys.stderr)
+        results.update(bench_decode([Path(path).read_bytes() for path in image_paths], args.repeats))
+    if "preprocess" in stages:
+        print("Benchmarking CLIP preprocessing...", file=sys.stderr)
+        images = [load_image(path).convert("RGB") for path in image_paths]
+        results.update(bench_preprocess(generator.processor, images, args.repeats))
+        results.update(bench_pixel_cache(generator.processor, image_paths, args.repeats))
+    if "vision" in stages:
+        print("Benchmarking vision forward...", file=sys.stderr)
+        results.update(bench_vision(generator, args.batch_sizes, args.repeats))
+    if "search" in stages:
+        print("Benchmarking similarity search...", file=sys.stderr)
+        results.update(bench_search(args.gallery_sizes, args.dim, args.num_queries, args.repeats, args.seed))
+    if stages & {"titles", "end_to_end"}:
+        # Gallery images and sample titles are encoded once here, outside the timed calls
+        generator.set_index(generator.build_index())
+    if "titles" in stages:
+        print("Benchmarking title scoring...", file=sys.stderr)
+        results.update(bench_titles(generator, titles, args.repeats))
+    if "end_to_end" in stages:
+        print("Benchmarking generate_instructions...", file=sys.stderr)
+        results.update(bench_end_to_end(generator, image_paths, titles, args.repeats))
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "threads": args.threads,
+            "execution_mode": args.execution_mode,
+            "model": "tiny random CLIP (benchmark.tiny_clip)",
+            "setup_s": setup_time,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")
+        },
+        "results": results
+    }
+
+def compare(report, baseline, tolerance):
+    """Return (name, baseline ms, current ms, ratio, regressed) for every benchmark in both reports"""
+    rows = []
+    for name, result in report["results"].items():
+        base = baseline["results"].get(name)
+        if not base or "median_ms" not in base or "median_ms" not in result:
+            continue
+        ratio = result["median_ms"] / base["median_ms"]
+        rows.append((name, base["median_ms"], result["median_ms"], ratio, ratio > 1 + tolerance))
+    return rows
+
+def print_results(report):
+    print(f"{'benchmark':<36}{'median ms':>12}{'p90 ms':>12}{'items/s':>12}")
+    for name, result in report["results"].items():
+        if "skipped" in result:
+            print(f"{name:<36}{'skipped: ' + result['skipped']:>36}")
+            continue
+        print(f"{name:<36}{result['median_ms']:>12.3f}{result['p90_ms']:>12.3f}{result['items_per_s']:>12.1f}")
+
+def main():
+    from main import EXECUTION_MODES
+
+    stages = ["decode", "preprocess", "vision", "search", "titles", "end_to_end"]
+    parser = argparse.ArgumentParser(description="Benchmark the matching hot path on CPU with a tiny random CLIP")
+    parser.add_argument("--stages", nargs="+", choices=stages, default=stages)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads(), help="torch intra-op threads")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=DEFAULT_BATCH_SIZES)
+    parser.add_argument("--gallery-sizes", type=int, nargs="+", default=DEFAULT_GALLERY_SIZES)
+    parser.add_argument("--dim", type=int, default=768, help="Feature size of the synthetic galleries")
+    parser.add_argument("--num-queries", type=int, default=16, help="Queries per search call")
+    parser.add_argument("--images", default=DEFAULT_TEST_IMAGES)
+    parser.add_argument("--num-workers", type=int, default=1)
+    parser.add_argument("--execution-mode", choices=EXECUTION_MODES, default="inference")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the report as JSON")
+    parser.add_argument("--save-baseline", nargs="?", const=DEFAULT_BASELINE, metavar="PATH",
+                        help=f"Store the report as a baseline (default {DEFAULT_BASELINE})")
+    parser.add_argument("--compare", nargs="?", const=DEFAULT_BASELINE, metavar="PATH",
+                        help="Compare against a stored baseline; exits 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="Allowed slowdown of the median before a benchmark counts as regressed")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_results(report)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=4)
+            print(f"Report written to {path}")
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        rows = compare(report, baseline, args.tolerance)
+        print(f"\nAgainst {args.compare} (tolerance {args.tolerance:.0%}):")
+        print(f"{'benchmark':<36}{'baseline ms':>12}{'now ms':>12}{'ratio':>8}")
+        for name, base_ms, now_ms, ratio, regressed in rows:
+            print(f"{name:<36}{base_ms:>12.3f}{now_ms:>12.3f}{ratio:>8.2f}{'  REGRESSION' if regressed else ''}")
+        regressions = [row for row in rows if row[4]]
+        if regressions:
+            print(f"{len(regressions)} regression(s)")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
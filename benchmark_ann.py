@@ -0,0 +1,92 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+from ann_index import FlatIndex, IVFIndex
+from embedding_index import EmbeddingIndex
+
+def synthetic_embeddings(num_vectors, dim, num_clusters=1000, seed=0):
+    """Clustered random vectors, closer to real image features than uniform noise"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(num_clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, num_clusters, num_vectors)
+    return centers[labels] + rng.normal(size=(num_vectors, dim)).astype(np.float32)
+
+def recall_at_k(approx_ids, exact_ids):
+    """Fraction of the exact top-k found by the approximate search, averaged over queries"""
+    k = exact_ids.shape[1]
+    return float(np.mean([len(set(a) & set(e)) / k for a, e in zip(approx_ids, exact_ids)]))
+
+def drop_rows(ids, rows, k):
+    """The first k ids of each result row, skipping that query's own row in `rows`"""
+    return np.stack([result[result != row][:k] for result, row in zip(ids, rows)])
+
+def benchmark(name, vectors, queries, k, nlists, nprobes, query_rows=None):
+    """Recall@k and per-query latency of IVF settings against exact search.
+
+    With `query_rows` (the row of vectors each query is), that row is left
+    out of both the exact and the IVF results.
+    """
+    def search(index, **kwargs):
+        if query_rows is None:
+            return index.search(queries, k, **kwargs)[0]
+        return drop_rows(index.search(queries, k + 1, **kwargs)[0], query_rows, k)
+
+    flat = FlatIndex(vectors)
+    start = time.perf_counter()
+    exact_ids = search(flat)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    results = [{"dataset": name, "backend": "flat", "num_vectors": len(vectors),
+                "recall": 1.0, "query_ms": exact_ms}]
+    print(f"\n{name}: {len(vectors)} x {vectors.shape[1]}, {len(queries)} queries, k={k}")
+    print(f"  flat                  recall@{k}=1.000  {exact_ms:8.3f} ms/query")
+
+    for nlist in nlists:
+        start = time.perf_counter()
+        ivf = IVFIndex.train(vectors, nlist=nlist)
+        train_s = time.perf_counter() - start
+        for nprobe in nprobes:
+            if nprobe > ivf.nlist:
+                continue
+            start = time.perf_counter()
+            ids = search(ivf, nprobe=nprobe)
+            query_ms = (time.perf_counter() - start) * 1000 / len(queries)
+            recall = recall_at_k(ids, exact_ids)
+            results.append({"dataset": name, "backend": "ivf", "num_vectors": len(vectors), "nlist": ivf.nlist,
+                            "nprobe": nprobe, "train_s": train_s, "recall": recall, "query_ms": query_ms})
+            print(f"  ivf nlist={ivf.nlist:<5} nprobe={nprobe:<4} recall@{k}={recall:.3f}  {query_ms:8.3f} ms/query")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@k and latency of the IVF index against exact search")
+    parser.add_argument("--index-dir", default="gallery_index", help="Real gallery index (see build_index.py)")
+    parser.add_argument("--num-vectors", type=int, default=200_000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, nargs="+", default=[256, 1024])
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--output", help="Write results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    if EmbeddingIndex.exists(args.index_dir):
+        # Leave-one-out: each gallery image queries the rest of the gallery
+        gallery = np.asarray(EmbeddingIndex.load(args.index_dir).live_embeddings())
+        results += benchmark("images/ gallery (leave-one-out)", gallery, gallery, min(args.k, len(gallery) - 1),
+                             nlists=[4, 10], nprobes=[1, 2, 4], query_rows=np.arange(len(gallery)))
+    else:
+        print(f"No gallery index at {args.index_dir}; run build_index.py to include the real gallery")
+
+    vectors = synthetic_embeddings(args.num_vectors + args.num_queries, args.dim)
+    results += benchmark("synthetic", vectors[args.num_queries:], vectors[:args.num_queries], args.k,
+                         args.nlist, args.nprobe)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == "__main__":
+    main()
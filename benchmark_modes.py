@@ -0,0 +1,107 @@
+import argparse
+import json
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+def run_mode(mode, repeats, batch_size):
+    """Benchmark one execution mode in this process and return its measurements"""
+    import torch
+    from main import FoodInstructionGenerator
+    from evaluate_accuracy import load_test_cases
+
+    start = time.perf_counter()
+    generator = FoodInstructionGenerator(index_dir=None, feature_cache=None, execution_mode=mode)
+    setup_time = time.perf_counter() - start
+
+    cases = load_test_cases(generator.dataset)
+    size = generator.vision_model.config.image_size
+    single = torch.randn(1, 3, size, size)
+    batch = torch.randn(batch_size, 3, size, size)
+
+    # Warm up (compile/trace modes do their real work on the first call)
+    generator.encode_pixels(single)
+    generator.encode_pixels(batch)
+
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        generator.encode_pixels(single)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(max(1, repeats // 4)):
+        generator.encode_pixels(batch)
+    batch_time = (time.perf_counter() - start) / max(1, repeats // 4)
+
+    start = time.perf_counter()
+    generator.set_index(generator.build_index(batch_size))
+    index_time = time.perf_counter() - start
+
+    pairs = [(image_path, vague_title) for image_path, _, vague_title in cases]
+    results = list(generator.generate_instructions_batch(pairs, batch_size, top_k=1))
+    predictions = [result["title"] if result else None for result in results]
+    correct = sum(1 for (_, food_item, _), prediction in zip(cases, predictions)
+                  if prediction and food_item in prediction.lower())
+
+    return {
+        "mode": mode,
+        "setup_s": setup_time,
+        "latency_ms_p50": statistics.median(latencies) * 1000,
+        "latency_ms_min": min(latencies) * 1000,
+        "batch_images_per_s": batch_size / batch_time,
+        "index_build_s": index_time,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "top1_accuracy": correct / len(cases) if cases else 0.0,
+        "predictions": predictions
+    }
+
+def main():
+    from main import EXECUTION_MODES
+
+    parser = argparse.ArgumentParser(description="Compare CLIP encoder execution modes on CPU")
+    parser.add_argument("--modes", nargs="+", default=list(EXECUTION_MODES), choices=EXECUTION_MODES)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--output", help="Write the full report as JSON")
+    parser.add_argument("--run-mode", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_mode:
+        print(json.dumps(run_mode(args.run_mode, args.repeats, args.batch_size)))
+        return
+
+    # Each mode runs in a fresh process so peak RSS is measured per mode
+    modes = ["fp32"] + [mode for mode in args.modes if mode != "fp32"]
+    reports = []
+    for mode in modes:
+        print(f"Benchmarking {mode}...", file=sys.stderr)
+        proc = subprocess.run([sys.executable, __file__, "--run-mode", mode, "--repeats", str(args.repeats),
+                               "--batch-size", str(args.batch_size)],
+                              capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f"  {mode} failed:\n{proc.stderr}", file=sys.stderr)
+            continue
+        reports.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    baseline = next((report for report in reports if report["mode"] == "fp32"), None)
+    for report in reports:
+        if baseline:
+            report["accuracy_delta"] = report["top1_accuracy"] - baseline["top1_accuracy"]
+            agree = sum(1 for a, b in zip(report["predictions"], baseline["predictions"]) if a == b)
+            report["agreement_with_fp32"] = agree / len(baseline["predictions"]) if baseline["predictions"] else 1.0
+
+    print(f"\n{'mode':<10}{'p50 ms':>9}{'img/s':>9}{'RSS MB':>9}{'top-1':>8}{'delta':>8}{'agree':>8}")
+    for report in reports:
+        print(f"{report['mode']:<10}{report['latency_ms_p50']:>9.1f}{report['batch_images_per_s']:>9.1f}"
+              f"{report['peak_rss_mb']:>9.0f}{report['top1_accuracy']:>8.2f}"
+              f"{report.get('accuracy_delta', 0.0):>+8.2f}{report.get('agreement_with_fp32', 1.0):>8.2f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=4)
+
+if __name__ == "__main__":
+    main()
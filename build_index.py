@@ -0,0 +1,55 @@
+import argparse
+from pathlib import Path
+from main import (FoodInstructionGenerator, DEFAULT_INDEX_DIR, DEFAULT_BATCH_SIZE, DEFAULT_DATASET_FILE,
+                  IVF_INDEX_FILE, COMPACT_RATIO, format_index_update)
+from ann_index import IVFIndex, load_search_index
+from embedding_index import EmbeddingIndex
+from image_loader import DEFAULT_NUM_WORKERS
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute CLIP features for every gallery image")
+    parser.add_argument("--index-dir", default=DEFAULT_INDEX_DIR, help="Where to write the index")
+    parser.add_argument("--dataset", default=DEFAULT_DATASET_FILE,
+                        help="food_samples.json or a dataset store directory")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--num-workers", type=int, default=DEFAULT_NUM_WORKERS,
+                        help="Image decode/preprocess workers")
+    parser.add_argument("--ivf-nlist", type=int,
+                        help="Also train an IVF index with this many lists (for --search-backend ivf)")
+    parser.add_argument("--full", action="store_true",
+                        help="Re-encode every image instead of updating an existing index incrementally")
+    args = parser.parse_args()
+
+    print("Loading model and dataset...")
+    generator = FoodInstructionGenerator(index_dir=None, num_workers=args.num_workers,
+                                         dataset_file=args.dataset)
+    if len(generator.dataset.samples) == 0:
+        print("WARNING: Dataset is empty! Run add_samples.py first.")
+        return
+
+    # Keep the IVF codebook size of an existing IVF index when retraining it
+    ivf_path = Path(args.index_dir) / IVF_INDEX_FILE
+    nlist = args.ivf_nlist or (load_search_index(ivf_path).nlist if ivf_path.exists() else None)
+
+    index = EmbeddingIndex.load(args.index_dir) if EmbeddingIndex.exists(args.index_dir) and not args.full else None
+    if index is not None and not index.model_problems(**generator.index_identity()):
+        # Only new or changed images are encoded; removed ones are tombstoned
+        summary = generator.update_stored_index(index, args.index_dir, batch_size=args.batch_size)
+        print(f"Updated index: {format_index_update(summary)}")
+        if index.tombstone_ratio > COMPACT_RATIO:
+            index = index.compacted()
+            index.save(args.index_dir)
+            print("Compacted tombstoned rows")
+    else:
+        print(f"Encoding {sum(len(s['image_paths']) for s in generator.dataset.samples)} gallery images...")
+        index = generator.build_index(batch_size=args.batch_size)
+        index.save(args.index_dir)
+    print(f"Saved {len(index)} x {index.dim} index to {args.index_dir}")
+
+    if nlist:
+        ivf = IVFIndex.train(index.live_embeddings(), nlist=nlist)
+        ivf.save(Path(args.index_dir) / IVF_INDEX_FILE)
+        print(f"Saved IVF index with {ivf.nlist} lists to {Path(args.index_dir) / IVF_INDEX_FILE}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+import argparse
+import itertools
+import json
+import re
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from main import (FoodInstructionGenerator, DEFAULT_BATCH_SIZE, DEFAULT_DATASET_FILE, DEFAULT_INDEX_DIR, MODEL_NAME,
+                  batched, read_inputs)
+
+DEFAULT_THRESHOLDS_FILE = "cascade_thresholds.json"
+DEFAULT_REPORT = "cascade_report.json"
+# Used until `python cascade.py calibrate` has written calibrated thresholds
+DEFAULT_MIN_SCORE = 0.8
+DEFAULT_MIN_MARGIN = 0.02
+DEFAULT_LLAVA_TOKENS = 120
+
+def load_thresholds(path=DEFAULT_THRESHOLDS_FILE):
+    """(min_score, min_margin) saved by calibration, or the defaults"""
+    if path and Path(path).exists():
+        with open(path, 'r') as f:
+            thresholds = json.load(f)
+        return thresholds["min_score"], thresholds["min_margin"]
+    return DEFAULT_MIN_SCORE, DEFAULT_MIN_MARGIN
+
+def confidence(result):
+    """(top-1 score, top-1 minus top-2 score) of a CLIP match result"""
+    if not result:
+        return float("-inf"), float("-inf")
+    scores = [match["similarity"] for match in result["matches"]]
+    return scores[0], scores[0] - scores[1] if len(scores) > 1 else scores[0]
+
+def build_prompt(vague_title, candidates):
+    """LLaVA prompt listing the retrieved recipes for it to choose from"""
+    lines = ["These recipes were retrieved as candidates for the dish in the photo:"]
+    for i, sample in enumerate(candidates, 1):
+        lines.append(f"{i}. {sample['actual_name']}: {' '.join(sample['concise_steps'])}")
+    if vague_title:
+        lines.append(f'The user describes it as "{vague_title}".')
+    lines.append("Which candidate is the dish in the photo? Answer with its name, then give the cooking steps.")
+    return "\n".join(lines)
+
+def pick_candidate(text, candidates):
+    """Index of the candidate LLaVA's answer names (earliest mention, or a leading number), or None"""
+    lowered = text.lower()
+    mentions = [(lowered.find(sample["actual_name"].lower()), i) for i, sample in enumerate(candidates)]
+    mentions = [mention for mention in mentions if mention[0] >= 0]
+    if mentions:
+        return min(mentions)[1]
+    number = re.match(r"\s*(?:candidate\s*)?(\d+)", lowered)
+    if number and 1 <= int(number.group(1)) <= len(candidates):
+        return int(number.group(1)) - 1
+    return None
+
+class CascadePipeline:
+    """Answer from the CLIP match when it is confident, escalate to LLaVA otherwise.
+
+    A CLIP result is accepted when its top-1 score is at least `min_score`
+    and it leads the runner-up by at least `min_margin`. Other queries go to
+    LLaVA-Next (`session`, a mistral_working.LlavaSession created on first
+    escalation) with the top-k retrieved recipes in the prompt; the recipe it
+    names replaces the CLIP pick, and its answer is kept as `generated_text`.
+    If it names none of them the CLIP pick stands.
+    """
+
+    def __init__(self, generator, session=None, min_score=DEFAULT_MIN_SCORE, min_margin=DEFAULT_MIN_MARGIN,
+                 top_k=3, max_new_tokens=DEFAULT_LLAVA_TOKENS):
+        self.generator = generator
+        self._session = session
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self.top_k = top_k
+        self.max_new_tokens = max_new_tokens
+        self.queries = 0
+        self.escalations = 0
+        self.clip_seconds = 0.0
+        self.llava_seconds = 0.0
+        # CLIP runs on every query: keep it resident when an escalation loads LLaVA
+        for part in ("processor", "vision", "text"):
+            generator.registry.pin(f"{MODEL_NAME}:{part}")
+
+    @property
+    def session(self):
+        if self._session is None:
+            from mistral_working import LlavaSession
+
+            self._session = LlavaSession(max_new_tokens=self.max_new_tokens, registry=self.generator.registry)
+        return self._session
+
+    def sample(self, match):
+        """Dataset sample of one of a result's matches (by row, as samples may share a name)"""
+        return self.generator.dataset.samples[match["sample"]]
+
+    def load_models(self):
+        """Load CLIP and LLaVA now, e.g. so calibration timings don't include loading"""
+        self.generator.load_models()
+        self.session.model
+
+    def should_escalate(self, result):
+        score, margin = confidence(result)
+        return score < self.min_score or margin < self.min_margin
+
+    def clip_results(self, pairs, batch_size=DEFAULT_BATCH_SIZE):
+        start = time.perf_counter()
+        results = list(self.generator.generate_instructions_batch(pairs, batch_size, self.top_k))
+        self.clip_seconds += time.perf_counter() - start
+        return results
+
+    def llava_results(self, pairs, clip_results):
+        """Ask LLaVA to pick among each query's retrieved recipes; returns cascade results"""
+        candidates = [[self.sample(match) for match in result["matches"]] if result else []
+                      for result in clip_results]
+        # Queries without a CLIP result have nothing for LLaVA to choose from
+        asked = [i for i, result in enumerate(clip_results) if result]
+        prompts = [(pairs[i][0], build_prompt(pairs[i][1], candidates[i])) for i in asked]
+        answers = [None] * len(clip_results)
+        start = time.perf_counter()
+        for i, answer in zip(asked, self.session.generate_batch(prompts, self.max_new_tokens)):
+            answers[i] = answer
+        self.llava_seconds += time.perf_counter() - start
+
+        results = []
+        for clip_result, options, answer in zip(clip_results, candidates, answers):
+            if answer is None:
+                results.append(None)
+                continue
+            choice = pick_candidate(answer["text"], options)
+            result = dict(clip_result)
+            if choice is not None:
+                chosen = options[choice]
+                result.update(title=chosen["actual_name"], vague_title=chosen["vague_title"],
+                              steps=chosen["concise_steps"], best_match=chosen,
+                              similarity=clip_result["matches"][choice]["similarity"])
+            result.update(source="llava", generated_text=answer["text"], llava_choice=choice)
+            results.append(result)
+        return results
+
+    def generate_batch(self, pairs, batch_size=DEFAULT_BATCH_SIZE):
+        """Cascade results for (image, vague_title) pairs, in order"""
+        pairs = list(pairs)
+        results = self.clip_results(pairs, batch_size)
+        escalate = [i for i, result in enumerate(results) if result is not None and self.should_escalate(result)]
+        for i, result in enumerate(results):
+            if result is not None and i not in escalate:
+                results[i] = {**result, "source": "clip"}
+        if escalate:
+            escalated = self.llava_results([pairs[i] for i in escalate], [results[i] for i in escalate])
+            for i, result in zip(escalate, escalated):
+                results[i] = result
+        for result in results:
+            if result is not None:
+                result["confidence"] = dict(zip(("score", "margin"), confidence(result)))
+        self.queries += len(pairs)
+        self.escalations += len(escalate)
+        return results
+
+    def generate(self, image, vague_title):
+        return self.generate_batch([(image, vague_title)])[0]
+
+    def stats(self):
+        return {
+            "queries": self.queries,
+            "escalations": self.escalations,
+            "escalation_rate": self.escalations / self.queries if self.queries else 0.0,
+            "clip_seconds": self.clip_seconds,
+            "llava_seconds": self.llava_seconds,
+            "min_score": self.min_score,
+            "min_margin": self.min_margin,
+            "models": self.generator.registry.stats()
+        }
+
+def threshold_curve(scores, margins, clip_correct, llava_correct, clip_cost, llava_cost, num_thresholds=20):
+    """Escalation rate, accuracy and cost per query of every (min_score, min_margin) pair on a grid.
+
+    The grid comes from quantiles of the observed scores and margins, plus
+    "never escalate"; with every query's CLIP and LLaVA outcome known, each
+    point is a mask over the arrays.
+    """
+    def grid(values):
+        # Queries without a result score -inf; they are covered by the sentinels
+        finite = values[np.isfinite(values)]
+        points = np.quantile(finite, quantiles) if len(finite) else []
+        return np.unique(np.concatenate([[-np.inf], points, [np.inf]]))
+
+    quantiles = np.linspace(0, 1, num_thresholds + 1)
+    score_grid = grid(scores)
+    margin_grid = grid(margins)
+    curve = []
+    for min_score, min_margin in itertools.product(score_grid, margin_grid):
+        escalate = (scores < min_score) | (margins < min_margin)
+        rate = float(escalate.mean())
+        curve.append({
+            "min_score": float(min_score),
+            "min_margin": float(min_margin),
+            "escalation_rate": rate,
+            "accuracy": float(np.where(escalate, llava_correct, clip_correct).mean()),
+            "cost_s": clip_cost + rate * llava_cost
+        })
+    return curve
+
+def pareto_front(curve):
+    """Points no other point beats on both escalation rate and accuracy, cheapest first"""
+    front = []
+    for point in sorted(curve, key=lambda point: (point["escalation_rate"], -point["accuracy"])):
+        if not front or point["accuracy"] > front[-1]["accuracy"]:
+            front.append(point)
+    return front
+
+def calibrate(pipeline, cases, tolerance=0.01, batch_size=DEFAULT_BATCH_SIZE, num_thresholds=20):
+    """Run CLIP and LLaVA on every labelled case and pick the cheapest thresholds within tolerance.
+
+    `cases` are (image_path, food_item, vague_title) triples (see
+    evaluate_accuracy.load_test_cases); their titles must not come from the
+    ground-truth sample, as both CLIP and LLaVA's prompt see them. The target
+    accuracy is the best of CLIP-only and LLaVA-on-everything, minus
+    `tolerance`. Costs are per query, excluding model loading.
+    """
+    pairs = [(image_path, vague_title) for image_path, _, vague_title in cases]
+    pipeline.load_models()
+    start = time.perf_counter()
+    clip_results = pipeline.clip_results(pairs, batch_size)
+    clip_cost = (time.perf_counter() - start) / len(cases)
+    start = time.perf_counter()
+    llava_results = pipeline.llava_results(pairs, clip_results)
+    llava_cost = (time.perf_counter() - start) / len(cases)
+
+    def correct(result, food_item):
+        return bool(result) and food_item in result["title"].lower()
+
+    clip_correct = np.array([correct(result, item) for result, (_, item, _) in zip(clip_results, cases)])
+    llava_correct = np.array([correct(result, item) for result, (_, item, _) in zip(llava_results, cases)])
+    scores, margins = np.array([confidence(result) for result in clip_results]).T
+
+    curve = threshold_curve(scores, margins, clip_correct, llava_correct, clip_cost, llava_cost, num_thresholds)
+    target = max(clip_correct.mean(), llava_correct.mean()) - tolerance
+    chosen = min((point for point in curve if point["accuracy"] >= target),
+                 key=lambda point: (point["escalation_rate"], -point["accuracy"]))
+    return {
+        "num_images": len(cases),
+        "clip_accuracy": float(clip_correct.mean()),
+        "llava_accuracy": float(llava_correct.mean()),
+        "clip_cost_s": clip_cost,
+        "llava_cost_s": llava_cost,
+        "target_accuracy": float(target),
+        "chosen": chosen,
+        "pareto_front": pareto_front(curve),
+        "curve": curve,
+        "cases": [{"image": image_path, "food_item": food_item, "score": float(score), "margin": float(margin),
+                   "clip_correct": bool(clip_ok), "llava_correct": bool(llava_ok),
+                   "llava_text": llava_result["generated_text"] if llava_result else None}
+                  for (image_path, food_item, _), score, margin, clip_ok, llava_ok, llava_result
+                  in zip(cases, scores, margins, clip_correct, llava_correct, llava_results)]
+    }
+
+def make_pipeline(args):
+    generator = FoodInstructionGenerator(index_dir=args.index_dir, dataset_file=args.dataset)
+    session = None
+    if args.tiny_llava:
+        from mistral_working import LlavaSession, TINY_MODEL_ID, tiny_llava
+
+        session = LlavaSession(TINY_MODEL_ID, loader=tiny_llava, max_new_tokens=args.max_new_tokens,
+                               registry=generator.registry)
+    min_score, min_margin = load_thresholds(args.thresholds)
+    if getattr(args, "min_score", None) is not None:
+        min_score = args.min_score
+    if getattr(args, "min_margin", None) is not None:
+        min_margin = args.min_margin
+    return CascadePipeline(generator, session, min_score, min_margin, args.top_k, args.max_new_tokens)
+
+def run(args):
+    pipeline = make_pipeline(args)
+    out = sys.stdout if args.output == "-" else open(args.output, 'w')
+    try:
+        for batch in batched(read_inputs(args.input, args.title), args.batch_size):
+            for (image_path, vague_title), result in zip(batch, pipeline.generate_batch(batch, args.batch_size)):
+                record = {"image": image_path, "input_title": vague_title}
+                if result:
+                    record.update({key: value for key, value in result.items() if key != "best_match"})
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    stats = pipeline.stats()
+    print(f"{stats['queries']} queries, {stats['escalations']} escalated to LLaVA "
+          f"({stats['escalation_rate']:.0%}); CLIP {stats['clip_seconds']:.1f}s, LLaVA {stats['llava_seconds']:.1f}s",
+          file=sys.stderr)
+
+def run_calibration(args):
+    from evaluate_accuracy import load_test_cases
+
+    pipeline = make_pipeline(args)
+    cases = load_test_cases(pipeline.generator.dataset, args.pattern, args.manifest)
+    if not cases:
+        print("No labelled test images to calibrate on.")
+        return
+    print(f"Running CLIP and LLaVA on {len(cases)} test images...")
+    report = calibrate(pipeline, cases, args.tolerance, args.batch_size)
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=4)
+
+    print(f"CLIP only: {report['clip_accuracy']:.1%} accuracy, {report['clip_cost_s'] * 1000:.0f} ms/query; "
+          f"LLaVA on everything: {report['llava_accuracy']:.1%}, "
+          f"{(report['clip_cost_s'] + report['llava_cost_s']) * 1000:.0f} ms/query")
+    print(f"\n{'escalated':>9} {'accuracy':>8} {'ms/query':>9} {'min score':>9} {'min margin':>10}")
+    for point in report["pareto_front"]:
+        print(f"{point['escalation_rate']:>9.0%} {point['accuracy']:>8.1%} {point['cost_s'] * 1000:>9.0f} "
+              f"{point['min_score']:>9.3f} {point['min_margin']:>10.3f}")
+    chosen = report["chosen"]
+    print(f"\nChosen: min_score={chosen['min_score']:.3f}, min_margin={chosen['min_margin']:.3f} -> "
+          f"{chosen['accuracy']:.1%} accuracy (target {report['target_accuracy']:.1%}) with "
+          f"{chosen['escalation_rate']:.0%} of queries escalated")
+    with open(args.thresholds, 'w') as f:
+        json.dump({"min_score": chosen["min_score"], "min_margin": chosen["min_margin"]}, f, indent=4)
+    print(f"Thresholds written to {args.thresholds}, full curve to {args.report}")
+
+def main():
+    from evaluate_accuracy import TEST_PATTERN
+
+    parser = argparse.ArgumentParser(description="CLIP retrieval first, LLaVA-Next only for uncertain matches")
+    parser.add_argument("command", choices=["run", "calibrate"],
+                        help="run: answer queries; calibrate: pick thresholds on labelled test images")
+    parser.add_argument("--input", default="images/test", help="run: image directory, glob or JSONL manifest")
+    parser.add_argument("--title", default="", help="run: vague title used for directory/glob inputs")
+    parser.add_argument("--output", default="-", help="run: JSONL output file ('-' for stdout)")
+    parser.add_argument("--min-score", type=float, help="Escalate when the top-1 score is below this")
+    parser.add_argument("--min-margin", type=float, help="Escalate when top-1 leads top-2 by less than this")
+    parser.add_argument("--thresholds", default=DEFAULT_THRESHOLDS_FILE,
+                        help="Calibrated thresholds (written by calibrate, read by run)")
+    parser.add_argument("--pattern", default=TEST_PATTERN, help="calibrate: glob of test images")
+    parser.add_argument("--manifest", help='calibrate: JSONL of {"image", "label", "title"} test cases')
+    parser.add_argument("--tolerance", type=float, default=0.01,
+                        help="calibrate: accuracy below the best single model that is acceptable")
+    parser.add_argument("--report", default=DEFAULT_REPORT, help="calibrate: cost/accuracy curve")
+    parser.add_argument("--top-k", type=int, default=3, help="Retrieved recipes shown to LLaVA")
+    parser.add_argument("--max-new-tokens", type=int, default=DEFAULT_LLAVA_TOKENS)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--dataset", default=DEFAULT_DATASET_FILE)
+    parser.add_argument("--index-dir", default=DEFAULT_INDEX_DIR)
+    parser.add_argument("--tiny-llava", action="store_true",
+                        help="Use a tiny random LLaVA-Next (see mistral_working.tiny_llava) to try the pipeline")
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        run_calibration(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+import argparse
+import hashlib
+import json
+import mmap
+from collections.abc import Sequence
+from pathlib import Path
+
+import numpy as np
+
+STORE_VERSION = 1
+HEADER_FILE = "header.json"
+RECIPES_FILE = "recipes.bin"
+IMAGES_FILE = "images.bin"
+STRINGS_FILE = "strings.bin"
+EMBEDDINGS_FILE = "embeddings.f32"
+
+# Every text field is an (offset, length) slice of the UTF-8 string pool.
+# Instruction lists are stored as JSON strings.
+RECIPE_DTYPE = np.dtype([
+    ("actual_name", "<u8", 2),
+    ("vague_title", "<u8", 2),
+    ("full_instructions", "<u8", 2),
+    ("concise_steps", "<u8", 2),
+    ("first_image", "<u8"),
+    ("num_images", "<u8"),
+])
+IMAGE_DTYPE = np.dtype([
+    ("sample", "<u8"),
+    ("path", "<u8", 2),
+    ("sha256", "u1", 32),
+])
+
+
+def _digest(path):
+    """Raw SHA-256 of a file, or 32 zero bytes if it does not exist (yet)"""
+    if not Path(path).exists():
+        return bytes(32)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.digest()
+
+
+class StoreSamples(Sequence):
+    """Read-only list-of-dicts view over a DatasetStore; samples are decoded on access"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store.num_recipes
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.store.sample(i) for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("sample index out of range")
+        return self.store.sample(idx)
+
+
+class StoreImages(Sequence):
+    """Read-only list view of a DatasetStore's image rows as {"sample", "image_path", "sha256"} dicts.
+
+    Covers the rows stored when the view was made; later appends are not in it.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.num_images = store.num_images
+
+    def __len__(self):
+        return self.num_images
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[i] for i in range(*row.indices(len(self)))]
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError("image row out of range")
+        return {"sample": self.store.image_sample(row), "image_path": self.store.image_path(row),
+                "sha256": self.store.image_sha256(row)}
+
+
+class DatasetStore:
+    """Append-only, memory-mapped columnar storage for the food dataset.
+
+    A store is a directory holding a fixed-width recipe table, a fixed-width
+    image-path table, a UTF-8 string pool and an optional float32 embedding
+    matrix with one row per image. Opening a store only maps the files, so
+    startup cost does not grow with the catalogue. `add_sample` appends to
+    every file and writes the recipe record last, so a crash mid-append
+    leaves the previously committed samples intact.
+
+    The header's `features` names what the embedding rows were computed
+    with (a main.FoodInstructionGenerator.cache_namespace); a generator with
+    the same one uses the matrix as its gallery index (see
+    EmbeddingIndex.from_store).
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / HEADER_FILE, 'r') as f:
+            self.header = json.load(f)
+        self.embedding_dim = self.header.get("embedding_dim")
+        self.features = self.header.get("features")
+        self._maps = None
+        self._strings_file = None
+
+    @classmethod
+    def create(cls, path, embedding_dim=None, features=None):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        if (path / HEADER_FILE).exists():
+            raise FileExistsError(f"Dataset store already exists at {path}")
+        with open(path / HEADER_FILE, 'w') as f:
+            json.dump({"version": STORE_VERSION, "embedding_dim": embedding_dim, "features": features}, f, indent=4)
+        names = [RECIPES_FILE, IMAGES_FILE, STRINGS_FILE] + ([EMBEDDINGS_FILE] if embedding_dim else [])
+        for name in names:
+            (path / name).touch()
+        return cls(path)
+
+    @staticmethod
+    def is_store(path):
+        return (Path(path) / HEADER_FILE).exists()
+
+    @property
+    def samples(self):
+        return StoreSamples(self)
+
+    @property
+    def images(self):
+        return StoreImages(self)
+
+    def set_features(self, features):
+        """Record what the embedding rows are computed with"""
+        self.header["features"] = self.features = features
+        tmp = self.path / (HEADER_FILE + ".tmp")
+        with open(tmp, 'w') as f:
+            json.dump(self.header, f, indent=4)
+        tmp.replace(self.path / HEADER_FILE)
+
+    # Reading
+
+    def _load_maps(self):
+        if self._maps is not None:
+            return self._maps
+        recipes_size = (self.path / RECIPES_FILE).stat().st_size
+        num_recipes = recipes_size // RECIPE_DTYPE.itemsize
+        recipes = (np.memmap(self.path / RECIPES_FILE, dtype=RECIPE_DTYPE, mode='r', shape=(num_recipes,))
+                   if num_recipes else np.zeros(0, dtype=RECIPE_DTYPE))
+
+        # Images past the last committed recipe belong to an interrupted append
+        num_images = int(recipes[-1]["first_image"] + recipes[-1]["num_images"]) if num_recipes else 0
+        images = (np.memmap(self.path / IMAGES_FILE, dtype=IMAGE_DTYPE, mode='r', shape=(num_images,))
+                  if num_images else np.zeros(0, dtype=IMAGE_DTYPE))
+
+        embeddings = None
+        if self.embedding_dim:
+            embeddings = (np.memmap(self.path / EMBEDDINGS_FILE, dtype=np.float32, mode='r',
+                                    shape=(num_images, self.embedding_dim))
+                          if num_images else np.zeros((0, self.embedding_dim), dtype=np.float32))
+
+        strings = None
+        if (self.path / STRINGS_FILE).stat().st_size:
+            self._strings_file = open(self.path / STRINGS_FILE, 'rb')
+            strings = mmap.mmap(self._strings_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps = {"recipes": recipes, "images": images, "embeddings": embeddings, "strings": strings}
+        return self._maps
+
+    def _invalidate(self):
+        if self._maps is not None and self._maps["strings"] is not None:
+            self._maps["strings"].close()
+            self._strings_file.close()
+        self._maps = None
+
+    def close(self):
+        self._invalidate()
+
+    def _string(self, span):
+        offset, length = int(span[0]), int(span[1])
+        return self._load_maps()["strings"][offset:offset + length].decode("utf-8")
+
+    @property
+    def num_recipes(self):
+        return len(self._load_maps()["recipes"])
+
+    @property
+    def num_images(self):
+        return len(self._load_maps()["images"])
+
+    @property
+    def strings_size(self):
+        """Bytes in the string pool, including any an interrupted append left behind"""
+        return (self.path / STRINGS_FILE).stat().st_size
+
+    @property
+    def embeddings(self):
+        """(num_images, embedding_dim) memory-mapped matrix; rows not yet encoded are NaN"""
+        return self._load_maps()["embeddings"]
+
+    @property
+    def image_samples(self):
+        """Sample index of every image row"""
+        return np.asarray(self._load_maps()["images"]["sample"], dtype=np.int64)
+
+    def image_sample(self, row):
+        return int(self._load_maps()["images"][row]["sample"])
+
+    def image_path(self, row):
+        return self._string(self._load_maps()["images"][row]["path"])
+
+    def image_sha256(self, row):
+        return bytes(self._load_maps()["images"][row]["sha256"]).hex()
+
+    @property
+    def image_digests(self):
+        """(num_images, 32) uint8 SHA-256 digests of every image row (zeros for files missing when added)"""
+        return self._load_maps()["images"]["sha256"]
+
+    def sample(self, idx):
+        record = self._load_maps()["recipes"][idx]
+        first, count = int(record["first_image"]), int(record["num_images"])
+        return {
+            "actual_name": self._string(record["actual_name"]),
+            "image_paths": [self.image_path(row) for row in range(first, first + count)],
+            "vague_title": self._string(record["vague_title"]),
+            "full_instructions": json.loads(self._string(record["full_instructions"])),
+            "concise_steps": json.loads(self._string(record["concise_steps"]))
+        }
+
+    # Writing
+
+    def add_sample(self, actual_name, image_paths, vague_title, full_instructions, concise_steps,
+                   image_embeddings=None):
+        """Append one sample without rewriting existing data.
+
+        `image_embeddings` is an optional (len(image_paths), embedding_dim)
+        array; images without embeddings get NaN rows.
+        """
+        sample = {"actual_name": actual_name, "image_paths": image_paths, "vague_title": vague_title,
+                  "full_instructions": full_instructions, "concise_steps": concise_steps}
+        return self.add_samples([sample], image_embeddings)[0]
+
+    def add_samples(self, samples, image_embeddings=None):
+        """Append many samples with one write per file; returns their sample indices.
+
+        `samples` are dicts shaped like the ones `sample` returns, optionally
+        with precomputed hex "image_sha256" digests of their images.
+        `image_embeddings` is an optional (total images, embedding_dim) array
+        in sample order; images without embeddings get NaN rows.
+        """
+        image_lists = [sample["image_paths"] if isinstance(sample["image_paths"], list) else [sample["image_paths"]]
+                       for sample in samples]
+        num_images = sum(len(paths) for paths in image_lists)
+        if image_embeddings is not None:
+            if not self.embedding_dim:
+                raise ValueError("This dataset store was created without an embedding matrix")
+            image_embeddings = np.asarray(image_embeddings, dtype=np.float32).reshape(num_images,
+                                                                                     self.embedding_dim)
+
+        maps = self._load_maps()
+        first_sample = len(maps["recipes"])
+        first_image = len(maps["images"])
+        strings_offset = self.strings_size
+        self._invalidate()
+
+        pool = bytearray()
+        def intern(text):
+            encoded = text.encode("utf-8")
+            span = (strings_offset + len(pool), len(encoded))
+            pool.extend(encoded)
+            return span
+
+        recipes = np.zeros(len(samples), dtype=RECIPE_DTYPE)
+        images = np.zeros(num_images, dtype=IMAGE_DTYPE)
+        row = 0
+        for i, (sample, paths) in enumerate(zip(samples, image_lists)):
+            recipe = recipes[i]
+            recipe["actual_name"] = intern(sample["actual_name"])
+            recipe["vague_title"] = intern(sample["vague_title"])
+            recipe["full_instructions"] = intern(json.dumps(sample["full_instructions"]))
+            recipe["concise_steps"] = intern(json.dumps(sample["concise_steps"]))
+            recipe["first_image"] = first_image + row
+            recipe["num_images"] = len(paths)
+            digests = sample.get("image_sha256")
+            for j, image_path in enumerate(paths):
+                images[row]["sample"] = first_sample + i
+                images[row]["path"] = intern(str(image_path))
+                digest = bytes.fromhex(digests[j]) if digests else _digest(image_path)
+                images[row]["sha256"] = np.frombuffer(digest, dtype=np.uint8)
+                row += 1
+
+        # Data first, the recipe records last: they are what make the samples visible
+        self._append(STRINGS_FILE, bytes(pool), expected_size=strings_offset)
+        if self.embedding_dim:
+            if image_embeddings is None:
+                image_embeddings = np.full((num_images, self.embedding_dim), np.nan, dtype=np.float32)
+            self._append(EMBEDDINGS_FILE, image_embeddings.tobytes(),
+                         expected_size=first_image * self.embedding_dim * 4)
+        self._append(IMAGES_FILE, images.tobytes(), expected_size=first_image * IMAGE_DTYPE.itemsize)
+        self._append(RECIPES_FILE, recipes.tobytes(), expected_size=first_sample * RECIPE_DTYPE.itemsize)
+        return list(range(first_sample, first_sample + len(samples)))
+
+    def truncate(self, num_recipes, strings_size=None):
+        """Drop every sample after the first num_recipes, e.g. to roll back an interrupted bulk import.
+
+        Every file is cut back to the kept samples. `strings_size` is the
+        string pool size to return to (noted before the rolled-back append);
+        by default it is the end of the last string the kept samples use.
+        """
+        recipes = self._load_maps()["recipes"][:num_recipes]
+        num_images = int(recipes[-1]["first_image"] + recipes[-1]["num_images"]) if num_recipes else 0
+        if strings_size is None:
+            spans = [recipes[field].reshape(-1, 2) for field in ("actual_name", "vague_title", "full_instructions",
+                                                                 "concise_steps")]
+            spans.append(self._load_maps()["images"][:num_images]["path"].reshape(-1, 2))
+            spans = np.concatenate(spans)
+            strings_size = int((spans[:, 0] + spans[:, 1]).max()) if len(spans) else 0
+        self._invalidate()
+        sizes = {RECIPES_FILE: num_recipes * RECIPE_DTYPE.itemsize, IMAGES_FILE: num_images * IMAGE_DTYPE.itemsize,
+                 STRINGS_FILE: strings_size}
+        if self.embedding_dim:
+            sizes[EMBEDDINGS_FILE] = num_images * self.embedding_dim * 4
+        for name, size in sizes.items():
+            with open(self.path / name, 'r+b') as f:
+                f.truncate(size)
+
+    def _append(self, name, data, expected_size):
+        # Drop anything an interrupted append left past the committed end
+        with open(self.path / name, 'r+b') as f:
+            f.truncate(expected_size)
+            f.seek(expected_size)
+            f.write(data)
+
+    def set_embeddings(self, rows, embeddings):
+        """Overwrite the embedding rows of already stored images in place"""
+        if not self.embedding_dim:
+            raise ValueError("This dataset store was created without an embedding matrix")
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(rows), self.embedding_dim)
+        matrix = np.memmap(self.path / EMBEDDINGS_FILE, dtype=np.float32, mode='r+',
+                           shape=(self.num_images, self.embedding_dim))
+        matrix[np.asarray(rows)] = embeddings
+        matrix.flush()
+        del matrix
+
+
+def import_json(json_path, store_path, embedding_dim=None):
+    """Convert a food_samples.json style file into a new dataset store"""
+    with open(json_path, 'r') as f:
+        samples = json.load(f)
+    store = DatasetStore.create(store_path, embedding_dim=embedding_dim)
+    for sample in samples:
+        store.add_sample(sample["actual_name"], sample["image_paths"], sample["vague_title"],
+                         sample["full_instructions"], sample["concise_steps"])
+    return store
+
+
+def export_json(store_path, json_path):
+    """Write a dataset store back out as food_samples.json style JSON"""
+    store = DatasetStore(store_path)
+    with open(json_path, 'w') as f:
+        json.dump(list(store.samples), f, indent=4)
+    store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert between food_samples.json and the columnar dataset store")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="JSON -> store")
+    import_parser.add_argument("json_path")
+    import_parser.add_argument("store_path")
+    import_parser.add_argument("--embedding-dim", type=int, help="Reserve an embedding matrix of this width")
+    export_parser = subparsers.add_parser("export", help="store -> JSON")
+    export_parser.add_argument("store_path")
+    export_parser.add_argument("json_path")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        store = import_json(args.json_path, args.store_path, args.embedding_dim)
+        print(f"Imported {store.num_recipes} recipes and {store.num_images} images into {args.store_path}")
+        store.close()
+    else:
+        export_json(args.store_path, args.json_path)
+        print(f"Exported {args.store_path} to {args.json_path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+import hashlib
+import json
+import os
+from collections import Counter, defaultdict
+from pathlib import Path
+
+import numpy as np
+
+INDEX_FILE = "index.json"
+EMBEDDINGS_FILE = "embeddings.f32"
+TITLES_FILE = "titles.f32"
+
+
+def file_hash(path):
+    """Return the SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_stat(path):
+    """(mtime_ns, size) of a file, a cheap check for whether it may have changed"""
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _replace_file(path, data):
+    """Write bytes to path atomically, so readers never see a half-written file"""
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def index_row(sample_idx, image_path):
+    mtime_ns, size = file_stat(image_path)
+    return {"sample": sample_idx, "image_path": image_path, "sha256": file_hash(image_path),
+            "mtime_ns": mtime_ns, "size": size}
+
+
+class EmbeddingIndex:
+    """Precomputed image features for every gallery image in the dataset.
+
+    The features are kept as one contiguous float32 matrix with one row per
+    image. `rows[i]` records which dataset sample row i belongs to, the image
+    path it was computed from and that file's content hash, size and mtime.
+
+    Dataset edits are applied incrementally with `update`: new images are
+    appended, and rows of removed or changed images are tombstoned rather than
+    deleted. `compacted` drops the tombstoned rows once enough pile up.
+
+    Optionally the index also stores text embeddings of every sample's
+    [vague_title, actual_name] pair as a (num_samples, 2, dim) matrix.
+
+    `model_name` and `vision_config` (a hash of the vision tower config, see
+    main.FoodInstructionGenerator.vision_config_hash) identify the model the
+    features came from; an index from another model, or a same-named model
+    with another architecture, fails check_dataset.
+
+    An index made with `from_store` is a view of a DatasetStore's embedding
+    matrix instead (`store` is then set): it is never updated or saved, the
+    store's image rows are its rows.
+    """
+
+    def __init__(self, embeddings, rows, model_name=None, titles=None, title_embeddings=None, tombstones=None,
+                 vision_config=None, row_samples=None, store=None):
+        self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        self.rows = rows
+        self.model_name = model_name
+        self.vision_config = vision_config
+        self.store = store
+        if row_samples is None:
+            row_samples = [row["sample"] for row in rows]
+        self.row_samples = np.asarray(row_samples, dtype=np.int64)
+        self.titles = titles
+        self.title_embeddings = title_embeddings
+        self.deleted = np.zeros(len(rows), dtype=bool)
+        if tombstones:
+            self.deleted[np.asarray(tombstones, dtype=np.int64)] = True
+
+    def __len__(self):
+        """Number of live (not tombstoned) rows"""
+        return len(self.rows) - int(self.deleted.sum())
+
+    @property
+    def live(self):
+        return np.flatnonzero(~self.deleted)
+
+    @property
+    def tombstone_ratio(self):
+        return float(self.deleted.mean()) if len(self.rows) else 0.0
+
+    def live_embeddings(self):
+        return self.embeddings[self.live] if self.deleted.any() else self.embeddings
+
+    def live_row_samples(self):
+        return self.row_samples[self.live] if self.deleted.any() else self.row_samples
+
+    @property
+    def dim(self):
+        return self.embeddings.shape[1]
+
+    @classmethod
+    def build(cls, dataset, encode_images, model_name=None, encode_titles=None, vision_config=None):
+        """Encode every image path of every sample once.
+
+        `encode_images` takes a list of image paths and returns a
+        (len(paths), dim) array of features. If `encode_titles` (a list of
+        strings -> (len(texts), dim) array) is given, sample titles are
+        encoded too.
+        """
+        rows = [index_row(sample_idx, image_path)
+                for sample_idx, sample in enumerate(dataset.samples)
+                for image_path in sample["image_paths"]]
+        if rows:
+            embeddings = encode_images([row["image_path"] for row in rows])
+        else:
+            embeddings = np.zeros((0, 0), dtype=np.float32)
+        index = cls(embeddings, rows, model_name=model_name, vision_config=vision_config)
+        if encode_titles is not None:
+            index.add_title_embeddings(dataset, encode_titles)
+        return index
+
+    @classmethod
+    def from_store(cls, store, model_name=None, vision_config=None):
+        """Index over a DatasetStore's embedding matrix, one row per store image row.
+
+        Nothing is decoded, stat'ed or hashed, so this costs the same for any
+        catalogue size; every row must already have its features.
+        """
+        return cls(store.embeddings, store.images, model_name=model_name, vision_config=vision_config,
+                   row_samples=store.image_samples, store=store)
+
+    @staticmethod
+    def dataset_titles(dataset):
+        return [[sample["vague_title"], sample["actual_name"]] for sample in dataset.samples]
+
+    def add_title_embeddings(self, dataset, encode_titles):
+        """Encode every sample's vague title and actual name.
+
+        Texts that already have an embedding in the index are not re-encoded.
+        Returns the number of texts encoded.
+        """
+        known = {}
+        if self.titles is not None and self.title_embeddings is not None:
+            for pair, embeddings in zip(self.titles, self.title_embeddings):
+                known.update(zip(pair, embeddings))
+        self.titles = self.dataset_titles(dataset)
+        missing = sorted({text for pair in self.titles for text in pair} - known.keys())
+        if missing:
+            known.update(zip(missing, np.asarray(encode_titles(missing), dtype=np.float32)))
+        if not self.titles:
+            self.title_embeddings = np.zeros((0, 2, 0), dtype=np.float32)
+        else:
+            self.title_embeddings = np.array([[known[text] for text in pair] for pair in self.titles],
+                                             dtype=np.float32)
+        return len(missing)
+
+    def is_current(self, row):
+        """Whether the row's image file still has the content its features were computed from.
+
+        Files with unchanged size and mtime are trusted; others are re-hashed.
+        """
+        try:
+            mtime_ns, size = file_stat(row["image_path"])
+        except OSError:
+            return False
+        if (row.get("mtime_ns"), row.get("size")) == (mtime_ns, size):
+            return True
+        if file_hash(row["image_path"]) != row["sha256"]:
+            return False
+        # Touched but not modified: remember the new stat so it is not hashed again
+        row["mtime_ns"], row["size"] = mtime_ns, size
+        return True
+
+    def update(self, dataset, encode_images, encode_titles=None):
+        """Bring the index in line with `dataset`, encoding only new or changed images.
+
+        Live rows whose image is unchanged are kept (and re-pointed at their
+        sample if samples moved), rows of removed or changed images are
+        tombstoned and new rows are appended. Returns counts of what changed.
+        """
+        # Image path -> live rows whose features are still valid
+        available = defaultdict(list)
+        stale = set()
+        for row_id in self.live:
+            row = self.rows[row_id]
+            if self.is_current(row):
+                available[row["image_path"]].append(row_id)
+            else:
+                stale.add(row_id)
+        sources = {image_path: row_ids[0] for image_path, row_ids in available.items()}
+
+        kept, to_encode, to_copy = set(), [], []
+        for sample_idx, sample in enumerate(dataset.samples):
+            for image_path in sample["image_paths"]:
+                if available.get(image_path):
+                    row_id = available[image_path].pop(0)
+                    self.rows[row_id]["sample"] = sample_idx
+                    kept.add(row_id)
+                elif image_path in sources:
+                    # The same image listed twice: reuse its features
+                    to_copy.append((sample_idx, sources[image_path]))
+                else:
+                    to_encode.append((sample_idx, image_path))
+
+        removed = [row_id for row_id in self.live if row_id not in kept]
+        # A changed image is one whose stale row is replaced by a re-encoded row for the same path
+        changed = {self.rows[row_id]["image_path"] for row_id in stale} & \
+            {image_path for _, image_path in to_encode}
+        summary = {
+            "unchanged": len(kept),
+            "added": len(to_encode) + len(to_copy) - len(changed),
+            "changed": len(changed),
+            "removed": len(removed) - len(changed),
+            "encoded": len(to_encode)
+        }
+        self.deleted[removed] = True
+
+        new_rows = [index_row(sample_idx, image_path) for sample_idx, image_path in to_encode]
+        new_rows += [dict(self.rows[row_id], sample=sample_idx) for sample_idx, row_id in to_copy]
+        if new_rows:
+            parts = [np.asarray(self.embeddings[[row_id for _, row_id in to_copy]])] if to_copy else []
+            if to_encode:
+                parts.insert(0, np.asarray(encode_images([image_path for _, image_path in to_encode]),
+                                           dtype=np.float32))
+            new_embeddings = np.concatenate(parts)
+            self.embeddings = new_embeddings if len(self.rows) == 0 else \
+                np.concatenate([self.embeddings, new_embeddings])
+            self.rows = self.rows + new_rows
+            self.deleted = np.concatenate([self.deleted, np.zeros(len(new_rows), dtype=bool)])
+        self.row_samples = np.array([row["sample"] for row in self.rows], dtype=np.int64)
+
+        if encode_titles is not None and (self.titles != self.dataset_titles(dataset) or
+                                          self.title_embeddings is None):
+            summary["titles_encoded"] = self.add_title_embeddings(dataset, encode_titles)
+        return summary
+
+    def compacted(self):
+        """Copy of the index without its tombstoned rows"""
+        live = self.live
+        return EmbeddingIndex(self.embeddings[live], [self.rows[row_id] for row_id in live],
+                              model_name=self.model_name, titles=self.titles,
+                              title_embeddings=self.title_embeddings, vision_config=self.vision_config)
+
+    def save(self, index_dir, append_from=None):
+        """Write the index to index_dir.
+
+        With `append_from` (the row count when the index was loaded) only the
+        rows added since then are appended to the embeddings file, provided it
+        still holds exactly that many rows; otherwise it is rewritten.
+        """
+        index_dir = Path(index_dir)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        dim = int(self.embeddings.shape[1]) if len(self.rows) else 0
+        path = index_dir / EMBEDDINGS_FILE
+        if append_from is not None and path.exists() and path.stat().st_size == append_from * dim * 4:
+            with open(path, 'ab') as f:
+                f.write(np.ascontiguousarray(self.embeddings[append_from:]).tobytes())
+        else:
+            _replace_file(path, np.ascontiguousarray(self.embeddings).tobytes())
+        meta = {
+            "model_name": self.model_name,
+            "vision_config": self.vision_config,
+            "num_rows": len(self.rows),
+            "dim": dim,
+            "rows": self.rows,
+            "tombstones": self.deleted.nonzero()[0].tolist()
+        }
+        if self.title_embeddings is not None:
+            _replace_file(index_dir / TITLES_FILE, np.ascontiguousarray(self.title_embeddings,
+                                                                        dtype=np.float32).tobytes())
+            meta["titles"] = self.titles
+            meta["title_dim"] = int(self.title_embeddings.shape[2])
+        # index.json goes last: readers only see the new rows once their embeddings are on disk
+        _replace_file(index_dir / INDEX_FILE, json.dumps(meta, indent=4).encode())
+
+    @classmethod
+    def load(cls, index_dir):
+        index_dir = Path(index_dir)
+        with open(index_dir / INDEX_FILE, 'r') as f:
+            meta = json.load(f)
+        embeddings = np.memmap(index_dir / EMBEDDINGS_FILE, dtype=np.float32, mode='r',
+                               shape=(meta["num_rows"], meta["dim"]))
+        title_embeddings = None
+        if "titles" in meta and (index_dir / TITLES_FILE).exists():
+            title_embeddings = np.fromfile(index_dir / TITLES_FILE, dtype=np.float32).reshape(
+                len(meta["titles"]), 2, meta["title_dim"])
+        return cls(embeddings, meta["rows"], model_name=meta["model_name"],
+                   titles=meta.get("titles"), title_embeddings=title_embeddings,
+                   tombstones=meta.get("tombstones"), vision_config=meta.get("vision_config"))
+
+    @staticmethod
+    def exists(index_dir):
+        index_dir = Path(index_dir)
+        return (index_dir / INDEX_FILE).exists() and (index_dir / EMBEDDINGS_FILE).exists()
+
+    def model_problems(self, model_name=None, dim=None, vision_config=None):
+        """Reasons the index's features don't come from the given model (empty if they do)"""
+        problems = []
+        if model_name is not None and self.model_name != model_name:
+            problems.append(f"index was built with {self.model_name}, expected {model_name}")
+        if dim is not None and len(self.rows) and self.dim != dim:
+            problems.append(f"index has {self.dim}-dim features, expected {dim}")
+        if vision_config is not None and self.vision_config != vision_config:
+            problems.append("index was built with a different vision model config")
+        return problems
+
+    def check_dataset(self, dataset, model_name=None, verify_hashes=True, dim=None, vision_config=None):
+        """Return a list of reasons this index does not match the dataset or model (empty if it does)"""
+        problems = self.model_problems(model_name, dim, vision_config)
+        if problems:
+            return problems
+
+        expected = Counter((sample_idx, image_path)
+                           for sample_idx, sample in enumerate(dataset.samples)
+                           for image_path in sample["image_paths"])
+        live_rows = [self.rows[row_id] for row_id in self.live]
+        actual = Counter((row["sample"], row["image_path"]) for row in live_rows)
+        if expected != actual:
+            problems.append("image paths in the index do not match the dataset")
+            return problems
+        if self.titles is not None and self.titles != self.dataset_titles(dataset):
+            problems.append("sample titles in the index do not match the dataset")
+
+        if verify_hashes:
+            for row in live_rows:
+                if not Path(row["image_path"]).exists():
+                    problems.append(f"missing image: {row['image_path']}")
+                elif not self.is_current(row):
+                    problems.append(f"image changed since indexing: {row['image_path']}")
+        return problems
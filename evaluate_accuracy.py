@@ -1,101 +1,256 @@
-from food_dataset import FoodDataset
-from transformers import AutoProcessor, CLIPVisionModel
-from PIL import Image
-import torch
+from main import FoodInstructionGenerator, DEFAULT_BATCH_SIZE, batched
+from feature_cache import namespace_key
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter, defaultdict
+import argparse
 import glob
-from rouge_score import rouge_scorer
-from nltk.translate.bleu_score import sentence_bleu
-import nltk
-from main import FoodInstructionGenerator
+import json
+import multiprocessing
+import os
+import time
 
-def evaluate_all_test_images():
+TEST_PATTERN = "images/test/test_*[12].png"
+DEFAULT_CHECKPOINT = "eval_checkpoint.jsonl"
+DEFAULT_REPORT = "eval_report.json"
+
+# Query titles for the glob test set, written independently of the gallery's own vague titles.
+# Never fall back to the ground-truth sample's title: that hands the label to the matcher.
+TEST_TITLES = {
+    "burger": "stacked meaty sandwich thing",
+    "chole": "spicy chickpeas with fluffy balloons",
+    "curry": "spicy sauce with meat and veggies",
+    "omelette": "fluffy egg pancake with fillings",
+    "pasta": "cheesy pasta with sauce",
+    "pizza": "italian pizza",
+    "salad": "fresh crunchy vegetable mix",
+    "soup": "warm liquid comfort food",
+    "sushi": "rolled rice and fish",
+    "tacos": "mexican folded crunchy flavor holders"
+}
+
+# Per-process ROUGE scorer, created on first use in each worker
+_rouge = None
+
+def food_item_from_path(image_path):
+    """images/test/test_chole2.png -> chole"""
+    return Path(image_path).stem[len("test_"):].rstrip("0123456789")
+
+def find_ground_truth(dataset, food_item):
+    return next((sample for sample in dataset.samples
+                 if food_item in sample["actual_name"].lower()), None)
+
+def load_test_cases(dataset, pattern=TEST_PATTERN, manifest=None):
+    """Return (image_path, food_item, vague_title) for every test image with a matching sample.
+
+    Test images come from a glob pattern (food item taken from the file name,
+    vague title from TEST_TITLES) or from a JSONL manifest of
+    {"image": ..., "label": ..., "title": ...} lines. Images without a title
+    are queried with an empty one.
+    """
+    if manifest:
+        with open(manifest, 'r') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        candidates = [(record["image"], record["label"], record.get("title")) for record in records]
+    else:
+        candidates = []
+        for image_path in sorted(glob.glob(pattern)):
+            food_item = food_item_from_path(image_path)
+            candidates.append((image_path, food_item, TEST_TITLES.get(food_item, "")))
+
+    cases = []
+    for image_path, food_item, vague_title in candidates:
+        ground_truth = find_ground_truth(dataset, food_item)
+        if ground_truth:
+            cases.append((image_path, food_item, vague_title or ""))
+    return cases
+
+def score_texts(pair):
+    """ROUGE-L F1 and BLEU of predicted steps against reference steps (runs in worker processes)"""
+    global _rouge
+    from rouge_score import rouge_scorer
+    from nltk.translate.bleu_score import sentence_bleu
+
+    reference_steps, candidate_steps = pair
+    if _rouge is None:
+        _rouge = rouge_scorer.RougeScorer(['rouge1', 'rouge2', 'rougeL'], use_stemmer=True)
+    rouge_l = _rouge.score(" ".join(reference_steps), " ".join(candidate_steps))['rougeL'].fmeasure
+    reference = [[word for step in reference_steps for word in step.split()]]
+    candidate = [word for step in candidate_steps for word in step.split()]
+    return rouge_l, sentence_bleu(reference, candidate)
+
+def run_config(generator, cases, top_k, aggregation):
+    """Checkpoint key: every option that changes a case's record, so a resumed run never mixes in
+    records from a different model, execution mode, title similarity, dataset or test set"""
+    dataset = namespace_key(*((sample["actual_name"], sample["vague_title"], list(sample["image_paths"]),
+                               list(sample["concise_steps"])) for sample in generator.dataset.samples))
+    return (f"top_k={top_k};aggregation={aggregation};features={generator.cache_namespace};"
+            f"execution_mode={generator.execution_mode};title_similarity={generator.title_similarity};"
+            f"search={generator.search_backend}/{generator.nprobe};dataset={dataset};"
+            f"cases={namespace_key(*cases)}")
+
+def load_checkpoint(path, config):
+    """Per-image records from an earlier run with the same config"""
+    done = {}
+    if path and Path(path).exists():
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn last line from an interrupted run
+                    continue
+                if record.get("config") == config:
+                    done[record["image"]] = record
+    return done
+
+def build_report(records, stage_times, top_k):
+    """Aggregate per-image records into accuracy, confusion matrix and per-category metrics"""
+    total = len(records)
+    confusion = defaultdict(Counter)
+    categories = defaultdict(lambda: {"count": 0, "correct": 0, "top_k_correct": 0, "rouge_l": 0.0, "bleu": 0.0})
+    for record in records:
+        confusion[record["food_item"]][record["prediction"] or "none"] += 1
+        category = categories[record["food_item"]]
+        category["count"] += 1
+        category["correct"] += record["correct"]
+        category["top_k_correct"] += record["top_k_correct"]
+        category["rouge_l"] += record["rouge_l"]
+        category["bleu"] += record["bleu"]
+
+    per_category = {}
+    for food_item, category in sorted(categories.items()):
+        count = category["count"]
+        per_category[food_item] = {
+            "count": count,
+            "accuracy": category["correct"] / count,
+            "top_k_accuracy": category["top_k_correct"] / count,
+            "rouge_l": category["rouge_l"] / count,
+            "bleu": category["bleu"] / count
+        }
+
+    return {
+        "num_images": total,
+        "accuracy": sum(record["correct"] for record in records) / total if total else 0.0,
+        "top_k": top_k,
+        "top_k_accuracy": sum(record["top_k_correct"] for record in records) / total if total else 0.0,
+        "rouge_l": sum(record["rouge_l"] for record in records) / total if total else 0.0,
+        "bleu": sum(record["bleu"] for record in records) / total if total else 0.0,
+        "per_category": per_category,
+        "confusion_matrix": {food_item: dict(row) for food_item, row in sorted(confusion.items())},
+        "stage_times_s": stage_times
+    }
+
+def evaluate_all_test_images(pattern=TEST_PATTERN, manifest=None, checkpoint=DEFAULT_CHECKPOINT,
+                             report_path=DEFAULT_REPORT, batch_size=DEFAULT_BATCH_SIZE, top_k=3,
+                             aggregation="max", workers=None, resume=True):
     """Evaluate accuracy of instruction generation on all test images."""
     print("Starting accuracy evaluation...")
+    stage_times = defaultdict(float)
+    run_start = time.perf_counter()
+
+    # Gallery features come from the index / feature cache, so this encodes the gallery at most once
+    start = time.perf_counter()
     generator = FoodInstructionGenerator()
-    
-    # Initialize metrics
-    rouge = rouge_scorer.RougeScorer(['rouge1', 'rouge2', 'rougeL'], use_stemmer=True)
-    nltk.download('punkt', quiet=True)
-    
-    total_tests = 0
-    correct_matches = 0
-    rouge_scores = []
-    bleu_scores = []
-    
-    # Get all test images
-    test_images = glob.glob("images/test/test_*[12].png")
-
-    # Dictionary mapping food items to their vague titles
-    vague_titles = {
-        "burger": "stacked meaty sandwich thing",
-        "chole_bature": "spicy chickpeas with fluffy balloons",
-        "curry": "spicy sauce with meat and veggies",
-        "omelette": "fluffy egg pancake with fillings",
-        "pasta": "cheesy pasta with sauce",
-        "pizza": "italian pizza",
-        "salad": "fresh crunchy vegetable mix",
-        "soup": "warm liquid comfort food",
-        "sushi": "rolled rice and fish",
-        "tacos": "mexican folded crunchy flavor holders"
-    }
+    stage_times["setup"] = time.perf_counter() - start
+
+    cases = load_test_cases(generator.dataset, pattern, manifest)
+    config = run_config(generator, cases, top_k, aggregation)
+    done = load_checkpoint(checkpoint, config) if resume else {}
+    if checkpoint and not resume and Path(checkpoint).exists():
+        os.remove(checkpoint)
+    pending = [case for case in cases if case[0] not in done]
+    print(f"{len(cases)} test images, {len(cases) - len(pending)} already scored, {len(pending)} to go")
+
+    out = open(checkpoint, 'a') if checkpoint else None
+    try:
+        # Spawned, not forked: torch's thread pools in this process are already running
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            for chunk in batched(pending, batch_size):
+                start = time.perf_counter()
+                features = generator.encode_images([image_path for image_path, _, _ in chunk], batch_size)
+                stage_times["encode_queries"] += time.perf_counter() - start
+
+                start = time.perf_counter()
+                results = generator.match(features, [vague_title for _, _, vague_title in chunk],
+                                          top_k=top_k, aggregation=aggregation)
+                stage_times["match"] += time.perf_counter() - start
+
+                start = time.perf_counter()
+                ground_truths = [find_ground_truth(generator.dataset, food_item) for _, food_item, _ in chunk]
+                pairs = [(ground_truth["concise_steps"], result["steps"] if result else [])
+                         for ground_truth, result in zip(ground_truths, results)]
+                text_scores = list(pool.map(score_texts, pairs))
+                stage_times["score_text"] += time.perf_counter() - start
+
+                for (image_path, food_item, vague_title), result, (rouge_l, bleu) in zip(chunk, results, text_scores):
+                    matches = result["matches"] if result else []
+                    record = {
+                        "image": image_path,
+                        "food_item": food_item,
+                        "vague_title": vague_title,
+                        "prediction": result["title"] if result else None,
+                        "top_k_predictions": [match["title"] for match in matches],
+                        "similarity": result["similarity"] if result else None,
+                        "correct": bool(result) and food_item in result["title"].lower(),
+                        "top_k_correct": any(food_item in match["title"].lower() for match in matches),
+                        "rouge_l": rouge_l,
+                        "bleu": bleu,
+                        "config": config
+                    }
+                    done[image_path] = record
+
+                    # Print results for this image
+                    print(f"\nTest image: {Path(image_path).name}")
+                    print(f"Matched recipe: {record['prediction']}")
+                    print(f"Correct match: {'Correct' if record['correct'] else 'Wrong'}")
+                    print(f"ROUGE-L score: {rouge_l:.3f}")
+                    print(f"BLEU score: {bleu:.3f}")
+                    if out:
+                        out.write(json.dumps(record) + "\n")
+                if out:
+                    out.flush()
+    finally:
+        if out:
+            out.close()
+
+    stage_times["total"] = time.perf_counter() - run_start
+    records = [done[image_path] for image_path, _, _ in cases if image_path in done]
+    report = build_report(records, dict(stage_times), top_k)
+    if generator.feature_cache is not None:
+        report["feature_cache"] = generator.feature_cache.stats()
+    report["models"] = generator.registry.stats()
+    if report_path:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=4)
 
-    for test_image in sorted(test_images):
-        # Extract food item name from filename
-        food_item = test_image.split('test_')[1].split('1.png')[0].split('2.png')[0]
-        
-        # Get corresponding vague title
-        vague_title = vague_titles.get(food_item, "")
-
-        # Generate instructions
-        result = generator.generate_instructions(test_image, vague_title)
-        
-        if result:
-            # Find ground truth from dataset
-            ground_truth = next((sample for sample in generator.dataset.samples 
-                               if food_item in sample["actual_name"].lower()), None)
-            
-            if ground_truth:
-                total_tests += 1
-                
-                # Check if correct dish was matched
-                is_correct = food_item in result["title"].lower()
-                if is_correct:
-                    correct_matches += 1
-                
-                # Calculate ROUGE score
-                rouge_score = rouge.score(
-                    " ".join(ground_truth["concise_steps"]),
-                    " ".join(result["steps"])
-                )
-                rouge_l = rouge_score['rougeL'].fmeasure
-                rouge_scores.append(rouge_l)
-                
-                # Calculate BLEU score - Fixed
-                reference = [[word for step in ground_truth["concise_steps"] 
-                            for word in step.split()]]
-                candidate = [word for step in result["steps"] 
-                           for word in step.split()]
-                bleu = sentence_bleu(reference, candidate)
-                bleu_scores.append(bleu)
-                
-                # Print results for this image
-                print(f"\nTest image: {Path(test_image).name}")
-                print(f"Matched recipe: {result['title']}")
-                print(f"Correct match: {'Correct' if is_correct else 'Wrong'}")
-                print(f"ROUGE-L score: {rouge_l:.3f}")
-                print(f"BLEU score: {bleu:.3f}")
-    
     # Print final accuracy metrics
-    if total_tests > 0:
-        accuracy = correct_matches / total_tests * 100
-        avg_rouge = sum(rouge_scores) / len(rouge_scores)
-        avg_bleu = sum(bleu_scores) / len(bleu_scores)
-        
+    if records:
+        correct_matches = sum(record["correct"] for record in records)
         print("\nFinal Metrics:")
-        print(f"Accuracy: {accuracy:.1f}% ({correct_matches}/{total_tests} correct matches)")
-        print(f"Average ROUGE-L score: {avg_rouge:.3f}")
-        print(f"Average BLEU score: {avg_bleu:.3f}")
+        print(f"Accuracy: {report['accuracy'] * 100:.1f}% ({correct_matches}/{len(records)} correct matches)")
+        print(f"Top-{top_k} accuracy: {report['top_k_accuracy'] * 100:.1f}%")
+        print(f"Average ROUGE-L score: {report['rouge_l']:.3f}")
+        print(f"Average BLEU score: {report['bleu']:.3f}")
+        print(f"Wall time: {stage_times['total']:.2f}s")
+        if report_path:
+            print(f"Report written to {report_path}")
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate matching accuracy and instruction quality on test images")
+    parser.add_argument("--pattern", default=TEST_PATTERN, help="Glob of test images named test_<dish><n>.png")
+    parser.add_argument("--manifest", help='JSONL of {"image", "label", "title"} test cases (overrides --pattern)')
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT, help="Per-image results, used to resume")
+    parser.add_argument("--no-resume", action="store_true", help="Ignore and overwrite the checkpoint")
+    parser.add_argument("--report", default=DEFAULT_REPORT, help="Machine-readable JSON report")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--aggregation", choices=["max", "mean", "vote"], default="max")
+    parser.add_argument("--workers", type=int, help="Text-scoring worker processes (default: CPU count)")
+    args = parser.parse_args()
+    evaluate_all_test_images(args.pattern, args.manifest, args.checkpoint, args.report, args.batch_size,
+                             args.top_k, args.aggregation, args.workers, resume=not args.no_resume)
 
 if __name__ == "__main__":
-    evaluate_all_test_images()
\ No newline at end of file
+    main()
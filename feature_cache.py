@@ -0,0 +1,161 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from embedding_index import file_hash
+
+DEFAULT_FEATURE_CACHE = "feature_cache.sqlite"
+DEFAULT_MAX_ENTRIES = 100_000
+DEFAULT_MAX_BYTES = 1 << 30
+
+
+def content_hash(source):
+    """SHA-256 of an image source: a file path, raw bytes or a PIL image"""
+    if isinstance(source, (bytes, bytearray)):
+        return hashlib.sha256(source).hexdigest()
+    if isinstance(source, (str, os.PathLike)):
+        return file_hash(source)
+    # A PIL image (PIL is only imported by whoever made it)
+    digest = hashlib.sha256(f"{source.mode}:{source.size}".encode())
+    digest.update(source.tobytes())
+    return digest.hexdigest()
+
+
+def namespace_key(*parts):
+    """Short stable hash of everything besides the image that affects its features"""
+    return hashlib.sha256("|".join(str(part) for part in parts).encode()).hexdigest()[:16]
+
+
+class FeatureCache:
+    """Content-addressed sqlite store of image feature vectors.
+
+    Entries are keyed by image content hash plus a namespace (model name,
+    revision, preprocessing config) and stored as raw float32 blobs. The
+    least recently used entries are evicted once the cache grows past
+    max_entries or max_bytes.
+    """
+
+    def __init__(self, path=DEFAULT_FEATURE_CACHE, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._connect()
+
+    def _connect(self):
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS features ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS features_last_used ON features(last_used)")
+        self._conn.commit()
+        self._entries, self._bytes = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM features").fetchone()
+
+    def reopen(self):
+        """Open a fresh connection in a forked child; sqlite connections must not be shared across fork"""
+        self._lock = threading.Lock()
+        self._connect()
+
+    @staticmethod
+    def make_key(image_hash, namespace):
+        return f"{image_hash}:{namespace}"
+
+    def get_many(self, keys):
+        """Return a list with a float32 vector for each cached key and None for misses"""
+        if not keys:
+            return []
+        found = {}
+        with self._lock:
+            # Stay well under sqlite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                for key, value in self._conn.execute(
+                        f"SELECT key, value FROM features WHERE key IN ({placeholders})", chunk):
+                    found[key] = np.frombuffer(value, dtype=np.float32)
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE features SET last_used = ? WHERE key = ?",
+                                       [(now, key) for key in found])
+                self._conn.commit()
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return [found.get(key) for key in keys]
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def put_many(self, items):
+        """Store (key, vector) pairs, then evict down to the size limits"""
+        now = time.time()
+        rows = {key: (key, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in items}
+        rows = list(rows.values())
+        if not rows:
+            return
+        with self._lock:
+            for start in range(0, len(rows), 500):
+                chunk = rows[start:start + 500]
+                keys = [row[0] for row in chunk]
+                placeholders = ",".join("?" * len(keys))
+                replaced, replaced_bytes = self._conn.execute(
+                    f"SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM features WHERE key IN ({placeholders})",
+                    keys).fetchone()
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO features (key, value, last_used) VALUES (?, ?, ?)", chunk)
+                self._entries += len(chunk) - replaced
+                self._bytes += sum(len(row[1]) for row in chunk) - replaced_bytes
+            self._evict()
+            self._conn.commit()
+
+    def put(self, key, vector):
+        self.put_many([(key, vector)])
+
+    def _evict(self):
+        while self._entries > self.max_entries or self._bytes > self.max_bytes:
+            excess = max(self._entries - self.max_entries, 1)
+            victims = self._conn.execute(
+                "SELECT key, LENGTH(value) FROM features ORDER BY last_used LIMIT ?", (excess,)).fetchall()
+            if not victims:
+                break
+            self._conn.executemany("DELETE FROM features WHERE key = ?", [(key,) for key, _ in victims])
+            self._entries -= len(victims)
+            self._bytes -= sum(size for _, size in victims)
+            self.evictions += len(victims)
+
+    def __len__(self):
+        return self._entries
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": self._entries,
+            "bytes": self._bytes
+        }
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM features")
+            self._conn.commit()
+            self._entries = self._bytes = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,13 +1,20 @@
 import json
 from pathlib import Path
+from dataset_store import DatasetStore
 
 class FoodDataset:
-    def __init__(self):
+    def __init__(self, dataset_file="food_samples.json"):
         self.samples = []
-        self.dataset_file = "food_samples.json"
+        self.dataset_file = dataset_file
+        # Set when dataset_file is a columnar store directory (see dataset_store.py)
+        self.store = None
 
     def add_sample(self, actual_name, image_paths, vague_title, full_instructions, concise_steps):
         """Add a sample to the dataset with single or multiple image paths"""
+        if self.store is not None:
+            # Appended to the store on disk straight away; self.samples is a live view
+            self.store.add_sample(actual_name, image_paths, vague_title, full_instructions, concise_steps)
+            return
         sample = {
             "actual_name": actual_name,
             "image_paths": image_paths if isinstance(image_paths, list) else [image_paths],
@@ -18,10 +25,15 @@ class FoodDataset:
         self.samples.append(sample)
 
     def save_dataset(self):
+        if self.store is not None:
+            return
         with open(self.dataset_file, 'w') as f:
             json.dump(self.samples, f, indent=4)
 
     def load_dataset(self):
-        if Path(self.dataset_file).exists():
+        if DatasetStore.is_store(self.dataset_file):
+            self.store = DatasetStore(self.dataset_file)
+            self.samples = self.store.samples
+        elif Path(self.dataset_file).exists():
             with open(self.dataset_file, 'r') as f:
-                self.samples = json.load(f)
\ No newline at end of file
+                self.samples = json.load(f)
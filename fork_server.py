@@ -0,0 +1,177 @@
+import argparse
+import json
+import os
+import signal
+import socket
+import sys
+import traceback
+
+DEFAULT_SOCKET = "fork_server.sock"
+# Options the server's generator was built with; a request must use the same ones
+SERVER_OPTIONS = ("index_dir", "dataset", "execution_mode", "title_similarity", "search_backend", "nprobe")
+PATH_OPTIONS = ("index_dir", "dataset")
+
+# Keeps one generator with its models, processor and index loaded and forks a
+# copy-on-write child per `main.py --input ...` request, so each run starts in
+# milliseconds instead of re-importing torch and re-reading the weights. The
+# client passes its stdin/stdout/stderr over the socket and the child writes to
+# them directly. The parent never runs a forward pass: intra-op thread pools
+# started before fork() do not survive into the child. So the server refuses to
+# start on a missing or stale index (run build_index.py first), leaves the
+# trace-mode encoder to be traced in each child, and makes any other forward
+# pass in the parent raise.
+
+def refuse_forward(module, inputs):
+    raise RuntimeError("The fork server ran a forward pass before fork(); its children could hang")
+
+def forbid_forward(generator):
+    """Make a forward pass through the generator's models and its encoder raise; returns the hook handles"""
+    models = [generator.vision_model, generator.text_model]
+    if generator.execution_mode != "trace":
+        # The encoder encode_pixels calls: in int8 or compile mode a different module from vision_model
+        models.append(generator.encoder)
+    return [model.register_forward_pre_hook(refuse_forward) for model in models if model is not None]
+
+def load_index(generator, index_dir):
+    """The dataset store's or index_dir's gallery index if it can be used as is, else None (after printing why)"""
+    from embedding_index import EmbeddingIndex
+
+    index = generator.load_store_index(encode_missing=False)
+    if index is not None:
+        return index
+
+    if not EmbeddingIndex.exists(index_dir):
+        print(f"No gallery index found at {index_dir}. Run build_index.py to create one.", file=sys.stderr)
+        return None
+    index = EmbeddingIndex.load(index_dir)
+    problems = index.check_dataset(generator.dataset, **generator.index_identity())
+    if generator.title_similarity == "clip" and index.title_embeddings is None:
+        problems.append("it has no title embeddings")
+    if problems:
+        print(f"Gallery index at {index_dir} is stale: {problems[0]}. Run build_index.py to update it.",
+              file=sys.stderr)
+        return None
+    return index
+
+def server_options(args, cwd):
+    """The generator-defining options of args, with paths made absolute against cwd"""
+    options = {name: getattr(args, name) for name in SERVER_OPTIONS}
+    for name in PATH_OPTIONS:
+        options[name] = os.path.normpath(os.path.join(cwd, options[name]))
+    return options
+
+def handle(conn, generator, options, hooks):
+    """Run one request in the forked child; returns the exit status for the client"""
+    from main import parse_args, run_batch
+
+    message, fds, _, _ = socket.recv_fds(conn, 1 << 20, 3)
+    request = json.loads(message)
+    # sys.stdin/stdout/stderr wrap fds 0-2, so after this they reach the client's terminal
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    os.chdir(request["cwd"])
+    for hook in hooks:
+        hook.remove()
+    generator.after_fork()
+
+    try:
+        args = parse_args(request["argv"])
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else 2
+    if not args.input:
+        print("The fork server only runs batch mode (--input); use main.py for interactive mode", file=sys.stderr)
+        return 2
+    requested = server_options(args, request["cwd"])
+    mismatched = [name for name in SERVER_OPTIONS if requested[name] != options[name]]
+    if mismatched:
+        print(f"The server was started with a different {', '.join(mismatched)}; "
+              f"restart it with these options or run main.py directly", file=sys.stderr)
+        return 2
+    run_batch(args, generator)
+    return 0
+
+def serve(socket_path, argv):
+    from main import FoodInstructionGenerator, parse_args
+
+    args = parse_args(argv)
+    # The index is loaded below, without updating or rebuilding it here
+    generator = FoodInstructionGenerator(index_dir=None, num_workers=args.num_workers,
+                                         execution_mode=args.execution_mode,
+                                         title_similarity=args.title_similarity,
+                                         dataset_file=args.dataset,
+                                         search_backend=args.search_backend, nprobe=args.nprobe)
+    # Tracing runs the encoder, so in trace mode each child traces its own
+    parts = ["processor", "vision_config", "tokenizer", "text_model", "vision_model"]
+    if args.execution_mode != "trace":
+        parts.append("encoder")
+    for name in parts:
+        getattr(generator, name)
+    hooks = forbid_forward(generator)
+    index = load_index(generator, args.index_dir)
+    if index is None:
+        sys.exit(1)
+    generator.index_dir = args.index_dir
+    generator.set_index(index)
+    options = server_options(args, os.getcwd())
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    # Children are reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(socket_path)
+        server.listen(64)
+        print(f"Fork server ready on {socket_path}")
+        try:
+            while True:
+                conn, _ = server.accept()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                if os.fork() == 0:
+                    server.close()
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    status = 1
+                    try:
+                        status = handle(conn, generator, options, hooks)
+                    except BaseException:
+                        traceback.print_exc()
+                    finally:
+                        try:
+                            sys.stdout.flush()
+                            sys.stderr.flush()
+                            conn.sendall(f"{status}\n".encode())
+                        finally:
+                            os._exit(0)
+                conn.close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(socket_path)
+
+def run(socket_path, argv):
+    """Send one main.py invocation to the server; returns its exit status"""
+    request = json.dumps({"argv": argv, "cwd": os.getcwd()}).encode()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(socket_path)
+        socket.send_fds(conn, [request], [0, 1, 2])
+        reply = b""
+        while chunk := conn.recv(64):
+            reply += chunk
+    return int(reply) if reply.strip() else 1
+
+def main():
+    parser = argparse.ArgumentParser(description="Preloaded fork server for fast main.py batch runs",
+                                     allow_abbrev=False)
+    parser.add_argument("command", choices=["serve", "run"],
+                        help="serve: load the models and wait; run: match images with a forked copy")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET)
+    args, argv = parser.parse_known_args()
+    # Everything else is passed through as main.py options
+    if args.command == "serve":
+        serve(args.socket, argv)
+    else:
+        sys.exit(run(args.socket, argv))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import numpy as np
+
+from image_loader import load_image
+
+# 8x8 comparisons -> 64-bit hashes
+DHASH_SIZE = 8
+
+
+def dhash(source, hash_size=DHASH_SIZE):
+    """Difference hash of an image path, bytes or PIL image as an int of hash_size**2 bits.
+
+    The image is shrunk to a (hash_size + 1) x hash_size grayscale thumbnail
+    and each bit says whether a pixel is brighter than its left neighbour.
+    Re-encoded, resized or lightly edited copies differ in only a few bits
+    (see `hamming`).
+    """
+    from PIL import Image
+
+    image = load_image(source)
+    # JPEGs can be decoded straight at a reduced size
+    image.draft("L", (hash_size * 8, hash_size * 8))
+    thumbnail = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = np.asarray(thumbnail, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming(a, b):
+    """Number of differing bits between two hashes"""
+    return (a ^ b).bit_count()
+
+
+class HashIndex:
+    """Find stored perceptual hashes within `max_distance` bits of a query.
+
+    Multi-index hashing: every hash is split into max_distance + 1 bands and
+    filed under each band's value. Two hashes at most max_distance bits apart
+    agree exactly on at least one band, so a lookup only compares against
+    hashes sharing a band instead of scanning all of them.
+    """
+
+    def __init__(self, max_distance=4, bits=DHASH_SIZE * DHASH_SIZE):
+        self.max_distance = max_distance
+        edges = np.linspace(0, bits, max_distance + 2).astype(int)
+        self._bands = [(int(low), (1 << int(high - low)) - 1) for low, high in zip(edges[:-1], edges[1:])]
+        self._tables = [{} for _ in self._bands]
+        self.values = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, hash_value):
+        return hash_value in self.values
+
+    def add(self, hash_value, value=None):
+        """Store hash_value with an associated value (replacing the value of an identical hash)"""
+        if hash_value not in self.values:
+            for (shift, mask), table in zip(self._bands, self._tables):
+                table.setdefault((hash_value >> shift) & mask, set()).add(hash_value)
+        self.values[hash_value] = value
+
+    def remove(self, hash_value):
+        if hash_value not in self.values:
+            return
+        del self.values[hash_value]
+        for (shift, mask), table in zip(self._bands, self._tables):
+            key = (hash_value >> shift) & mask
+            bucket = table[key]
+            bucket.discard(hash_value)
+            if not bucket:
+                del table[key]
+
+    def find(self, hash_value):
+        """(stored hash, value, distance) of the nearest hash within max_distance bits, or None"""
+        if hash_value in self.values:
+            return hash_value, self.values[hash_value], 0
+        best = None
+        for (shift, mask), table in zip(self._bands, self._tables):
+            for candidate in table.get((hash_value >> shift) & mask, ()):
+                distance = (hash_value ^ candidate).bit_count()
+                if distance <= self.max_distance and (best is None or distance < best[2]):
+                    best = (candidate, self.values[candidate], distance)
+        return best
@@ -0,0 +1,165 @@
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+
+DEFAULT_NUM_WORKERS = min(4, os.cpu_count() or 1)
+
+# Processor and pixel cache used by process-pool workers, set once per worker by _init_worker
+_worker_processor = None
+_worker_pixel_cache = None
+
+
+def load_image(source):
+    """Open an image from a path, raw bytes or an existing PIL image"""
+    from PIL import Image
+
+    if isinstance(source, Image.Image):
+        return source
+    if isinstance(source, (bytes, bytearray)):
+        return Image.open(BytesIO(source))
+    return Image.open(Path(source))
+
+
+def preprocess_image(processor, source, pixel_cache=None):
+    """Decode one image and run the CLIP processor on it, returning a (3, H, W) float32 array.
+
+    Images in `pixel_cache` (see pixel_cache.py) skip the decode and resize.
+    """
+    if pixel_cache is not None:
+        pixels = pixel_cache.get(source)
+        if pixels is not None:
+            return pixels
+    image = load_image(source)
+    image.load()
+    inputs = processor(images=image, return_tensors="np")
+    return inputs["pixel_values"][0].astype(np.float32, copy=False)
+
+
+def _init_worker(processor, pixel_cache=None):
+    import torch
+
+    global _worker_processor, _worker_pixel_cache
+    _worker_processor = processor
+    _worker_pixel_cache = pixel_cache
+    # Workers only decode and resize; leave the cores for the model
+    torch.set_num_threads(1)
+
+
+def _preprocess_in_worker(source):
+    return preprocess_image(_worker_processor, source, _worker_pixel_cache)
+
+
+class PrefetchLoader:
+    """Decode and preprocess images in a worker pool ahead of the model.
+
+    Iterating yields (sources, pixel_values) pairs where pixel_values is a
+    (len(sources), 3, H, W) tensor ready for the vision model. A background
+    thread keeps up to `prefetch` batches in flight through a bounded queue,
+    so decoding the next batch overlaps with the forward pass on this one.
+    Set use_processes=True to decode in worker processes instead of threads.
+    Sources found in `pixel_cache` are read pre-resized instead of decoded.
+
+    With skip_errors=True, an image that can't be read or decoded is left
+    out of its batch's pixel_values instead of raising; its exception is
+    stored in `errors` under its position in `sources`.
+    """
+
+    def __init__(self, processor, sources, batch_size=16, num_workers=DEFAULT_NUM_WORKERS,
+                 prefetch=2, use_processes=False, pixel_cache=None, skip_errors=False):
+        self.processor = processor
+        self.pixel_cache = pixel_cache
+        self.sources = sources
+        self.batch_size = batch_size
+        self.num_workers = max(1, num_workers)
+        self.prefetch = max(1, prefetch)
+        self.use_processes = use_processes
+        self.skip_errors = skip_errors
+        self.errors = {}
+        self._queue = queue.Queue(maxsize=self.prefetch)
+        self._stop = threading.Event()
+        self._executor = None
+        self._producer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _start(self):
+        if self.use_processes:
+            self._executor = ProcessPoolExecutor(self.num_workers, initializer=_init_worker,
+                                                 initargs=(self.processor, self.pixel_cache))
+        else:
+            self._executor = ThreadPoolExecutor(self.num_workers, thread_name_prefix="image-loader")
+        self._producer = threading.Thread(target=self._produce, name="image-prefetch", daemon=True)
+        self._producer.start()
+
+    def _submit(self, source):
+        if self.use_processes:
+            return self._executor.submit(_preprocess_in_worker, source)
+        return self._executor.submit(preprocess_image, self.processor, source, self.pixel_cache)
+
+    def _put(self, item):
+        # Block while the queue is full, but give up if the consumer went away
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self):
+        try:
+            batch = []
+            for source in self.sources:
+                batch.append(source)
+                if len(batch) == self.batch_size:
+                    if not self._put((batch, [self._submit(s) for s in batch])):
+                        return
+                    batch = []
+            if batch:
+                self._put((batch, [self._submit(s) for s in batch]))
+        except Exception as e:
+            self._put(e)
+        finally:
+            self._put(None)
+
+    def __iter__(self):
+        import torch
+
+        self._start()
+        position = 0
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                batch, futures = item
+                rows = []
+                for future in futures:
+                    try:
+                        rows.append(future.result())
+                    except Exception as e:
+                        if not self.skip_errors:
+                            raise
+                        self.errors[position] = e
+                    position += 1
+                pixel_values = torch.from_numpy(np.stack(rows)) if rows else torch.zeros(0)
+                yield batch, pixel_values
+        finally:
+            self.close()
+
+    def close(self):
+        self._stop.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
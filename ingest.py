@@ -0,0 +1,433 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from main import FoodInstructionGenerator, DEFAULT_BATCH_SIZE, EXECUTION_MODES, IMAGE_EXTENSIONS, batched
+from dataset_store import DatasetStore
+from feature_cache import FeatureCache
+from image_hash import HashIndex, dhash
+from image_loader import DEFAULT_NUM_WORKERS, load_image
+from instrumentation import Instrumentation
+
+# Per-source progress, kept inside the dataset store directory
+CHECKPOINT_FILE = "ingest_checkpoint.json"
+# dHash of every image row, aligned with the store's image table
+DHASH_FILE = "dhashes.u64"
+DEFAULT_CHUNK_IMAGES = 256
+LIST_SEPARATOR = "|"
+PROGRESS_INTERVAL = 10.0
+
+
+def read_records(source):
+    """Lazily yield raw record dicts from a .csv or .jsonl dump (unparseable lines as {"_error": ...})"""
+    with open(source, 'r', newline='', encoding='utf-8') as f:
+        if Path(source).suffix.lower() == ".csv":
+            yield from csv.DictReader(f)
+            return
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                yield {"_error": f"invalid JSON: {e}"}
+
+
+def split_list(value):
+    """A list field from JSONL (a list) or CSV (a JSON list or a '|'-separated string)"""
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.strip()
+        if value.startswith("["):
+            value = json.loads(value)
+        else:
+            value = value.split(LIST_SEPARATOR)
+    return [str(item).strip() for item in value if str(item).strip()]
+
+
+def parse_record(record, image_root=None, field_map=None):
+    """Turn a raw record into a dataset sample dict; raises ValueError if it is unusable.
+
+    Images come from an "images" list and/or every image file in an
+    "image_dir" folder, relative to image_root if given.
+    """
+    if "_error" in record:
+        raise ValueError(record["_error"])
+    if field_map:
+        record = {**record, **{field: record.get(column) for field, column in field_map.items()}}
+    actual_name = (record.get("actual_name") or "").strip()
+    if not actual_name:
+        raise ValueError("missing actual_name")
+
+    root = Path(image_root) if image_root else None
+    image_paths = [str(root / path) if root else path for path in split_list(record.get("images"))]
+    if record.get("image_dir"):
+        folder = root / record["image_dir"] if root else Path(record["image_dir"])
+        if not folder.is_dir():
+            raise ValueError(f"image_dir {folder} not found")
+        image_paths += [str(path) for path in sorted(folder.iterdir()) if path.suffix.lower() in IMAGE_EXTENSIONS]
+    if not image_paths:
+        raise ValueError("no images")
+    return {
+        "actual_name": actual_name,
+        "image_paths": list(dict.fromkeys(image_paths)),
+        "vague_title": (record.get("vague_title") or "").strip(),
+        "full_instructions": split_list(record.get("full_instructions")),
+        "concise_steps": split_list(record.get("concise_steps"))
+    }
+
+
+def chunk_records(records, chunk_images):
+    """Group (record_no, sample, error) items into chunks of about chunk_images images"""
+    chunk, count = [], 0
+    for item in records:
+        chunk.append(item)
+        count += len(item[1]["image_paths"]) if item[1] else 0
+        if count >= chunk_images:
+            yield chunk
+            chunk, count = [], 0
+    if chunk:
+        yield chunk
+
+
+class Ingestor:
+    """Stream records from a CSV/JSONL dump into a dataset store.
+
+    Records are read lazily and processed in chunks of about `chunk_images`
+    images, with the next chunk's images loading while the current one is
+    encoded, so memory is bounded by two chunks of pixels. Each image file is
+    read once: hashed (SHA-256 for exact duplicates, dHash for near
+    duplicates within `max_distance` bits; None keeps near duplicates),
+    validated, decoded and
+    preprocessed on a thread pool. New images are encoded in batches (reusing
+    the feature cache) and each chunk is appended to the store with its
+    embeddings in one write per file; the generator then uses them as its
+    gallery index (see FoodInstructionGenerator.load_store_index).
+
+    Progress is checkpointed per source after every chunk. The checkpoint
+    notes the store size before each append, so an interrupted run rolls the
+    store back to it and redoes only that chunk.
+    """
+
+    def __init__(self, generator, batch_size=DEFAULT_BATCH_SIZE, chunk_images=DEFAULT_CHUNK_IMAGES,
+                 num_workers=DEFAULT_NUM_WORKERS, max_distance=4, min_size=32, rejects=None):
+        self.generator = generator
+        self.dataset = generator.dataset
+        self.store = generator.dataset.store
+        self.instrumentation = generator.instrumentation
+        self.batch_size = batch_size
+        self.chunk_images = chunk_images
+        self.num_workers = num_workers
+        self.min_size = min_size
+        self.rejects = rejects
+        self.known_digests = set()
+        self.max_distance = max_distance
+        self.hashes = HashIndex(max_distance or 0)
+        self.stats = Counter()
+        self.checkpoint_path = self.store.path / CHECKPOINT_FILE
+        self.dhash_path = self.store.path / DHASH_FILE
+
+    # Checkpointing
+
+    def load_checkpoints(self):
+        if not self.checkpoint_path.exists():
+            return {}
+        with open(self.checkpoint_path, 'r') as f:
+            return json.load(f)
+
+    def save_checkpoint(self, source, state):
+        checkpoints = self.load_checkpoints()
+        checkpoints[source] = state
+        tmp = self.checkpoint_path.with_name(CHECKPOINT_FILE + ".tmp")
+        with open(tmp, 'w') as f:
+            json.dump(checkpoints, f, indent=4)
+        os.replace(tmp, self.checkpoint_path)
+
+    def resume(self, source):
+        """Checkpoint state of source, rolling back a chunk that was being written when the last run stopped"""
+        state = self.load_checkpoints().get(source, {"records_done": 0, "stats": {}})
+        pending = state.pop("pending", None)
+        if pending is not None:
+            if self.store.num_recipes > pending["num_recipes"]:
+                print(f"Rolling back {self.store.num_recipes - pending['num_recipes']} recipes "
+                      f"from an interrupted chunk", file=sys.stderr)
+            # Also drops strings and images written before the recipes were
+            self.store.truncate(pending["num_recipes"], pending.get("strings_size"))
+        return state
+
+    # Deduplication state
+
+    def load_known_images(self):
+        """Exact and perceptual hashes of every image already in the store"""
+        digests = self.store.image_digests
+        self.known_digests = {bytes(digest).hex() for digest in digests if any(digest)}
+
+        num_images = self.store.num_images
+        known = np.fromfile(self.dhash_path, dtype=np.uint64) if self.dhash_path.exists() else np.zeros(0, np.uint64)
+        known = known[:num_images]
+        if len(known) < num_images:
+            # Images added by other tools (or before dHashes were kept) are hashed once here
+            missing = range(len(known), num_images)
+            print(f"Computing perceptual hashes of {len(missing)} stored images...", file=sys.stderr)
+            with ThreadPoolExecutor(self.num_workers) as executor:
+                computed = list(executor.map(lambda row: _safe_dhash(self.store.image_path(row)), missing))
+            known = np.concatenate([known, np.array(computed, dtype=np.uint64)])
+        with open(self.dhash_path, 'wb') as f:
+            f.write(known.tobytes())
+        for row, hash_value in enumerate(known.tolist()):
+            if hash_value:
+                self.hashes.add(hash_value, self.store.image_path(row))
+
+    # Pipeline
+
+    def load(self, path):
+        """Read, hash, validate and preprocess one image (runs on the thread pool)"""
+        try:
+            data = Path(path).read_bytes()
+        except OSError as e:
+            return {"error": f"unreadable: {e.strerror or e}"}
+        digest = hashlib.sha256(data).hexdigest()
+        if digest in self.known_digests:
+            # Skip decoding images that are already ingested
+            return {"sha256": digest, "duplicate": True}
+        try:
+            image = load_image(data)
+            image.load()
+        except Exception as e:
+            return {"error": f"undecodable: {e}"}
+        if min(image.size) < self.min_size:
+            return {"error": f"too small ({image.size[0]}x{image.size[1]})"}
+        pixels = self.generator.processor(images=image, return_tensors="np")["pixel_values"][0]
+        return {"sha256": digest, "dhash": dhash(image), "pixels": pixels}
+
+    def reject(self, record_no, path, reason):
+        if self.rejects is not None:
+            self.rejects.write(json.dumps({"record": record_no, "image": path, "reason": reason}) + "\n")
+
+    def select(self, chunk, loads):
+        """Deduplicate a loaded chunk; returns (samples, images) to write, images as (sha256, dhash, pixels)"""
+        samples, images = [], []
+        for (record_no, sample, error), futures in zip(chunk, loads):
+            if error is not None:
+                self.stats["records_rejected"] += 1
+                self.reject(record_no, None, error)
+                continue
+            paths, digests = [], []
+            for path, future in zip(sample["image_paths"], futures):
+                result = future.result()
+                if "error" in result:
+                    self.stats["images_invalid"] += 1
+                    self.reject(record_no, path, result["error"])
+                    continue
+                if result.get("duplicate") or result["sha256"] in self.known_digests:
+                    self.stats["images_duplicate"] += 1
+                    continue
+                match = self.hashes.find(result["dhash"]) if self.max_distance is not None else None
+                if match is not None:
+                    self.stats["images_near_duplicate"] += 1
+                    self.reject(record_no, path, f"near-duplicate of {match[1]} ({match[2]} bits)")
+                    continue
+                self.known_digests.add(result["sha256"])
+                self.hashes.add(result["dhash"], path)
+                paths.append(path)
+                digests.append(result["sha256"])
+                images.append((result["sha256"], result["dhash"], result["pixels"]))
+            if not paths:
+                self.stats["records_skipped"] += 1
+                continue
+            samples.append({**sample, "image_paths": paths, "image_sha256": digests})
+        return samples, images
+
+    def encode(self, images):
+        """(len(images), dim) features, from the feature cache where possible"""
+        import torch
+
+        generator = self.generator
+        features = np.zeros((len(images), generator.vision_config.hidden_size), dtype=np.float32)
+        cache = generator.feature_cache
+        keys = [FeatureCache.make_key(digest, generator.cache_namespace) for digest, _, _ in images]
+        cached = cache.get_many(keys) if cache is not None else [None] * len(images)
+        missing = [i for i, vector in enumerate(cached) if vector is None]
+        for i, vector in enumerate(cached):
+            if vector is not None:
+                features[i] = vector
+        for rows in batched(missing, self.batch_size):
+            pixel_values = torch.from_numpy(np.stack([images[i][2] for i in rows]))
+            with self.instrumentation.stage("vision_forward", batch_size=len(rows)):
+                features[rows] = generator.encode_pixels(pixel_values).numpy()
+        if cache is not None and missing:
+            cache.put_many((keys[i], features[i]) for i in missing)
+        self.stats["images_encoded"] += len(missing)
+        self.stats["images_cached"] += len(images) - len(missing)
+        return features
+
+    def write(self, source, state, samples, images, features, records_done):
+        # Note the store size first: if the append is interrupted, the next run rolls it back
+        self.save_checkpoint(source, {**state, "pending": {"num_recipes": self.store.num_recipes,
+                                                            "strings_size": self.store.strings_size}})
+        if samples:
+            self.store.add_samples(samples, features if self.store.embedding_dim else None)
+            with open(self.dhash_path, 'r+b') as f:
+                f.truncate((self.store.num_images - len(images)) * 8)
+                f.seek(0, os.SEEK_END)
+                f.write(np.array([hash_value for _, hash_value, _ in images], dtype=np.uint64).tobytes())
+        state.update(records_done=records_done, stats=dict(self.stats))
+        self.save_checkpoint(source, state)
+
+    def ingest(self, source, image_root=None, field_map=None, limit=None):
+        """Import every record of source not yet ingested; returns the cumulative stats"""
+        source_key = str(Path(source).resolve())
+        state = self.resume(source_key)
+        self.load_known_images()
+        self.stats = Counter(state.get("stats", {}))
+        done = state["records_done"]
+        if done:
+            print(f"Resuming {source} after {done} records", file=sys.stderr)
+
+        def parsed():
+            for record_no, record in enumerate(read_records(source)):
+                if record_no < done:
+                    continue
+                if limit is not None and record_no >= done + limit:
+                    return
+                try:
+                    yield record_no, parse_record(record, image_root, field_map), None
+                except (ValueError, TypeError) as e:
+                    yield record_no, None, str(e)
+
+        instrumentation = self.instrumentation
+        start = last_report = time.perf_counter()
+        run_records = run_images = 0
+        in_flight = deque()
+        with ThreadPoolExecutor(self.num_workers, thread_name_prefix="ingest") as executor:
+            def submit(chunk):
+                loads = [[executor.submit(self.load, path) for path in sample["image_paths"]] if sample else []
+                         for _, sample, _ in chunk]
+                in_flight.append((chunk, loads))
+
+            chunks = chunk_records(parsed(), self.chunk_images)
+            # Keep the next chunk decoding while this one is encoded and written
+            first = next(chunks, None)
+            if first is not None:
+                submit(first)
+            while in_flight:
+                chunk, loads = in_flight.popleft()
+                next_chunk = next(chunks, None)
+                if next_chunk is not None:
+                    submit(next_chunk)
+                with instrumentation.stage("ingest_load_wait"):
+                    for futures in loads:
+                        for future in futures:
+                            future.result()
+                with instrumentation.stage("ingest_dedup"):
+                    samples, images = self.select(chunk, loads)
+                del loads
+                self.stats["records_read"] += len(chunk)
+                self.stats["records_ingested"] += len(samples)
+                self.stats["images_ingested"] += len(images)
+                with instrumentation.stage("ingest_encode", images=len(images)):
+                    features = self.encode(images) if images else None
+                with instrumentation.stage("ingest_write", samples=len(samples)):
+                    self.write(source_key, state, samples, images, features, chunk[-1][0] + 1)
+
+                run_records += len(chunk)
+                run_images += sum(len(sample["image_paths"]) for _, sample, _ in chunk if sample)
+                now = time.perf_counter()
+                if now - last_report >= PROGRESS_INTERVAL:
+                    last_report = now
+                    print(f"{format_progress(self.stats)} | {run_records / (now - start):.1f} records/s, "
+                          f"{run_images / (now - start):.1f} images/s", file=sys.stderr)
+        elapsed = time.perf_counter() - start
+        return {"stats": self.stats, "seconds": elapsed, "records": run_records, "images": run_images,
+                "records_per_s": run_records / elapsed if elapsed else 0.0,
+                "images_per_s": run_images / elapsed if elapsed else 0.0}
+
+
+def _safe_dhash(path):
+    try:
+        return dhash(path)
+    except Exception:
+        return 0
+
+
+def format_progress(stats):
+    return (f"{stats['records_read']} records ({stats['records_ingested']} ingested, "
+            f"{stats['records_rejected']} rejected, {stats['records_skipped']} without new images), "
+            f"{stats['images_ingested']} images ingested ({stats['images_duplicate']} duplicate, "
+            f"{stats['images_near_duplicate']} near-duplicate, {stats['images_invalid']} invalid)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream recipes and photos from CSV/JSONL dumps into a dataset store")
+    parser.add_argument("source", help="CSV or JSONL dump: actual_name, vague_title, full_instructions, "
+                                       "concise_steps, images and/or image_dir")
+    parser.add_argument("--dataset", required=True, help="Dataset store directory (created if missing)")
+    parser.add_argument("--image-root", help="Resolve image paths and folders relative to this directory")
+    parser.add_argument("--map", nargs="*", default=[], metavar="FIELD=COLUMN",
+                        help="Read a field from a differently named column, e.g. actual_name=name")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--chunk-images", type=int, default=DEFAULT_CHUNK_IMAGES,
+                        help="Images per write chunk (bounds memory)")
+    parser.add_argument("--num-workers", type=int, default=DEFAULT_NUM_WORKERS)
+    parser.add_argument("--max-distance", type=int, default=4,
+                        help="dHash bits within which two images count as near duplicates (-1 to disable)")
+    parser.add_argument("--min-size", type=int, default=32, help="Reject images smaller than this (pixels)")
+    parser.add_argument("--execution-mode", choices=EXECUTION_MODES, default="inference")
+    parser.add_argument("--limit", type=int, help="Stop after this many records (this run)")
+    parser.add_argument("--rejects", help="Append rejected records/images with reasons to this JSONL file")
+    parser.add_argument("--trace", help="Append per-stage timings to this JSONL file")
+    args = parser.parse_args()
+
+    if Path(args.dataset).exists() and not DatasetStore.is_store(args.dataset):
+        sys.exit(f"{args.dataset} is not a dataset store; convert it with `python dataset_store.py import` first")
+    field_map = dict(item.split("=", 1) for item in args.map)
+
+    instrumentation = Instrumentation(trace_path=args.trace)
+    generator = FoodInstructionGenerator(index_dir=None, dataset_file=args.dataset, num_workers=args.num_workers,
+                                         execution_mode=args.execution_mode, title_similarity="overlap",
+                                         instrumentation=instrumentation)
+    if generator.dataset.store is None:
+        DatasetStore.create(args.dataset, embedding_dim=generator.vision_config.hidden_size,
+                            features=generator.cache_namespace)
+        generator.dataset.load_dataset()
+        print(f"Created dataset store at {args.dataset}", file=sys.stderr)
+    elif generator.dataset.store.features not in (None, generator.cache_namespace):
+        sys.exit(f"The embeddings in {args.dataset} were computed with another model, preprocessing or "
+                 f"--execution-mode; ingest with the same settings")
+    elif generator.dataset.store.embedding_dim and generator.dataset.store.features is None:
+        generator.dataset.store.set_features(generator.cache_namespace)
+
+    rejects = open(args.rejects, 'a') if args.rejects else None
+    try:
+        ingestor = Ingestor(generator, args.batch_size, args.chunk_images, args.num_workers,
+                            max_distance=args.max_distance if args.max_distance >= 0 else None,
+                            min_size=args.min_size, rejects=rejects)
+        report = ingestor.ingest(args.source, args.image_root, field_map, args.limit)
+    finally:
+        if rejects is not None:
+            rejects.close()
+        instrumentation.close()
+
+    print(format_progress(report["stats"]))
+    print(f"This run: {report['records']} records, {report['images']} images in {report['seconds']:.1f}s "
+          f"({report['records_per_s']:.1f} records/s, {report['images_per_s']:.1f} images/s)")
+    stages = instrumentation.snapshot()
+    for name in ("ingest_load_wait", "ingest_dedup", "ingest_encode", "ingest_write"):
+        if name in stages["stages"]:
+            print(f"  {name:<18} {stages['stages'][name]['total_s']:8.2f}s")
+    print(f"  peak RSS {stages['peak_rss_bytes'] / 2**20:.0f} MB; store now has "
+          f"{generator.dataset.store.num_recipes} recipes, {generator.dataset.store.num_images} images")
+
+
+if __name__ == "__main__":
+    main()
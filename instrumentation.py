@@ -0,0 +1,244 @@
+import bisect
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+# Upper bounds (seconds) of the Prometheus latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_PREFIX = "food"
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def current_rss():
+    """Resident set size of this process in bytes (Linux), or None"""
+    try:
+        with open("/proc/self/statm", 'rb') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def current_pss():
+    """Proportional set size in bytes (Linux): shared pages are split between the processes mapping them"""
+    try:
+        with open("/proc/self/smaps_rollup", 'r') as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        pass
+    return None
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageStats:
+    """Running count/sum/max and histogram of one stage's durations"""
+
+    __slots__ = ("count", "total", "max", "buckets", "peak_rss")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.peak_rss = 0
+
+    def add(self, seconds, rss=None):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss, rss)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total_s": self.total,
+            "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "max_ms": self.max * 1000,
+            "peak_rss_bytes": self.peak_rss
+        }
+
+
+class NullInstrumentation:
+    """Disabled instrumentation: every hook is a no-op"""
+
+    enabled = False
+    _null = contextlib.nullcontext()
+
+    def stage(self, name, **attributes):
+        return self._null
+
+    def observe(self, name, seconds, **attributes):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def profile(self, name="profile"):
+        return self._null
+
+    def snapshot(self):
+        return {}
+
+    def prometheus(self):
+        return ""
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Instrumentation:
+    """Opt-in per-stage timers, counters and memory samples.
+
+    `with instrumentation.stage("vision_forward"):` times a block; stats are
+    aggregated per stage name (count, total, max, histogram, peak RSS seen at
+    the end of the stage) and, with a `trace_path`, each timed block is also
+    appended to a JSONL trace. `count` increments named counters. `snapshot`
+    returns everything as a dict and `prometheus` as Prometheus text
+    exposition format. With `profile_dir`, `profile()` blocks are captured
+    with torch.profiler and saved as Chrome traces.
+
+    The hot path is a perf_counter pair and a dict lookup under a lock. With
+    `sample_memory`, RSS is read from /proc at most every `memory_interval`
+    seconds and the last sample is reused in between.
+    """
+
+    enabled = True
+
+    def __init__(self, trace_path=None, sample_memory=True, profile_dir=None, flush_every=256,
+                 memory_interval=0.05):
+        self.sample_memory = sample_memory
+        self.memory_interval = memory_interval
+        self._rss = None
+        self._rss_sampled = float("-inf")
+        self.profile_dir = Path(profile_dir) if profile_dir else None
+        self.flush_every = flush_every
+        self.stages = {}
+        self.counters = Counter()
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._trace = open(trace_path, 'a') if trace_path else None
+        self._pending = []
+
+    @contextlib.contextmanager
+    def stage(self, name, **attributes):
+        """Time the enclosed block as one occurrence of stage `name`"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **attributes)
+
+    def observe(self, name, seconds, **attributes):
+        """Record one occurrence of stage `name` that took `seconds` (for spans not shaped like a block)"""
+        rss = None
+        if self.sample_memory:
+            now = time.monotonic()
+            if now - self._rss_sampled >= self.memory_interval:
+                self._rss, self._rss_sampled = current_rss(), now
+            rss = self._rss
+        with self._lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = StageStats()
+            stats.add(seconds, rss)
+            if self._trace is not None:
+                event = {"ts": time.time(), "stage": name, "ms": seconds * 1000,
+                         "thread": threading.current_thread().name}
+                if rss is not None:
+                    event["rss_bytes"] = rss
+                event.update(attributes)
+                self._pending.append(event)
+                if len(self._pending) >= self.flush_every:
+                    self._write_pending()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    @contextlib.contextmanager
+    def profile(self, name="profile"):
+        """Capture the enclosed block with torch.profiler (a plain stage if profile_dir is unset)"""
+        if self.profile_dir is None:
+            with self.stage(name):
+                yield
+            return
+        from torch.profiler import ProfilerActivity, profile
+
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        with self.stage(name), profile(activities=[ProfilerActivity.CPU], record_shapes=True,
+                                       profile_memory=True) as profiler:
+            yield
+        path = self.profile_dir / f"{name}-{int(time.time() * 1000)}.json"
+        profiler.export_chrome_trace(str(path))
+        self.count("profiles_captured")
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "uptime_s": time.time() - self.started,
+                "peak_rss_bytes": peak_rss(),
+                "rss_bytes": current_rss(),
+                "stages": {name: stats.to_dict() for name, stats in sorted(self.stages.items())},
+                "counters": dict(sorted(self.counters.items()))
+            }
+
+    def prometheus(self):
+        """All metrics in Prometheus text exposition format"""
+        lines = [f"# HELP {METRIC_PREFIX}_stage_seconds Duration of each pipeline stage",
+                 f"# TYPE {METRIC_PREFIX}_stage_seconds histogram"]
+        with self._lock:
+            stages = sorted(self.stages.items())
+            counters = sorted(self.counters.items())
+            for name, stats in stages:
+                cumulative = 0
+                for bound, bucket in zip(LATENCY_BUCKETS + ("+Inf",), stats.buckets):
+                    cumulative += bucket
+                    lines.append(f'{METRIC_PREFIX}_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{METRIC_PREFIX}_stage_seconds_sum{{stage="{name}"}} {stats.total}')
+                lines.append(f'{METRIC_PREFIX}_stage_seconds_count{{stage="{name}"}} {stats.count}')
+
+            lines += [f"# HELP {METRIC_PREFIX}_stage_peak_rss_bytes Largest RSS observed at the end of each stage",
+                      f"# TYPE {METRIC_PREFIX}_stage_peak_rss_bytes gauge"]
+            lines += [f'{METRIC_PREFIX}_stage_peak_rss_bytes{{stage="{name}"}} {stats.peak_rss}'
+                      for name, stats in stages]
+
+        lines += [f"# HELP {METRIC_PREFIX}_events_total Event counters",
+                  f"# TYPE {METRIC_PREFIX}_events_total counter"]
+        lines += [f'{METRIC_PREFIX}_events_total{{event="{name}"}} {value}' for name, value in counters]
+        lines += [f"# HELP {METRIC_PREFIX}_process_peak_rss_bytes Peak resident set size",
+                  f"# TYPE {METRIC_PREFIX}_process_peak_rss_bytes gauge",
+                  f"{METRIC_PREFIX}_process_peak_rss_bytes {peak_rss()}"]
+        return "\n".join(lines) + "\n"
+
+    def _write_pending(self):
+        self._trace.write("".join(json.dumps(event) + "\n" for event in self._pending))
+        self._pending = []
+
+    def flush(self):
+        with self._lock:
+            if self._trace is not None:
+                self._write_pending()
+                self._trace.flush()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._trace is not None:
+                self._trace.close()
+                self._trace = None
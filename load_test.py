@@ -0,0 +1,107 @@
+import argparse
+import asyncio
+import glob
+import json
+import random
+import statistics
+import time
+import uuid
+from pathlib import Path
+
+def multipart_body(image_bytes, filename, title):
+    """Encode an image upload and a title as multipart/form-data"""
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="title"\r\n\r\n'
+        f"{title}\r\n"
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="image"; filename="{filename}"\r\n'
+        f"Content-Type: application/octet-stream\r\n\r\n"
+    ).encode() + image_bytes + f"\r\n--{boundary}--\r\n".encode()
+    return f"multipart/form-data; boundary={boundary}", body
+
+async def post(reader, writer, host, content_type, body):
+    """Send one POST /generate on an open keep-alive connection and return the status code"""
+    writer.write((f"POST /generate HTTP/1.1\r\nHost: {host}\r\nContent-Type: {content_type}\r\n"
+                  f"Content-Length: {len(body)}\r\n\r\n").encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":")[1])
+    await reader.readexactly(length)
+    return status
+
+async def client(host, port, uploads, deadline, latencies, errors):
+    """One simulated user sending requests back to back until the deadline"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while time.perf_counter() < deadline:
+            content_type, body = random.choice(uploads)
+            start = time.perf_counter()
+            status = await post(reader, writer, host, content_type, body)
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors.append(status)
+    finally:
+        writer.close()
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+async def run(args):
+    titles = {}
+    if Path("food_samples.json").exists():
+        with open("food_samples.json", 'r') as f:
+            titles = {Path(sample["image_paths"][0]).parent.name: sample["vague_title"]
+                      for sample in json.load(f)}
+    uploads = []
+    for image_path in sorted(glob.glob(args.images)):
+        food_item = Path(image_path).stem[len("test_"):].rstrip("0123456789")
+        title = next((t for name, t in titles.items() if name.startswith(food_item)), "")
+        uploads.append(multipart_body(Path(image_path).read_bytes(), Path(image_path).name, title))
+    if not uploads:
+        print(f"No images match {args.images}")
+        return
+
+    latencies, errors = [], []
+    start = time.perf_counter()
+    deadline = start + args.duration
+    await asyncio.gather(*(client(args.host, args.port, uploads, deadline, latencies, errors)
+                           for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+
+    report = {
+        "concurrency": args.concurrency,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "throughput_rps": len(latencies) / elapsed,
+    }
+    if latencies:
+        report.update({
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p90_ms": percentile(latencies, 90) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "mean_ms": statistics.mean(latencies) * 1000,
+        })
+    print(json.dumps(report, indent=4))
+
+def main():
+    parser = argparse.ArgumentParser(description="Closed-loop load generator for service.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--images", default="images/test/test_*.png")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to run")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,544 @@
 from food_dataset import FoodDataset
-from transformers import AutoProcessor, CLIPVisionModel
-from PIL import Image
-import torch
+from embedding_index import EmbeddingIndex
+from similarity import SimilarityEngine, l2_normalize
+from ann_index import IVFIndex, SEARCH_BACKENDS, load_search_index
+from image_loader import PrefetchLoader, DEFAULT_NUM_WORKERS, load_image
+from pixel_cache import PixelCache, DEFAULT_PIXEL_CACHE
+from feature_cache import FeatureCache, DEFAULT_FEATURE_CACHE, content_hash, namespace_key
+from instrumentation import Instrumentation, NullInstrumentation
+from result_cache import ResultCache, DEFAULT_MAX_DISTANCE
+import numpy as np
 from pathlib import Path
+import argparse
+import contextlib
+import functools
+import glob
+import itertools
+import json
+import sys
+import threading
+
+MODEL_NAME = "openai/clip-vit-base-patch32"
+DEFAULT_INDEX_DIR = "gallery_index"
+# Safetensors snapshot of the CLIP towers, used instead of the hub cache when present (see model_loader.py)
+DEFAULT_SNAPSHOT_DIR = "model_snapshot"
+DEFAULT_DATASET_FILE = "food_samples.json"
+IVF_INDEX_FILE = "ivf.npz"
+# Compact the gallery index once this fraction of its rows are tombstones
+COMPACT_RATIO = 0.25
+DEFAULT_BATCH_SIZE = 16
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".bmp"}
+
+# How the vision encoder is run on CPU:
+# - "fp32": plain eager forward with autograd bookkeeping (the original behaviour)
+# - "inference": fp32 under torch.inference_mode()
+# - "bf16": inference_mode + bfloat16 autocast
+# - "int8": inference_mode + dynamic int8 quantization of the Linear layers
+# - "trace" / "compile": inference_mode + TorchScript-traced / torch.compile'd encoder
+EXECUTION_MODES = ("fp32", "inference", "bf16", "int8", "trace", "compile")
+
+# Title term of the fused score: CLIP text embeddings or the original word overlap
+TITLE_SIMILARITIES = ("clip", "overlap")
+TITLE_CACHE_SIZE = 4096
+# Vision config fields that determine the features; hashed into the gallery index and cache namespace
+VISION_CONFIG_FIELDS = ("hidden_size", "intermediate_size", "num_hidden_layers", "num_attention_heads",
+                        "image_size", "patch_size", "num_channels", "hidden_act", "layer_norm_eps")
+
+def batched(iterable, batch_size):
+    """Yield lists of up to batch_size items from iterable"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 class FoodInstructionGenerator:
-    def __init__(self):
-        # Initialize vision model and processor
-        self.vision_model = CLIPVisionModel.from_pretrained("openai/clip-vit-base-patch32", local_files_only=True)
-        self.processor = AutoProcessor.from_pretrained("openai/clip-vit-base-patch32", local_files_only=True)
-        self.dataset = FoodDataset()
+    def __init__(self, index_dir=DEFAULT_INDEX_DIR, num_workers=DEFAULT_NUM_WORKERS,
+                 feature_cache=DEFAULT_FEATURE_CACHE, execution_mode="inference", title_similarity="clip",
+                 dataset_file=DEFAULT_DATASET_FILE, search_backend="exact", nprobe=8, nlist=None, models=None,
+                 instrumentation=None, snapshot_dir=DEFAULT_SNAPSHOT_DIR, pixel_cache=DEFAULT_PIXEL_CACHE,
+                 result_cache=None, registry=None, model_name=None):
+        if title_similarity not in TITLE_SIMILARITIES:
+            raise ValueError(f"Unknown title similarity '{title_similarity}', expected one of {TITLE_SIMILARITIES}")
+
+        # Per-stage timers and counters (see instrumentation.py); a no-op unless one is passed
+        self.instrumentation = instrumentation or NullInstrumentation()
+
+        # Models are loaded on first use (see the properties below), so runs served from the
+        # feature cache and gallery index never load the vision weights. `models` is a
+        # preloaded (vision_model, processor, text_model) triple used instead of MODEL_NAME,
+        # e.g. benchmark.tiny_clip(). The feature cache and gallery index are keyed by the model
+        # name, so preloaded models need `model_name` (what they are a copy of, e.g. the shared
+        # weights of worker_pool.py) to use either. Otherwise the towers come from `registry`
+        # (model_registry.REGISTRY by default) and are shared with every other generator in the
+        # process; the registry may unload them to stay within its budget.
+        if models is not None and model_name is None and (index_dir is not None or feature_cache):
+            raise ValueError("Preloaded models need a model_name to use a gallery index or feature cache; "
+                             "pass index_dir=None and feature_cache=None")
+        self.model_name = MODEL_NAME if models is None else model_name
+        self.snapshot_dir = snapshot_dir
+        self._vision_model, self._processor, self._text_model = models or (None, None, None)
+        if registry is None:
+            from model_registry import REGISTRY as registry
+        self.registry = registry
+        if models is None:
+            # The encoder holds the vision weights; let them go when the registry unloads them
+            registry.on_unload(f"{MODEL_NAME}:vision", self._drop_encoder)
+        self._vision_config = None
+        self._vision_config_hash = None
+        self._tokenizer = None
+        self._encoder = None
+        self._cache_namespace = None
+
+        # JSON file or columnar dataset store directory
+        self.dataset = FoodDataset(dataset_file)
         self.dataset.load_dataset()
 
+        # Text tower with projection, for title similarity in CLIP's joint space
+        self.title_similarity = title_similarity
+        self.title_matrix = None
+        if title_similarity == "clip":
+            # Repeated vague titles are encoded only once
+            self.query_title_embedding = functools.lru_cache(maxsize=TITLE_CACHE_SIZE)(self._encode_query_title)
+
+        # Image decode/preprocess workers used by encode_images
+        self.num_workers = num_workers
+
+        # On-disk cache of image features (None to disable)
+        self.feature_cache = FeatureCache(feature_cache) if feature_cache else None
+        # Pre-resized gallery/test pixels built by pixel_cache.py, opened on first decode (None to disable)
+        self.pixel_cache_dir = pixel_cache
+        self._pixel_cache = None
+        self._pixel_cache_checked = False
+        # ResultCache answering repeated and near-duplicate queries without the model (None to disable)
+        self.result_cache = result_cache
+        self.set_execution_mode(execution_mode)
+
+        # Gallery search: exact brute force, or an approximate IVF index for large galleries
+        if search_backend not in SEARCH_BACKENDS:
+            raise ValueError(f"Unknown search backend '{search_backend}', expected one of {SEARCH_BACKENDS}")
+        self.search_backend = search_backend
+        self.nprobe = nprobe
+        self.nlist = nlist
+
+        # Precomputed gallery features (see build_index.py)
+        self.index_dir = index_dir
+        self.index = None
+        self.engine = None
+        # Serializes index updates with background compaction
+        self.index_lock = threading.Lock()
+        if index_dir is not None:
+            self.set_index(self.load_index(index_dir))
+
+    def _shared_model(self, part, load):
+        return self.registry.get(f"{MODEL_NAME}:{part}", lambda: load(MODEL_NAME, self.snapshot_dir))
+
+    @property
+    def vision_model(self):
+        if self._vision_model is None:
+            from model_loader import load_vision_model
+            return self._shared_model("vision", load_vision_model)
+        return self._vision_model
+
+    @property
+    def vision_config(self):
+        """Vision tower config, read without loading the weights"""
+        if self._vision_config is None:
+            if self._vision_model is not None:
+                self._vision_config = self._vision_model.config
+            else:
+                from model_loader import load_vision_config
+                self._vision_config = load_vision_config(MODEL_NAME, self.snapshot_dir)
+        return self._vision_config
+
+    @property
+    def vision_config_hash(self):
+        """Short hash of the vision architecture, so features of a differently shaped model never match"""
+        if self._vision_config_hash is None:
+            self._vision_config_hash = namespace_key(*(getattr(self.vision_config, field, None)
+                                                       for field in VISION_CONFIG_FIELDS))
+        return self._vision_config_hash
+
+    def index_identity(self):
+        """Model checks for EmbeddingIndex.check_dataset / model_problems"""
+        return {"model_name": self.model_name, "dim": self.vision_config.hidden_size,
+                "vision_config": self.vision_config_hash}
+
+    @property
+    def processor(self):
+        if self._processor is None:
+            from model_loader import load_processor
+            return self._shared_model("processor", load_processor)
+        return self._processor
+
+    @property
+    def text_model(self):
+        """CLIP text tower with projection (None in overlap title mode)"""
+        if self.title_similarity != "clip":
+            return None
+        if self._text_model is None:
+            from model_loader import load_text_model
+            return self._shared_model("text", load_text_model)
+        return self._text_model
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None and self.title_similarity == "clip":
+            self._tokenizer = getattr(self.processor, "tokenizer", None)
+            if self._tokenizer is None:
+                from model_loader import load_tokenizer
+                self._tokenizer = load_tokenizer(MODEL_NAME, self.snapshot_dir)
+        return self._tokenizer
+
+    @property
+    def pixel_cache(self):
+        """The PixelCache, or None if it is disabled, not built or made with another preprocessing config"""
+        if not self._pixel_cache_checked:
+            self._pixel_cache = PixelCache.open(self.pixel_cache_dir, self.processor)
+            self._pixel_cache_checked = True
+        return self._pixel_cache
+
+    @property
+    def encoder(self):
+        """The vision encoder prepared for the current execution mode, built on first use"""
+        if self._encoder is None:
+            self._encoder = self.build_encoder(self.execution_mode)
+        elif self._vision_model is None:
+            # Keeps the registry's LRU order in step with encoder use
+            self.registry.get(f"{MODEL_NAME}:vision")
+        return self._encoder
+
+    def _drop_encoder(self):
+        self._encoder = None
+
+    @property
+    def cache_namespace(self):
+        if self._cache_namespace is None:
+            self._cache_namespace = self.feature_namespace()
+        return self._cache_namespace
+
+    def load_models(self):
+        """Load every model now instead of on first use (e.g. before serving or forking workers)"""
+        for name in ("processor", "vision_config", "encoder", "tokenizer", "text_model"):
+            getattr(self, name)
+
+    def after_fork(self):
+        """Reset per-process state in a child forked from a loaded generator (see fork_server.py)"""
+        self.index_lock = threading.Lock()
+        if self.feature_cache is not None:
+            self.feature_cache.reopen()
+
+    def set_index(self, index, gallery=None):
+        """Use `index` for matching (70% image, 30% title).
+
+        `gallery` is an optional normalized copy of its live rows, e.g. shared
+        between worker processes (see worker_pool.py).
+        """
+        self.index = index
+        if self.result_cache is not None:
+            # Cached results were matched against the previous gallery
+            self.result_cache.clear()
+        self.engine = SimilarityEngine.from_index(index, num_samples=len(self.dataset.samples),
+                                                  gallery=gallery, image_weight=0.7, title_weight=0.3,
+                                                  search_index=self.load_search_index(index))
+        if self.title_similarity == "clip":
+            if index.title_embeddings is None:
+                index.add_title_embeddings(self.dataset, self.encode_titles)
+            # One row per (sample, [vague_title, actual_name]), normalized once
+            num_samples, pair, dim = index.title_embeddings.shape
+            self.title_matrix = l2_normalize(index.title_embeddings.reshape(num_samples * pair, dim))
+        if index.tombstone_ratio > COMPACT_RATIO:
+            self.compact_index()
+
+    def load_search_index(self, index):
+        """Approximate search index over the gallery, or None for exact search"""
+        if self.search_backend == "exact" or len(index) == 0:
+            return None
+        if self.index_dir is not None:
+            path = Path(self.index_dir) / IVF_INDEX_FILE
+            if path.exists():
+                search_index = load_search_index(path)
+                if len(search_index) == len(index) and (self.nlist is None or search_index.nlist == self.nlist):
+                    search_index.nprobe = self.nprobe
+                    return search_index
+        return IVFIndex.train(index.live_embeddings(), nlist=self.nlist, nprobe=self.nprobe)
+
+    def load_store_index(self, encode_missing=True):
+        """Index over the dataset store's embedding matrix, or None if the store has none for this model.
+
+        The matrix is used when its features were computed with this model,
+        preprocessing and precision (see ingest.py); a store created without
+        them is claimed when its width matches. Images appended without
+        features are encoded into the store first (with encode_missing=False,
+        None is returned instead).
+        """
+        store = self.dataset.store
+        if store is None or store.embedding_dim != self.vision_config.hidden_size:
+            return None
+        if store.features not in (None, self.cache_namespace):
+            return None
+        if not encode_missing and np.isnan(store.embeddings).any():
+            return None
+        encoded = self.fill_store_embeddings(store)
+        if encoded:
+            print(f"Encoded {encoded} dataset store images without features")
+        if store.features is None:
+            store.set_features(self.cache_namespace)
+        return EmbeddingIndex.from_store(store, self.model_name, self.vision_config_hash)
+
+    def fill_store_embeddings(self, store, batch_size=DEFAULT_BATCH_SIZE):
+        """Encode the store's images whose embedding rows are still NaN; returns how many"""
+        rows = np.flatnonzero(np.isnan(store.embeddings).any(axis=1))
+        if len(rows):
+            store.set_embeddings(rows, self.encode_images([store.image_path(row) for row in rows], batch_size))
+        return len(rows)
+
+    def load_index(self, index_dir):
+        """Load the gallery index, updating it for dataset edits or rebuilding it in memory if missing.
+
+        A dataset store with features for this model is its own index (see
+        load_store_index) and index_dir is not read.
+        """
+        index = self.load_store_index()
+        if index is not None:
+            return index
+        if EmbeddingIndex.exists(index_dir):
+            index = EmbeddingIndex.load(index_dir)
+            problems = index.check_dataset(self.dataset, **self.index_identity())
+            if not problems:
+                return index
+            print(f"Gallery index at {index_dir} is stale: {problems[0]}")
+            if not index.model_problems(**self.index_identity()):
+                summary = self.update_stored_index(index, index_dir)
+                print(f"Updated gallery index: {format_index_update(summary)}")
+                return index
+        else:
+            print(f"No gallery index found at {index_dir}. Run build_index.py to create one.")
+        print("Encoding gallery images in memory...")
+        return self.build_index()
+
+    def index_encoders(self, batch_size=DEFAULT_BATCH_SIZE):
+        """(encode_images, encode_titles) callables for EmbeddingIndex.build / update"""
+        encode_titles = self.encode_titles if self.title_similarity == "clip" else None
+        return (lambda paths: self.encode_images(paths, batch_size)), encode_titles
+
+    def build_index(self, batch_size=DEFAULT_BATCH_SIZE):
+        """Encode every gallery image (and, in clip title mode, every sample title) in the dataset once"""
+        encode_images, encode_titles = self.index_encoders(batch_size)
+        return EmbeddingIndex.build(self.dataset, encode_images, model_name=self.model_name,
+                                    encode_titles=encode_titles, vision_config=self.vision_config_hash)
+
+    def update_stored_index(self, index, index_dir=None, batch_size=DEFAULT_BATCH_SIZE):
+        """Apply dataset edits to `index`, encoding only new or changed images, and append them to index_dir"""
+        num_rows = len(index.rows)
+        summary = index.update(self.dataset, *self.index_encoders(batch_size))
+        if index_dir is not None:
+            index.save(index_dir, append_from=num_rows)
+            # Saved IVF lists refer to the old rows
+            (Path(index_dir) / IVF_INDEX_FILE).unlink(missing_ok=True)
+        return summary
+
+    def update_index(self, batch_size=DEFAULT_BATCH_SIZE):
+        """Bring the gallery index up to date with the dataset; cost is proportional to the edits"""
+        with self.index_lock:
+            store = self.dataset.store
+            if self.index is not None and self.index.store is not None and store is not None:
+                # Store rows are only ever appended, with their features
+                num_rows = len(self.index)
+                encoded = self.fill_store_embeddings(store, batch_size)
+                self.set_index(EmbeddingIndex.from_store(store, self.model_name, self.vision_config_hash))
+                return {"added": len(self.index) - num_rows, "changed": 0, "removed": 0, "unchanged": num_rows,
+                        "encoded": encoded}
+            if self.index is None:
+                self.set_index(self.build_index(batch_size))
+                return {"added": len(self.index), "changed": 0, "removed": 0, "unchanged": 0,
+                        "encoded": len(self.index)}
+            summary = self.update_stored_index(self.index, self.index_dir, batch_size)
+            self.set_index(self.index)
+        return summary
+
+    def refresh(self, batch_size=DEFAULT_BATCH_SIZE):
+        """Reload the dataset from disk and apply its edits to the gallery index"""
+        self.dataset.load_dataset()
+        return self.update_index(batch_size)
+
+    def compact_index(self, background=True):
+        """Drop tombstoned rows from the gallery index, on a background thread by default.
+
+        Matching is unaffected (the engine only sees live rows); this reclaims
+        memory and disk space. Returns the thread, or None when run inline.
+        """
+        def compact():
+            with self.index_lock:
+                compacted = self.index.compacted()
+                if self.index_dir is not None:
+                    compacted.save(self.index_dir)
+                    (Path(self.index_dir) / IVF_INDEX_FILE).unlink(missing_ok=True)
+                self.index = compacted
+
+        if not background:
+            compact()
+            return None
+        thread = threading.Thread(target=compact, name="index-compaction", daemon=True)
+        thread.start()
+        return thread
+
+    def set_execution_mode(self, mode):
+        """Select how the vision encoder runs (see EXECUTION_MODES); the encoder is rebuilt on next use"""
+        if mode not in EXECUTION_MODES:
+            raise ValueError(f"Unknown execution mode '{mode}', expected one of {EXECUTION_MODES}")
+        self.execution_mode = mode
+        self._encoder = None
+        self._cache_namespace = None
+
+    def build_encoder(self, mode):
+        import torch
+        from model_loader import PooledVisionEncoder
+
+        self.vision_model.eval()
+        encoder = PooledVisionEncoder(self.vision_model).eval()
+
+        if mode == "int8":
+            encoder = torch.ao.quantization.quantize_dynamic(encoder, {torch.nn.Linear}, dtype=torch.qint8)
+        elif mode == "trace":
+            size = self.vision_model.config.image_size
+            example = torch.zeros(1, 3, size, size)
+            with torch.inference_mode():
+                encoder = torch.jit.freeze(torch.jit.trace(encoder, example, strict=False))
+        elif mode == "compile":
+            encoder = torch.compile(encoder)
+        return encoder
+
+    def encode_pixels(self, pixel_values):
+        """Run the vision encoder on preprocessed pixels, returning (batch, dim) float32 features"""
+        import torch
+
+        if self.execution_mode == "fp32":
+            return self.encoder(pixel_values).detach()
+        with torch.inference_mode():
+            if self.execution_mode == "bf16":
+                with torch.autocast("cpu", dtype=torch.bfloat16):
+                    return self.encoder(pixel_values).float()
+            return self.encoder(pixel_values)
+
+    def feature_namespace(self):
+        """Cache namespace: everything besides the image that changes its features"""
+        image_processor = getattr(self.processor, "image_processor", self.processor)
+        precision = self.execution_mode if self.execution_mode in ("bf16", "int8") else "fp32"
+        return namespace_key(self.model_name, getattr(self.vision_config, "_commit_hash", None),
+                             self.vision_config_hash, "mean_last_hidden_state", precision,
+                             image_processor.to_json_string())
+
+    def feature_cache_key(self, image_path):
+        return FeatureCache.make_key(content_hash(image_path), self.cache_namespace)
+
     def process_image(self, image_path):
         """Process a single image and return its features"""
-        image = Image.open(image_path)
-        inputs = self.processor(images=image, return_tensors="pt")
-        outputs = self.vision_model(**inputs)
-        return outputs.last_hidden_state.mean(dim=1)
+        import torch
+
+        instrumentation = self.instrumentation
+        if self.feature_cache is not None:
+            with instrumentation.stage("feature_cache_lookup"):
+                cache_key = self.feature_cache_key(image_path)
+                cached = self.feature_cache.get(cache_key)
+            if cached is not None:
+                instrumentation.count("feature_cache_hits")
+                return torch.from_numpy(cached.copy()).unsqueeze(0)
+            instrumentation.count("feature_cache_misses")
+
+        pixels = None
+        if self.pixel_cache is not None:
+            with instrumentation.stage("pixel_cache_lookup"):
+                pixels = self.pixel_cache.get(image_path)
+            instrumentation.count("pixel_cache_hits" if pixels is not None else "pixel_cache_misses")
+        if pixels is not None:
+            pixel_values = torch.from_numpy(pixels).unsqueeze(0)
+        else:
+            with instrumentation.stage("decode"):
+                image = load_image(image_path)
+                image.load()
+            with instrumentation.stage("preprocess"):
+                pixel_values = self.processor(images=image, return_tensors="pt")["pixel_values"]
+        with instrumentation.stage("vision_forward", batch_size=1):
+            features = self.encode_pixels(pixel_values)
+        instrumentation.count("images_encoded")
+
+        if self.feature_cache is not None:
+            with instrumentation.stage("feature_cache_store"):
+                self.feature_cache.put(cache_key, features[0].numpy())
+        return features
+
+    def encode_images(self, image_paths, batch_size=DEFAULT_BATCH_SIZE, errors=None):
+        """Encode many images, batch_size at a time, into a (len(image_paths), dim) array
+
+        Cached features are reused; only the misses are decoded (in a worker
+        pool, overlapping with the vision forward of the previous batch) and
+        encoded. An image that can't be read raises, unless an `errors` dict
+        is given: it then gets {position: exception} and the image's row is
+        left zero (and not cached).
+        """
+        image_paths = list(image_paths)
+        dim = self.vision_config.hidden_size
+        if not image_paths:
+            return np.zeros((0, dim), dtype=np.float32)
+
+        instrumentation = self.instrumentation
+        if self.feature_cache is not None:
+            with instrumentation.stage("feature_cache_lookup", images=len(image_paths)):
+                cache_keys = []
+                for i, path in enumerate(image_paths):
+                    try:
+                        cache_keys.append(self.feature_cache_key(path))
+                    except OSError as e:
+                        if errors is None:
+                            raise
+                        errors[i] = e
+                        cache_keys.append(None)
+                found = iter(self.feature_cache.get_many([key for key in cache_keys if key is not None]))
+                cached = [next(found) if key is not None else None for key in cache_keys]
+        else:
+            cache_keys = None
+            cached = [None] * len(image_paths)
+        missing = [i for i, vector in enumerate(cached) if vector is None and i not in (errors or {})]
+        if self.feature_cache is not None:
+            instrumentation.count("feature_cache_hits", len(image_paths) - len(missing))
+            instrumentation.count("feature_cache_misses", len(missing))
+
+        features = np.zeros((len(image_paths), dim), dtype=np.float32)
+        for i, vector in enumerate(cached):
+            if vector is not None:
+                features[i] = vector
+
+        done = 0
+        loader = PrefetchLoader(self.processor, [image_paths[i] for i in missing], batch_size,
+                                num_workers=self.num_workers, pixel_cache=self.pixel_cache if missing else None,
+                                skip_errors=errors is not None)
+        batches = iter(loader)
+        while True:
+            # Decode + preprocess time that the prefetching did not hide behind the forward
+            with instrumentation.stage("image_load_wait"):
+                batch = next(batches, None)
+            if batch is None:
+                break
+            sources, pixel_values = batch
+            # Images that failed to load are not in pixel_values
+            batch_rows = [missing[j] for j in range(done, done + len(sources)) if j not in loader.errors]
+            if batch_rows:
+                with instrumentation.stage("vision_forward", batch_size=len(pixel_values)):
+                    features[batch_rows] = self.encode_pixels(pixel_values).numpy()
+            done += len(sources)
+        for j, error in loader.errors.items():
+            errors[missing[j]] = error
+        encoded = [i for i in missing if i not in (errors or {})]
+        instrumentation.count("images_encoded", len(encoded))
+
+        if self.feature_cache is not None and encoded:
+            with instrumentation.stage("feature_cache_store", images=len(encoded)):
+                self.feature_cache.put_many((cache_keys[i], features[i]) for i in encoded)
+        return features
 
     def calculate_text_similarity(self, text1, text2):
         """Calculate similarity between two text strings"""
@@ -26,45 +547,252 @@ class FoodInstructionGenerator:
         common_words = words1 & words2
         return len(common_words) / max(len(words1), len(words2))
 
-    def generate_instructions(self, image_path, vague_title):
-        """Generate cooking instructions for a new image-title pair"""
-        # Process new image
-        image_features = self.process_image(image_path)
-    
-        # Find most similar example from dataset
-        best_match = None
-        best_similarity = -1
-
-        for sample in self.dataset.samples:
-            # Process each sample image and compare
-            for sample_image in sample["image_paths"]:
-                sample_features = self.process_image(sample_image)
-                
-                # Calculate image similarity
-                img_similarity = torch.cosine_similarity(image_features, sample_features)
-                
-                # Calculate title similarity
-                title_similarity = self.calculate_text_similarity(vague_title, sample["vague_title"])
-                
-                # Combined similarity (70% image, 30% title)
-                similarity = 0.7 * img_similarity + 0.3 * title_similarity
-            
-                if similarity > best_similarity:
-                    best_similarity = similarity
-                    best_match = sample
-                    matched_similarity = similarity.item()  # Convert tensor to number
-        
-        if best_match:
-            return {
+    def encode_titles(self, texts):
+        """Encode texts with CLIP's text tower and projection into a (len(texts), dim) array"""
+        import torch
+
+        inputs = self.tokenizer(list(texts), padding=True, truncation=True, return_tensors="pt")
+        with torch.inference_mode():
+            return self.text_model(**inputs).text_embeds.numpy()
+
+    def _encode_query_title(self, vague_title):
+        embedding = l2_normalize(self.encode_titles([vague_title]))[0]
+        embedding.setflags(write=False)
+        return embedding
+
+    def title_similarities(self, vague_title):
+        """Similarity of a vague title to every sample's titles, one value per sample"""
+        return self.batch_title_similarities([vague_title])[0]
+
+    def batch_title_similarities(self, vague_titles):
+        """Title similarities for many queries, shape (len(vague_titles), num_samples)"""
+        if self.title_similarity == "overlap":
+            return np.array([[self.calculate_text_similarity(vague_title, sample["vague_title"])
+                              for sample in self.dataset.samples]
+                             for vague_title in vague_titles], dtype=np.float32).reshape(len(vague_titles), -1)
+
+        # Best of the vague-title and actual-name matches, as one matrix product
+        queries = np.stack([self.query_title_embedding(vague_title) for vague_title in vague_titles])
+        scores = queries @ self.title_matrix.T
+        return scores.reshape(len(vague_titles), -1, 2).max(axis=2)
+
+    def match(self, image_features, vague_titles, top_k=3, aggregation="max"):
+        """Match a batch of encoded images and their vague titles against the dataset.
+
+        Returns one result dict (or None) per query.
+        """
+        if self.engine is None:
+            self.set_index(self.build_index())
+        if self.engine.num_samples == 0:
+            return [None] * len(vague_titles)
+
+        with self.instrumentation.stage("title_scoring", queries=len(vague_titles)):
+            title_scores = self.batch_title_similarities(vague_titles)
+        with self.instrumentation.stage("search", queries=len(vague_titles)):
+            sample_indices, scores = self.engine.top_k(image_features, title_scores,
+                                                       k=top_k, aggregation=aggregation)
+        results = []
+        for query_indices, query_scores in zip(sample_indices, scores):
+            matches = [
+                {
+                    "title": self.dataset.samples[sample_idx]["actual_name"],
+                    "vague_title": self.dataset.samples[sample_idx]["vague_title"],
+                    "similarity": float(score),
+                    # Dataset row: names need not be unique
+                    "sample": int(sample_idx)
+                }
+                for sample_idx, score in zip(query_indices, query_scores)
+                if np.isfinite(score)
+            ]
+            if not matches:
+                results.append(None)
+                continue
+            best_match = self.dataset.samples[query_indices[0]]
+            results.append({
                 "title": best_match["actual_name"],
                 "vague_title": best_match["vague_title"],
                 "steps": best_match["concise_steps"],
                 "best_match": best_match,
-                "similarity": matched_similarity
-            }
-        else:
+                "similarity": matches[0]["similarity"],
+                "matches": matches
+            })
+        return results
+
+    def generate_instructions(self, image_path, vague_title, top_k=3, aggregation="max"):
+        """Generate cooking instructions for a new image-title pair
+
+        `aggregation` controls how the 10 images per dish are combined:
+        "max" (best image), "mean" or "vote" (top-n vote).
+        """
+        cache_key = None
+        if self.result_cache is not None:
+            cache_key = self.result_cache.key(image_path, vague_title, top_k, aggregation)
+            result = self.result_cache.get(cache_key)
+            if result is not None:
+                self.instrumentation.count("queries")
+                return result
+        with self.instrumentation.stage("generate_instructions"):
+            # Process new image
+            image_features = self.process_image(image_path).numpy()
+            result = self.match(image_features, [vague_title], top_k, aggregation)[0]
+        self.instrumentation.count("queries")
+        if cache_key is not None:
+            self.result_cache.put(cache_key, result)
+        if result is None:
             print("No suitable match found in dataset.")
-            return None
+        return result
+
+    def generate_instructions_batch(self, pairs, batch_size=DEFAULT_BATCH_SIZE, top_k=3, aggregation="max",
+                                    errors=None):
+        """Generate instructions for many (image_path, vague_title) pairs.
+
+        Images are preprocessed and encoded batch_size at a time; results are
+        yielded in input order as each batch finishes, so `pairs` can be a
+        lazy iterator over a large manifest. With a result cache, only the
+        queries it can't answer are encoded and matched.
+
+        An image that can't be read raises, unless an `errors` dict is given:
+        it then gets {pair index: exception} before that pair's result (None)
+        is yielded.
+        """
+        cache = self.result_cache
+        offset = 0
+        for batch in batched(pairs, batch_size):
+            results = [None] * len(batch)
+            # Unreadable images of this batch, by position
+            failed = {} if errors is not None else None
+            missing = list(range(len(batch)))
+            # Misses repeating an earlier query of the batch byte for byte -> that query's position
+            repeats = {}
+            if cache is not None:
+                cache_keys = []
+                for i, (image_path, vague_title) in enumerate(batch):
+                    try:
+                        cache_keys.append(cache.key(image_path, vague_title, top_k, aggregation))
+                    except OSError as e:
+                        if failed is None:
+                            raise
+                        failed[i] = e
+                        cache_keys.append(None)
+                results = [cache.get(key) if key is not None else None for key in cache_keys]
+                first = {}
+                for i, result in enumerate(results):
+                    if result is None and i not in (failed or {}):
+                        first.setdefault((cache_keys[i].digest, cache_keys[i].options), i)
+                        repeats[i] = first[cache_keys[i].digest, cache_keys[i].options]
+                missing = sorted(set(repeats.values()))
+            if missing:
+                image_paths = [batch[i][0] for i in missing]
+                with self.instrumentation.stage("generate_batch", batch_size=len(missing)):
+                    load_errors = {} if failed is not None else None
+                    image_features = self.encode_images(image_paths, batch_size, load_errors)
+                    if load_errors:
+                        failed.update((missing[j], error) for j, error in load_errors.items())
+                        keep = [j for j in range(len(missing)) if j not in load_errors]
+                        missing = [missing[j] for j in keep]
+                        image_features = image_features[keep]
+                    vague_titles = [batch[i][1] for i in missing]
+                    matches = self.match(image_features, vague_titles, top_k, aggregation) if missing else []
+                    for i, result in zip(missing, matches):
+                        results[i] = result
+                        if cache is not None:
+                            cache.put(cache_keys[i], result)
+            for i, first_i in repeats.items():
+                results[i] = results[first_i]
+                if failed is not None and first_i in failed:
+                    failed[i] = failed[first_i]
+            if failed:
+                errors.update((offset + i, error) for i, error in failed.items())
+            offset += len(batch)
+            self.instrumentation.count("queries", len(batch))
+            yield from results
+
+def format_index_update(summary):
+    return (f"{summary['added']} new, {summary['changed']} changed, {summary['removed']} removed, "
+            f"{summary['unchanged']} unchanged images ({summary['encoded']} encoded)")
+
+def read_inputs(source, default_title=""):
+    """Yield (image_path, vague_title) pairs from a directory, glob pattern or JSONL manifest.
+
+    Manifest lines look like {"image": "images/test/test_pizza1.png", "title": "italian pizza"}.
+    Directory and glob inputs all use default_title.
+    """
+    path = Path(source)
+    if path.is_dir():
+        for image_path in sorted(path.iterdir()):
+            if image_path.suffix.lower() in IMAGE_EXTENSIONS:
+                yield str(image_path), default_title
+    elif path.suffix == ".jsonl" and path.exists():
+        with open(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    yield record["image"], record.get("title", default_title)
+    else:
+        for image_path in sorted(glob.glob(source)):
+            yield image_path, default_title
+
+def make_instrumentation(args):
+    """Instrumentation for the --trace / --metrics / --profile-dir options, or None if none is set"""
+    if not (args.trace or args.metrics or args.profile_dir):
+        return None
+    return Instrumentation(trace_path=args.trace, profile_dir=args.profile_dir)
+
+def run_batch(args, generator=None):
+    """Non-interactive mode: match every input and stream JSONL results.
+
+    `generator` is an already loaded generator to use (see fork_server.py);
+    by default one is created from args.
+    """
+    instrumentation = make_instrumentation(args) or NullInstrumentation()
+    if generator is None:
+        # Keep stdout clean for JSONL output
+        with contextlib.redirect_stdout(sys.stderr):
+            generator = FoodInstructionGenerator(index_dir=args.index_dir, num_workers=args.num_workers,
+                                                 execution_mode=args.execution_mode,
+                                                 title_similarity=args.title_similarity,
+                                                 dataset_file=args.dataset,
+                                                 search_backend=args.search_backend, nprobe=args.nprobe,
+                                                 instrumentation=instrumentation)
+    else:
+        generator.instrumentation = instrumentation
+    if args.result_cache_size:
+        # Repeated and near-duplicate images in the input are matched once
+        max_distance = args.near_duplicate_distance if args.near_duplicate_distance >= 0 else None
+        generator.result_cache = ResultCache(args.result_cache_size, max_distance=max_distance,
+                                             instrumentation=instrumentation)
+
+    # Inputs are read lazily; tee only buffers the pairs of the batch in flight
+    pairs, model_pairs = itertools.tee(read_inputs(args.input, args.title))
+    print(f"Matching images in batches of {args.batch_size}...", file=sys.stderr)
+
+    out = sys.stdout if args.output == "-" else open(args.output, 'w')
+    count = 0
+    try:
+        with instrumentation.profile("run_batch"):
+            # Unreadable images get an error record instead of stopping the run
+            errors = {}
+            results = generator.generate_instructions_batch(model_pairs, args.batch_size, args.top_k,
+                                                            args.aggregation, errors)
+            for i, ((image_path, vague_title), result) in enumerate(zip(pairs, results)):
+                count += 1
+                record = {"image": image_path, "input_title": vague_title}
+                if i in errors:
+                    error = errors.pop(i)
+                    record["error"] = f"{type(error).__name__}: {error}"
+                elif result:
+                    record.update({key: value for key, value in result.items() if key != "best_match"})
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        instrumentation.close()
+    print(f"Wrote {count} results", file=sys.stderr)
+    if args.metrics:
+        with open(args.metrics, 'w') as f:
+            f.write(instrumentation.prometheus())
+        print(f"Metrics written to {args.metrics}", file=sys.stderr)
 
 def main():
     print("Starting FoodInstructionGenerator...")
@@ -95,6 +823,10 @@ def main():
         print(f"Matched vague title: {result['vague_title']}")
         print(f"Your input title: {title}")
         print(f"Similarity score: {result['similarity']:.2f}")
+        if len(result['matches']) > 1:
+            print("Other candidates:")
+            for match in result['matches'][1:]:
+                print(f"- {match['title']} ({match['similarity']:.2f})")
         print("\nGenerated instructions:")
         for i, step in enumerate(result['steps'], 1):
             print(f"{i}. {step}")
@@ -103,5 +835,35 @@ def main():
         print("- Check if test_image exists in images folder")
         print("- Verify food_samples.json contains valid data")
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate cooking instructions from food images")
+    parser.add_argument("--input", help="Image directory, glob pattern or JSONL manifest (omit for interactive mode)")
+    parser.add_argument("--title", default="", help="Vague title used for directory/glob inputs")
+    parser.add_argument("--output", default="-", help="JSONL output file ('-' for stdout)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--aggregation", choices=["max", "mean", "vote"], default="max")
+    parser.add_argument("--num-workers", type=int, default=DEFAULT_NUM_WORKERS,
+                        help="Image decode/preprocess workers")
+    parser.add_argument("--execution-mode", choices=EXECUTION_MODES, default="inference")
+    parser.add_argument("--title-similarity", choices=TITLE_SIMILARITIES, default="clip")
+    parser.add_argument("--dataset", default=DEFAULT_DATASET_FILE,
+                        help="food_samples.json or a dataset store directory")
+    parser.add_argument("--search-backend", choices=SEARCH_BACKENDS, default="exact")
+    parser.add_argument("--nprobe", type=int, default=8, help="IVF lists scanned per query")
+    parser.add_argument("--index-dir", default=DEFAULT_INDEX_DIR)
+    parser.add_argument("--result-cache-size", type=int, default=0,
+                        help="Cache this many results to skip repeated images (0 disables)")
+    parser.add_argument("--near-duplicate-distance", type=int, default=DEFAULT_MAX_DISTANCE,
+                        help="dHash bits a result cache hit may differ by (-1: exact bytes only)")
+    parser.add_argument("--trace", help="Append per-stage timings to this JSONL file")
+    parser.add_argument("--metrics", help="Write Prometheus-format stage metrics here when done")
+    parser.add_argument("--profile-dir", help="Capture the run with torch.profiler into this directory")
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    if args.input:
+        run_batch(args)
+    else:
+        main()
\ No newline at end of file
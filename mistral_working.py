@@ -1,40 +1,51 @@
+import argparse
+import copy
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+from pathlib import Path
+
 import torch
 from PIL import Image
-import requests
 from transformers import LlavaNextProcessor, LlavaNextForConditionalGeneration, BitsAndBytesConfig
-import time
-from io import BytesIO
-import gc
-import os
+from transformers.generation.stopping_criteria import StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+from transformers.modeling_outputs import BaseModelOutputWithPooling
+
+from feature_cache import content_hash
+from model_registry import REGISTRY, release_memory
 
 # Set environment variables for better memory management
 os.environ['PYTORCH_CUDA_ALLOC_CONF'] = 'max_split_size_mb:32'
 
-def clear_gpu_memory():
-    """Clear GPU memory cache"""
-    if torch.cuda.is_available():
-        torch.cuda.empty_cache()
-        gc.collect()
+MODEL_ID = "llava-hf/llava-v1.6-mistral-7b-hf"
+# Larger images are shrunk before preprocessing to save memory
+MAX_IMAGE_SIZE = 1024
+DEFAULT_MAX_NEW_TOKENS = 150
+DEFAULT_MAX_BATCH_SIZE = 8
+# Bytes the KV cache of one batch may take; bounds how many (image, prompt) pairs are generated together
+DEFAULT_KV_BUDGET = 2 << 30
+# Projected image embeddings (~16 MB per image for the 7B model) and prefilled prompt prefixes
+# (~260 MB each) kept for follow-up prompts about the same image
+DEFAULT_IMAGE_CACHE_BYTES = 1 << 30
+DEFAULT_PREFIX_CACHE_BYTES = 2 << 30
+TINY_MODEL_ID = "tiny-llava"
+FOLLOW_UP_PROMPTS = ("What dish is this?", "Give the cooking steps.", "List the likely allergens.")
 
-def test_llava_model():
-    """
-    Test the LLaVA-v1.6-mistral-7b-hf model with image and text input
-    Optimized for memory efficiency
-    """
-    
-    # Clear initial memory
-    clear_gpu_memory()
-    
-    # Check if CUDA is available
-    if torch.cuda.is_available():
-        device = torch.device("cuda:0")
-        print("Running on GPU")
-        # Limit GPU memory usage to 80% of available
-        torch.cuda.set_per_process_memory_fraction(0.8)
-    else:
-        device = torch.device("cpu")
-        print("Running on CPU")
-    
+def load_llava(model_id=MODEL_ID):
+    """Load (model, processor): 4-bit on GPU when bitsandbytes works, bfloat16 on CPU"""
+    processor = LlavaNextProcessor.from_pretrained(model_id)
+    if not torch.cuda.is_available():
+        # float16 matmuls are slow or unsupported on CPU
+        model = LlavaNextForConditionalGeneration.from_pretrained(model_id, torch_dtype=torch.bfloat16,
+                                                                  low_cpu_mem_usage=True)
+        return model.eval(), processor
+
+    # Limit GPU memory usage to 80% of available
+    torch.cuda.set_per_process_memory_fraction(0.8)
     # Configure quantization for memory efficiency
     quantization_config = BitsAndBytesConfig(
         load_in_4bit=True,
@@ -42,29 +53,524 @@ def test_llava_model():
         bnb_4bit_quant_type="nf4",
         bnb_4bit_use_double_quant=True,
     )
-    
-    # Load the model and processor with memory optimizations
-    print("Loading model and processor...")
     try:
-        processor = LlavaNextProcessor.from_pretrained("llava-hf/llava-v1.6-mistral-7b-hf")
         model = LlavaNextForConditionalGeneration.from_pretrained(
-            "llava-hf/llava-v1.6-mistral-7b-hf", 
-            torch_dtype=torch.float16, 
+            model_id,
+            torch_dtype=torch.float16,
             low_cpu_mem_usage=True,
-            quantization_config=quantization_config if torch.cuda.is_available() else None,
+            quantization_config=quantization_config,
             device_map="auto"
         )
-        print("Model loaded successfully!")
     except Exception as e:
         print(f"Error loading model: {e}")
         print("Trying without quantization...")
         model = LlavaNextForConditionalGeneration.from_pretrained(
-            "llava-hf/llava-v1.6-mistral-7b-hf", 
-            torch_dtype=torch.float16, 
+            model_id,
+            torch_dtype=torch.float16,
             low_cpu_mem_usage=True,
             device_map="auto"
         )
-    
+    return model.eval(), processor
+
+def tiny_llava(seed=0):
+    """Randomly initialized (model, processor) with LLaVA-Next's architecture but tiny widths.
+
+    A 2-layer CLIP vision tower on 32x32 anyres tiles, a 2-layer Mistral
+    decoder, a byte-level tokenizer and a Mistral-style [INST] chat template,
+    so the generation code paths run on CPU without downloading anything.
+    """
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+    from transformers import (CLIPVisionConfig, LlavaNextConfig, LlavaNextImageProcessor, MistralConfig,
+                              PreTrainedTokenizerFast)
+    from transformers.convert_slow_tokenizer import bytes_to_unicode
+
+    # Byte-level vocabulary without merges: every byte is one token
+    vocab = {token: i for i, token in enumerate(["<unk>", "<s>", "</s>", "<image>"]
+                                                + list(bytes_to_unicode().values()))}
+    backend = Tokenizer(models.BPE(vocab=vocab, merges=[], unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = decoders.ByteLevel()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, bos_token="<s>", eos_token="</s>",
+                                        unk_token="<unk>", pad_token="</s>")
+    tokenizer.add_special_tokens({"additional_special_tokens": ["<image>"]})
+    chat_template = ("{% for message in messages %}{% if message['role'] == 'user' %}[INST] "
+                     "{% for content in message['content'] %}{% if content['type'] == 'image' %}<image>\n"
+                     "{% else %}{{ content['text'] }}{% endif %}{% endfor %} [/INST]"
+                     "{% else %}{{ message['content'][0]['text'] }}</s>{% endif %}{% endfor %}")
+
+    pinpoints = [[32, 32], [32, 64], [64, 32], [64, 64]]
+    image_processor = LlavaNextImageProcessor(size={"shortest_edge": 32}, crop_size={"height": 32, "width": 32},
+                                              image_grid_pinpoints=pinpoints)
+    processor = LlavaNextProcessor(image_processor=image_processor, tokenizer=tokenizer, patch_size=8,
+                                   vision_feature_select_strategy="default", chat_template=chat_template,
+                                   num_additional_image_tokens=1)
+
+    torch.manual_seed(seed)
+    config = LlavaNextConfig(
+        vision_config=CLIPVisionConfig(hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                                       num_attention_heads=4, image_size=32, patch_size=8),
+        text_config=MistralConfig(vocab_size=len(tokenizer), hidden_size=64, intermediate_size=128,
+                                  num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2,
+                                  max_position_embeddings=4096, bos_token_id=vocab["<s>"],
+                                  eos_token_id=vocab["</s>"], pad_token_id=vocab["</s>"]),
+        image_token_index=vocab["<image>"], image_grid_pinpoints=pinpoints)
+    return LlavaNextForConditionalGeneration(config).eval(), processor
+
+def read_source(source):
+    """Download URLs; paths, bytes and PIL images are returned as they are"""
+    if isinstance(source, str) and source.startswith(("http://", "https://")):
+        import requests
+
+        response = requests.get(source, stream=True, timeout=30)
+        response.raise_for_status()
+        return response.content
+    return source
+
+def fetch_image(source, max_size=MAX_IMAGE_SIZE):
+    """Load an image from a URL, path, bytes or PIL image as RGB, shrunk to at most max_size pixels"""
+    source = read_source(source)
+    if isinstance(source, (bytes, bytearray)):
+        image = Image.open(BytesIO(source))
+    elif isinstance(source, Image.Image):
+        image = source
+    else:
+        image = Image.open(Path(source))
+    image = image.convert("RGB")
+    if max(image.size) > max_size:
+        image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    return image
+
+class _TokenTimer(BaseStreamer):
+    """Records when generate() emits the prompt and the first new token"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_token = None
+        self._prompt_seen = False
+
+    def put(self, value):
+        if not self._prompt_seen:
+            self._prompt_seen = True
+        elif self.first_token is None:
+            self.first_token = time.perf_counter()
+
+    def end(self):
+        pass
+
+class TextStream(_TokenTimer):
+    """Text of one generation as it is produced, from LlavaSession.stream.
+
+    Iterate it (or `async for` it) for decoded text chunks. The prompt is
+    dropped by position: generate() hands it to the streamer first, and only
+    the token ids after it are decoded. Incomplete UTF-8 byte tokens are held
+    back until the character is complete. `cancel()` (or leaving an iteration
+    early) stops generation after the current token; `result` holds the same
+    dict as LlavaSession.generate once generation has ended.
+    """
+
+    _END = object()
+
+    def __init__(self, tokenizer):
+        super().__init__()
+        self.tokenizer = tokenizer
+        self.result = None
+        self.error = None
+        self.cancelled = threading.Event()
+        self._tokens = []
+        self._sent = 0
+        self._chunks = queue.Queue()
+        self._thread = None
+
+    def put(self, value):
+        if not self._prompt_seen:
+            self._prompt_seen = True
+            return
+        super().put(value)
+        self._tokens.extend(value.reshape(-1).tolist())
+        text = self.tokenizer.decode(self._tokens, skip_special_tokens=True).lstrip()
+        if not text.endswith("\ufffd") and len(text) > self._sent:
+            self._chunks.put(text[self._sent:])
+            self._sent = len(text)
+
+    def end(self):
+        text = self.tokenizer.decode(self._tokens, skip_special_tokens=True).lstrip()
+        if len(text) > self._sent:
+            self._chunks.put(text[self._sent:])
+            self._sent = len(text)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def start(self, fn):
+        """Run fn (which calls generate() with this streamer) on a background thread"""
+        def target():
+            try:
+                self.result = fn()
+            except Exception as e:
+                self.error = e
+            finally:
+                self._chunks.put(self._END)
+
+        self._thread = threading.Thread(target=target, name="llava-stream", daemon=True)
+        self._thread.start()
+        return self
+
+    def _next(self):
+        chunk = self._chunks.get()
+        if chunk is self._END:
+            self._thread.join()
+            if self.error is not None:
+                raise self.error
+        return chunk
+
+    def __iter__(self):
+        try:
+            while (chunk := self._next()) is not self._END:
+                yield chunk
+        finally:
+            self.cancel()
+
+    async def __aiter__(self):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        try:
+            while (chunk := await loop.run_in_executor(None, self._next)) is not self._END:
+                yield chunk
+        finally:
+            self.cancel()
+
+class _Cancelled(StoppingCriteria):
+    """Stops generate() once a TextStream is cancelled"""
+
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+class TensorCache:
+    """In-memory LRU of tensors or KV caches, bounded by their total size in bytes (thread-safe)"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.bytes
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+class LlavaSession:
+    """LLaVA-Next loaded once and reused for many (image, prompt) generations.
+
+    Generation keeps the KV cache on, so each new token attends over cached
+    keys/values instead of recomputing the prompt and its ~2000 image tokens.
+    `generate_batch` runs several pairs per `generate()` call, left-padded so
+    every prompt ends where decoding starts; a batch grows only while its KV
+    cache stays within `kv_budget` bytes.
+
+    The model and processor come from `registry` (model_registry.REGISTRY by
+    default) under the name `model_id`, loaded by `loader` (load_llava) on
+    first use and shared with every other session in the process. `models`
+    is a preloaded (model, processor) pair used instead, e.g. tiny_llava().
+
+    Several prompts about the same image share work. Projected image
+    embeddings (vision tower + anyres packing) are cached by image content
+    hash, so a known image is neither preprocessed nor encoded again. The
+    prompt puts the image first, so everything up to its last image token is
+    the same for every question; single-prompt generations keep that prefix's
+    prefilled KV cache and only prefill the question's own tokens next time.
+    """
+
+    def __init__(self, model_id=MODEL_ID, models=None, max_new_tokens=DEFAULT_MAX_NEW_TOKENS,
+                 max_batch_size=DEFAULT_MAX_BATCH_SIZE, kv_budget=DEFAULT_KV_BUDGET,
+                 image_cache_bytes=DEFAULT_IMAGE_CACHE_BYTES, prefix_cache_bytes=DEFAULT_PREFIX_CACHE_BYTES,
+                 registry=None, loader=None):
+        self.model_id = model_id
+        self._models = models
+        self.registry = registry or REGISTRY
+        self.loader = loader or (lambda: load_llava(model_id))
+        self.max_new_tokens = max_new_tokens
+        self.max_batch_size = max_batch_size
+        self.kv_budget = kv_budget
+        self.image_cache = TensorCache(image_cache_bytes)
+        self.prefix_cache = TensorCache(prefix_cache_bytes)
+        # One generation at a time: streams run on their own threads
+        self._lock = threading.RLock()
+        self.generations = 0
+        self.tokens_generated = 0
+        self.tokens_prefilled = 0
+        self.prefill_tokens_reused = 0
+        if models is None:
+            # Cached features and prefixes belong to the weights they were computed with
+            self.registry.on_unload(model_id, self.clear_caches)
+
+    def _load(self):
+        print(f"Loading {self.model_id}...")
+        return self.loader()
+
+    @property
+    def models(self):
+        """(model, processor), loaded on first use"""
+        return self._models or self.registry.get(self.model_id, self._load)
+
+    @property
+    def model(self):
+        return self.models[0]
+
+    @property
+    def processor(self):
+        return self.models[1]
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def kv_bytes_per_token(self):
+        """Size of one token's keys and values across all decoder layers"""
+        config = self.model.config.text_config
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        num_kv_heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+        dtype_size = torch.finfo(self.model.dtype).bits // 8
+        return 2 * config.num_hidden_layers * num_kv_heads * head_dim * dtype_size
+
+    def format_prompt(self, prompt):
+        conversation = [
+            {
+                "role": "user",
+                # Image first: the prefix up to the image tokens is then shared by every question
+                "content": [
+                    {"type": "image"},
+                    {"type": "text", "text": prompt},
+                ],
+            },
+        ]
+        return self.processor.apply_chat_template(conversation, add_generation_prompt=True)
+
+    def prepare(self, image, prompt):
+        """Token ids for one (image, prompt) pair, plus its cached image features or the pixels to encode"""
+        source = read_source(image)
+        digest = content_hash(source)
+        text = self.format_prompt(prompt)
+        features = self.image_cache.get(digest)
+        if features is None:
+            item = dict(self.processor(images=fetch_image(source), text=text, return_tensors="pt"))
+        else:
+            # The processor would only expand the image placeholder to this many tokens
+            image_token = self.processor.image_token
+            item = dict(self.processor.tokenizer(text.replace(image_token, image_token * len(features)),
+                                                 return_tensors="pt"))
+        item.update(digest=digest, features=features)
+        return item
+
+    def encode_images(self, items):
+        """Fill in the features of prepared pairs whose image wasn't cached, in one vision tower pass"""
+        pending = [item for item in items if item["features"] is None]
+        if not pending:
+            return
+        config = self.model.config
+        with torch.inference_mode():
+            features = self.model.model.get_image_features(
+                torch.cat([item["pixel_values"][0] for item in pending]).to(self.device, self.model.dtype),
+                torch.cat([item["image_sizes"] for item in pending]).to(self.device),
+                vision_feature_layer=config.vision_feature_layer,
+                vision_feature_select_strategy=config.vision_feature_select_strategy).pooler_output
+        for item, image_features in zip(pending, features):
+            item["features"] = image_features
+            self.image_cache.put(item["digest"], image_features,
+                                 image_features.numel() * image_features.element_size())
+            del item["pixel_values"], item["image_sizes"]
+
+    def collate(self, items):
+        """Left-pad the token ids of several prepared pairs into one batch"""
+        pad_token_id = self.processor.tokenizer.pad_token_id
+        length = max(item["input_ids"].shape[1] for item in items)
+        input_ids = torch.full((len(items), length), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(items), length), dtype=torch.long)
+        for row, item in enumerate(items):
+            size = item["input_ids"].shape[1]
+            input_ids[row, length - size:] = item["input_ids"][0]
+            attention_mask[row, length - size:] = item["attention_mask"][0]
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+    def prefix_state(self, item):
+        """Prefilled KV cache of the pair's prompt up to its last image token, reused across prompts"""
+        input_ids = item["input_ids"].to(self.device)
+        image_token_id = self.processor.tokenizer.convert_tokens_to_ids(self.processor.image_token)
+        prefix_length = int((input_ids[0] == image_token_id).nonzero().max()) + 1
+        key = (item["digest"], tuple(input_ids[0, :prefix_length].tolist()))
+        state = self.prefix_cache.get(key)
+        if state is None:
+            with torch.inference_mode():
+                state = self.model(input_ids=input_ids[:, :prefix_length], use_cache=True,
+                                   mm_encoder_outputs={"image": BaseModelOutputWithPooling(
+                                       pooler_output=[item["features"]])}).past_key_values
+            self.prefix_cache.put(key, state, prefix_length * self.kv_bytes_per_token())
+            self.tokens_prefilled += prefix_length
+        else:
+            self.prefill_tokens_reused += prefix_length
+        # generate() appends to the cache it is given
+        return copy.deepcopy(state)
+
+    def plan_batches(self, lengths, max_new_tokens):
+        """Group consecutive prompts (by token count) into batches whose padded KV cache fits kv_budget"""
+        per_token = self.kv_bytes_per_token()
+        batch, longest = [], 0
+        for i, length in enumerate(lengths):
+            fits = (len(batch) + 1) * (max(longest, length) + max_new_tokens) * per_token <= self.kv_budget
+            if batch and (len(batch) == self.max_batch_size or not fits):
+                yield batch
+                batch, longest = [], 0
+            batch.append(i)
+            longest = max(longest, length)
+        if batch:
+            yield batch
+
+    def run(self, items, max_new_tokens=None, use_cache=True, streamer=None, **generate_kwargs):
+        """One generate() call on prepared pairs; returns a result dict per pair"""
+        with self._lock:
+            return self._run(items, max_new_tokens, use_cache, streamer, **generate_kwargs)
+
+    def _run(self, items, max_new_tokens, use_cache, streamer, **generate_kwargs):
+        max_new_tokens = max_new_tokens or self.max_new_tokens
+        tokenizer = self.processor.tokenizer
+        generate_kwargs.setdefault("do_sample", False)
+        timer = streamer or _TokenTimer()
+        if isinstance(streamer, TextStream):
+            generate_kwargs["stopping_criteria"] = StoppingCriteriaList([_Cancelled(streamer.cancelled)])
+        self.encode_images(items)
+        inputs = {key: value.to(self.device) for key, value in self.collate(items).items()}
+        if use_cache and len(items) == 1 and self.prefix_cache.max_bytes:
+            # Only the tokens after the shared prefix are prefilled
+            cache = generate_kwargs["past_key_values"] = self.prefix_state(items[0])
+            self.tokens_prefilled += inputs["input_ids"].shape[1] - cache.get_seq_length()
+        else:
+            generate_kwargs["mm_encoder_outputs"] = {
+                "image": BaseModelOutputWithPooling(pooler_output=[item["features"] for item in items])}
+            self.tokens_prefilled += int(inputs["attention_mask"].sum())
+        with torch.inference_mode():
+            output = self.model.generate(**inputs, max_new_tokens=max_new_tokens, use_cache=use_cache,
+                                         pad_token_id=tokenizer.pad_token_id, num_beams=1, streamer=timer,
+                                         **generate_kwargs)
+        seconds = time.perf_counter() - timer.started
+        ttft = (timer.first_token or time.perf_counter()) - timer.started
+
+        # Everything after the (left-padded) prompt is new
+        prompt_length = inputs["input_ids"].shape[1]
+        results = []
+        for row, tokens in enumerate(output[:, prompt_length:].tolist()):
+            if tokenizer.eos_token_id in tokens:
+                tokens = tokens[:tokens.index(tokenizer.eos_token_id) + 1]
+            results.append({
+                "text": tokenizer.decode(tokens, skip_special_tokens=True).strip(),
+                "prompt_tokens": int(inputs["attention_mask"][row].sum()),
+                "new_tokens": len(tokens),
+                "batch_size": len(output),
+                "ttft_s": ttft,
+                "seconds": seconds,
+                "tokens_per_s": len(tokens) / seconds if seconds > 0 else 0.0,
+                "cancelled": isinstance(timer, TextStream) and timer.cancelled.is_set()
+            })
+        self.generations += len(results)
+        self.tokens_generated += sum(result["new_tokens"] for result in results)
+        return results
+
+    def generate(self, image, prompt, max_new_tokens=None, **generate_kwargs):
+        """Answer one prompt about one image; returns a dict with the text, token counts, TTFT and tokens/s"""
+        return self.run([self.prepare(image, prompt)], max_new_tokens, **generate_kwargs)[0]
+
+    def stream(self, image, prompt, max_new_tokens=None, **generate_kwargs):
+        """Like generate, but returns a TextStream of text chunks right away and generates on a background
+        thread; the first chunk arrives after the time to first token instead of the whole answer's time"""
+        stream = TextStream(self.processor.tokenizer)
+        return stream.start(lambda: self.run([self.prepare(image, prompt)], max_new_tokens, streamer=stream,
+                                             **generate_kwargs)[0])
+
+    def generate_batch(self, pairs, max_new_tokens=None, **generate_kwargs):
+        """Answer many (image, prompt) pairs, batched within max_batch_size and kv_budget; yields results in order"""
+        pairs = list(pairs)
+        max_new_tokens = max_new_tokens or self.max_new_tokens
+        prepared = [self.prepare(image, prompt) for image, prompt in pairs]
+        for rows in self.plan_batches([item["input_ids"].shape[1] for item in prepared], max_new_tokens):
+            yield from self.run([prepared[i] for i in rows], max_new_tokens, **generate_kwargs)
+
+    def ask(self, image, prompts, max_new_tokens=None, **generate_kwargs):
+        """Several questions about one image, e.g. FOLLOW_UP_PROMPTS; after the first, each one only
+        prefills its own tokens"""
+        return [self.generate(image, prompt, max_new_tokens, **generate_kwargs) for prompt in prompts]
+
+    def stats(self):
+        return {
+            "generations": self.generations,
+            "tokens_generated": self.tokens_generated,
+            "tokens_prefilled": self.tokens_prefilled,
+            "prefill_tokens_reused": self.prefill_tokens_reused,
+            "image_cache": self.image_cache.stats(),
+            "prefix_cache": self.prefix_cache.stats()
+        }
+
+    def clear_caches(self):
+        self.image_cache.clear()
+        self.prefix_cache.clear()
+
+def print_result(result, text=True):
+    if text:
+        print(f"Response: {result['text']}")
+    print(f"Generation time: {result['seconds']:.2f} seconds ({result['new_tokens']} tokens, "
+          f"{result['tokens_per_s']:.1f} tokens/s, first token after {result['ttft_s']:.2f} s, "
+          f"batch of {result['batch_size']})")
+
+def test_llava_model(session=None):
+    """
+    Test the LLaVA-v1.6-mistral-7b-hf model with image and text input
+    """
+    session = session or LlavaSession()
+    print(f"Running on {'GPU' if torch.cuda.is_available() else 'CPU'}")
+
     # Test with different images and prompts
     test_cases = [
         {
@@ -80,181 +586,124 @@ def test_llava_model():
             "prompt": "Extract any text visible in this image."
         }
     ]
-    
+
     for i, test_case in enumerate(test_cases, 1):
         print(f"\n{'='*50}")
         print(f"Test Case {i}")
         print(f"{'='*50}")
-        
+
         try:
-            # Clear memory before each test case
-            clear_gpu_memory()
-            
-            # Load image from URL with timeout
             print(f"Loading image from: {test_case['image_url']}")
-            response = requests.get(test_case['image_url'], stream=True, timeout=30)
-            response.raise_for_status()
-            image = Image.open(BytesIO(response.content)).convert("RGB")
-            
-            # Resize image if too large to save memory
-            max_size = 1024
-            if max(image.size) > max_size:
-                image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-                print(f"Image resized to: {image.size}")
-            else:
-                print(f"Image loaded successfully. Size: {image.size}")
-            
-            # Prepare conversation
-            conversation = [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": test_case['prompt']},
-                        {"type": "image"},
-                    ],
-                },
-            ]
-            
-            # Apply chat template
-            prompt = processor.apply_chat_template(conversation, add_generation_prompt=True)
-            
-            # Prepare inputs
-            inputs = processor(images=image, text=prompt, return_tensors="pt")
-            
-            # Move inputs to device
-            if torch.cuda.is_available():
-                inputs = {k: v.to(device) if isinstance(v, torch.Tensor) else v for k, v in inputs.items()}
-            
-            # Generate response with memory-efficient settings
+            image = fetch_image(test_case['image_url'])
             print(f"Prompt: {test_case['prompt']}")
             print("Generating response...")
-            
-            start_time = time.time()
-            with torch.no_grad():
-                output = model.generate(
-                    **inputs, 
-                    max_new_tokens=150,  # Reduced from 200
-                    pad_token_id=processor.tokenizer.eos_token_id,
-                    do_sample=True,
-                    temperature=0.7,
-                    top_p=0.9,
-                    use_cache=False,  # Disable KV cache to save memory
-                    num_beams=1  # Use greedy search instead of beam search
-                )
-            generation_time = time.time() - start_time
-            
-            # Decode and print response
-            response = processor.decode(output[0], skip_special_tokens=True)
-            
-            # Extract only the generated part (remove the input prompt)
-            if "[/INST]" in response:
-                generated_text = response.split("[/INST]")[-1].strip()
-            else:
-                # Fallback if the format is different
-                generated_text = response[len(prompt):].strip()
-            
-            print(f"Response: {generated_text}")
-            print(f"Generation time: {generation_time:.2f} seconds")
-            
-            # Clear memory after generation
-            del output, inputs
-            clear_gpu_memory()
-            
+            print_result(session.generate(image, test_case['prompt'], do_sample=True, temperature=0.7, top_p=0.9))
         except torch.cuda.OutOfMemoryError:
-            print(f"CUDA out of memory in test case {i}. Clearing cache and continuing...")
-            clear_gpu_memory()
+            print(f"CUDA out of memory in test case {i}. Dropping cached prefixes and continuing...")
+            session.clear_caches()
+            release_memory()
             continue
         except Exception as e:
             print(f"Error in test case {i}: {str(e)}")
-            clear_gpu_memory()
             continue
-    
+
     print(f"\n{'='*50}")
     print("Testing completed!")
 
-def test_with_local_image(image_path, prompt):
+def test_with_local_image(image_path, prompt, session=None):
     """
-    Test the model with a local image file - memory optimized version
+    Test the model with a local image file
     """
     print("Testing with local image...")
-    
-    # Clear memory
-    clear_gpu_memory()
-    
-    # Setup device
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    if torch.cuda.is_available():
-        torch.cuda.set_per_process_memory_fraction(0.8)
-    
-    # Configure quantization
-    quantization_config = BitsAndBytesConfig(
-        load_in_4bit=True,
-        bnb_4bit_compute_dtype=torch.float16,
-        bnb_4bit_quant_type="nf4",
-        bnb_4bit_use_double_quant=True,
-    ) if torch.cuda.is_available() else None
-    
-    # Load model and processor
-    processor = LlavaNextProcessor.from_pretrained("llava-hf/llava-v1.6-mistral-7b-hf")
-    model = LlavaNextForConditionalGeneration.from_pretrained(
-        "llava-hf/llava-v1.6-mistral-7b-hf", 
-        torch_dtype=torch.float16, 
-        low_cpu_mem_usage=True,
-        quantization_config=quantization_config,
-        device_map="auto"
-    )
-    
+    session = session or LlavaSession()
     try:
-        # Load local image
-        image = Image.open(image_path).convert("RGB")
-        
-        # Resize if necessary
-        max_size = 1024
-        if max(image.size) > max_size:
-            image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-        
-        # Prepare conversation
-        conversation = [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {"type": "image"},
-                ],
-            },
-        ]
-        
-        # Process and generate
-        formatted_prompt = processor.apply_chat_template(conversation, add_generation_prompt=True)
-        inputs = processor(images=image, text=formatted_prompt, return_tensors="pt")
-        
-        if torch.cuda.is_available():
-            inputs = {k: v.to(device) if isinstance(v, torch.Tensor) else v for k, v in inputs.items()}
-        
-        with torch.no_grad():
-            output = model.generate(
-                **inputs, 
-                max_new_tokens=150,
-                use_cache=False,
-                num_beams=1
-            )
-        
-        response = processor.decode(output[0], skip_special_tokens=True)
-        if "[/INST]" in response:
-            generated_text = response.split("[/INST]")[-1].strip()
-        else:
-            generated_text = response[len(formatted_prompt):].strip()
-        
-        print(f"Local image analysis: {generated_text}")
-        
+        # Print the answer as it is generated
+        stream = session.stream(image_path, prompt)
+        print("Response: ", end="", flush=True)
+        for chunk in stream:
+            print(chunk, end="", flush=True)
+        print()
+        print_result(stream.result, text=False)
     except Exception as e:
         print(f"Error with local image: {str(e)}")
-    finally:
-        clear_gpu_memory()
+
+def benchmark(session, pairs, max_new_tokens):
+    """Tokens/s and time to first token: one pair at a time without and with the KV cache, then batched,
+    then follow-up prompts about one image without and with the image feature / prefix caches"""
+    # Warm up (first-call allocations and kernel selection)
+    session.generate(*pairs[0], max_new_tokens=2)
+    # Same number of tokens in every mode, even if a random model emits EOS early
+    fixed = {"max_new_tokens": max_new_tokens, "min_new_tokens": max_new_tokens}
+    image = pairs[0][0]
+
+    def cold_follow_ups():
+        results = []
+        for prompt in FOLLOW_UP_PROMPTS:
+            session.clear_caches()
+            results.append(session.generate(image, prompt, **fixed))
+        return results
+
+    modes = {
+        "no KV cache": lambda: [session.run([session.prepare(*pair)], use_cache=False, **fixed)[0]
+                                for pair in pairs],
+        "KV cache": lambda: [session.generate(*pair, **fixed) for pair in pairs],
+        "KV cache, batched": lambda: list(session.generate_batch(pairs, **fixed)),
+        "follow-ups, cold": cold_follow_ups,
+        "follow-ups, cached": lambda: session.ask(image, FOLLOW_UP_PROMPTS, **fixed),
+    }
+    for label, run in modes.items():
+        session.clear_caches()
+        start = time.perf_counter()
+        results = run()
+        seconds = time.perf_counter() - start
+        tokens = sum(result["new_tokens"] for result in results)
+        ttft = sorted(result["ttft_s"] for result in results)[len(results) // 2]
+        print(f"{label:>18}: {tokens / seconds:7.1f} tokens/s, median time to first token {ttft * 1000:.0f} ms, "
+              f"{seconds:.2f} s for {len(results)} prompts")
+    stats = session.stats()
+    print(f"Prefilled {stats['tokens_prefilled']} prompt tokens, reused {stats['prefill_tokens_reused']}; "
+          f"image cache {stats['image_cache']['hit_rate']:.0%} hits, "
+          f"prefix cache {stats['prefix_cache']['hit_rate']:.0%} hits")
+
+def main():
+    parser = argparse.ArgumentParser(description="Ask LLaVA-Next about food photos")
+    parser.add_argument("--image", nargs="*", default=["image.jpg"], help="Local image paths or URLs")
+    parser.add_argument("--prompt", default="What do you see in this image?")
+    parser.add_argument("--max-new-tokens", type=int, default=DEFAULT_MAX_NEW_TOKENS)
+    parser.add_argument("--max-batch-size", type=int, default=DEFAULT_MAX_BATCH_SIZE)
+    parser.add_argument("--kv-budget-mb", type=int, default=DEFAULT_KV_BUDGET >> 20,
+                        help="KV cache memory one batch may use")
+    parser.add_argument("--image-cache-mb", type=int, default=DEFAULT_IMAGE_CACHE_BYTES >> 20,
+                        help="Memory for cached image features")
+    parser.add_argument("--prefix-cache-mb", type=int, default=DEFAULT_PREFIX_CACHE_BYTES >> 20,
+                        help="Memory for prefilled image prefixes reused by follow-up prompts (0 disables)")
+    parser.add_argument("--follow-ups", action="store_true",
+                        help="Also ask the built-in follow-up questions about a single image")
+    parser.add_argument("--tiny", action="store_true",
+                        help="Use a tiny randomly initialized LLaVA-Next (no download, output is gibberish)")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Report tokens/s and time to first token with and without the KV cache and batching")
+    parser.add_argument("--test-cases", action="store_true", help="Run the built-in URL test cases")
+    args = parser.parse_args()
+
+    model_id, loader = (TINY_MODEL_ID, tiny_llava) if args.tiny else (MODEL_ID, None)
+    session = LlavaSession(model_id, loader=loader, max_new_tokens=args.max_new_tokens,
+                           max_batch_size=args.max_batch_size, kv_budget=args.kv_budget_mb << 20,
+                           image_cache_bytes=args.image_cache_mb << 20, prefix_cache_bytes=args.prefix_cache_mb << 20)
+    if args.test_cases:
+        test_llava_model(session)
+    elif args.benchmark:
+        benchmark(session, [(image, args.prompt) for image in args.image], args.max_new_tokens)
+    elif len(args.image) == 1:
+        test_with_local_image(args.image[0], args.prompt, session)
+        if args.follow_ups:
+            for prompt, result in zip(FOLLOW_UP_PROMPTS, session.ask(args.image[0], FOLLOW_UP_PROMPTS)):
+                print(f"\n{prompt}")
+                print_result(result)
+    else:
+        for image, result in zip(args.image, session.generate_batch((image, args.prompt) for image in args.image)):
+            print(f"\n{image}")
+            print_result(result)
 
 if __name__ == "__main__":
-    # Run the main test
-    #test_llava_model()
-    
-    # Uncomment the line below to test with a local image
-    test_with_local_image("image.jpg", "What do you see in this image?")
+    main()
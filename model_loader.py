@@ -0,0 +1,126 @@
+import argparse
+import json
+from pathlib import Path
+
+import torch
+from transformers import (AutoConfig, AutoProcessor, AutoTokenizer, CLIPTextModelWithProjection, CLIPVisionConfig,
+                          CLIPVisionModel)
+
+# Imported lazily by main.py: torch and transformers dominate startup time, and a run whose
+# features are all cached never needs them beyond the processor and config.
+
+SNAPSHOT_FILE = "snapshot.json"
+
+
+class PooledVisionEncoder(torch.nn.Module):
+    """CLIP vision model reduced to pixel_values -> mean-pooled features, so it can be traced"""
+    def __init__(self, vision_model):
+        super().__init__()
+        self.vision_model = vision_model
+
+    def forward(self, pixel_values):
+        return self.vision_model(pixel_values=pixel_values).last_hidden_state.mean(dim=1)
+
+
+def read_snapshot(snapshot_dir, model_name):
+    """The snapshot manifest if snapshot_dir holds a snapshot of model_name, else None"""
+    if snapshot_dir is None:
+        return None
+    path = Path(snapshot_dir) / SNAPSHOT_FILE
+    if not path.exists():
+        return None
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    return manifest if manifest.get("model_name") == model_name else None
+
+
+def _source(model_name, snapshot_dir, part):
+    """Where to load `part` from: the snapshot subdirectory if there is one, else the hub cache"""
+    manifest = read_snapshot(snapshot_dir, model_name)
+    if manifest is None:
+        return model_name, None
+    return str(Path(snapshot_dir) / part), manifest
+
+
+def _keep_revision(config, manifest):
+    # A snapshot keeps the hub revision it was made from, so feature cache keys stay valid
+    if manifest is not None:
+        config._commit_hash = manifest.get("commit_hash")
+    return config
+
+
+def load_vision_config(model_name, snapshot_dir=None):
+    """Vision tower config only (no weights), e.g. for feature sizes and cache keys"""
+    source, manifest = _source(model_name, snapshot_dir, "vision")
+    if manifest is None:
+        config = AutoConfig.from_pretrained(model_name, local_files_only=True)
+        vision_config = getattr(config, "vision_config", config)
+        # The CLIP config carries the revision; its vision sub-config may not
+        vision_config._commit_hash = getattr(config, "_commit_hash", None)
+        return vision_config
+    return _keep_revision(CLIPVisionConfig.from_pretrained(source, local_files_only=True), manifest)
+
+
+def load_vision_model(model_name, snapshot_dir=None):
+    source, manifest = _source(model_name, snapshot_dir, "vision")
+    model = CLIPVisionModel.from_pretrained(source, local_files_only=True).eval()
+    _keep_revision(model.config, manifest)
+    return model
+
+
+def load_text_model(model_name, snapshot_dir=None):
+    source, _ = _source(model_name, snapshot_dir, "text")
+    return CLIPTextModelWithProjection.from_pretrained(source, local_files_only=True).eval()
+
+
+def load_processor(model_name, snapshot_dir=None):
+    source, _ = _source(model_name, snapshot_dir, "processor")
+    return AutoProcessor.from_pretrained(source, local_files_only=True)
+
+
+def load_tokenizer(model_name, snapshot_dir=None):
+    source, _ = _source(model_name, snapshot_dir, "processor")
+    return AutoTokenizer.from_pretrained(source, local_files_only=True)
+
+
+def save_snapshot(model_name, snapshot_dir, models=None):
+    """Write the vision tower, text tower and processor as a safetensors snapshot.
+
+    Each tower is saved on its own, so loading the vision model reads (and
+    memory-maps) only its weights instead of the whole CLIP checkpoint.
+    `models` is an optional preloaded (vision_model, processor, text_model).
+    """
+    commit_hash = None
+    if models is None:
+        commit_hash = load_vision_config(model_name)._commit_hash
+        models = (CLIPVisionModel.from_pretrained(model_name, local_files_only=True),
+                  AutoProcessor.from_pretrained(model_name, local_files_only=True),
+                  CLIPTextModelWithProjection.from_pretrained(model_name, local_files_only=True))
+    vision_model, processor, text_model = models
+    snapshot_dir = Path(snapshot_dir)
+    vision_model.save_pretrained(snapshot_dir / "vision", safe_serialization=True)
+    text_model.save_pretrained(snapshot_dir / "text", safe_serialization=True)
+    processor.save_pretrained(snapshot_dir / "processor")
+    manifest = {
+        "model_name": model_name,
+        "commit_hash": commit_hash or getattr(vision_model.config, "_commit_hash", None),
+        "torch": torch.__version__
+    }
+    # The manifest goes last: a half-written snapshot is never picked up
+    with open(snapshot_dir / SNAPSHOT_FILE, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+def main():
+    from main import MODEL_NAME, DEFAULT_SNAPSHOT_DIR
+
+    parser = argparse.ArgumentParser(description="Save the CLIP towers as a fast-loading safetensors snapshot")
+    parser.add_argument("--output", default=DEFAULT_SNAPSHOT_DIR)
+    args = parser.parse_args()
+    manifest = save_snapshot(MODEL_NAME, args.output)
+    print(f"Saved {manifest['model_name']} (revision {manifest['commit_hash']}) to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
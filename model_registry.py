@@ -0,0 +1,268 @@
+import argparse
+import gc
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from instrumentation import NullInstrumentation
+
+# Share of physical memory resident models may use unless a budget is given
+DEFAULT_MEMORY_FRACTION = 0.75
+
+
+def physical_memory():
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return 16 << 30
+
+
+def model_bytes(value):
+    """Memory held by the weights of a model, or of the torch modules in a tuple/list of parts"""
+    parts = value if isinstance(value, (tuple, list)) else (value,)
+    total = 0
+    for part in parts:
+        if hasattr(part, "get_memory_footprint"):
+            total += part.get_memory_footprint()
+        elif hasattr(part, "parameters") and hasattr(part, "buffers"):
+            total += sum(tensor.numel() * tensor.element_size()
+                         for tensors in (part.parameters(), part.buffers()) for tensor in tensors)
+    return total
+
+
+def release_memory():
+    """Return freed tensors to the allocator (and the GPU's cached blocks to the driver)"""
+    gc.collect()
+    import torch
+
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class _Entry:
+    __slots__ = ("name", "loader", "value", "bytes", "pinned", "loads", "unloads", "requests", "load_seconds",
+                 "last_load_seconds", "callbacks", "load_lock")
+
+    def __init__(self, name, loader):
+        self.name = name
+        self.loader = loader
+        self.value = None
+        self.bytes = 0
+        self.pinned = False
+        self.loads = 0
+        self.unloads = 0
+        self.requests = 0
+        self.load_seconds = 0.0
+        self.last_load_seconds = None
+        self.callbacks = []
+        # Held while this model loads, so concurrent get()s of it wait for one load
+        self.load_lock = threading.Lock()
+
+
+class ModelRegistry:
+    """Process-wide owner of the loaded models (CLIP parts, LLaVA).
+
+    `get(name, loader)` returns the resident model, calling `loader()` on
+    first use, so every FoodInstructionGenerator, LlavaSession and script in
+    the process shares one copy. Resident weights are kept within
+    `memory_budget` bytes: before and after a load, the least recently used
+    models are unloaded until the rest fits. Pinned models are never
+    unloaded; pin the ones a workload keeps coming back to so a mixed
+    workload doesn't reload a 7B model and a ViT-B/32 in turn. Objects that
+    hold on to a model (encoders, caches) register `on_unload` callbacks to
+    drop their references so the memory is actually freed.
+
+    The registry lock only covers bookkeeping: loaders run outside it, so a
+    resident model (and stats()) stays available while another one loads.
+
+    The size of a model is only known once it has been loaded; the first
+    load of a model can therefore overshoot the budget until the others are
+    unloaded right after it.
+    """
+
+    def __init__(self, memory_budget=None, instrumentation=None):
+        self.memory_budget = memory_budget or int(physical_memory() * DEFAULT_MEMORY_FRACTION)
+        self.instrumentation = instrumentation or NullInstrumentation()
+        # name -> _Entry, least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _entry(self, name, loader=None):
+        entry = self._entries.get(name)
+        if entry is None:
+            entry = self._entries[name] = _Entry(name, loader)
+        elif entry.loader is None:
+            entry.loader = loader
+        return entry
+
+    def get(self, name, loader=None):
+        """The model registered as `name`, loaded with `loader()` if it isn't resident"""
+        with self._lock:
+            entry = self._entry(name, loader)
+            entry.requests += 1
+            self._entries.move_to_end(name)
+            value = entry.value
+            if value is not None:
+                return value
+            if entry.loader is None:
+                raise KeyError(f"No loader for model '{name}'")
+        with entry.load_lock:
+            with self._lock:
+                # Loaded by another thread while this one waited
+                if entry.value is not None:
+                    return entry.value
+                # A model loaded before is expected to take as much memory again
+                unloaded = self._make_room(entry.bytes, keep=name)
+            if unloaded:
+                release_memory()
+            start = time.perf_counter()
+            value = entry.loader()
+            seconds = time.perf_counter() - start
+            with self._lock:
+                entry.value = value
+                entry.bytes = model_bytes(value)
+                entry.loads += 1
+                entry.load_seconds += seconds
+                entry.last_load_seconds = seconds
+                unloaded = self._make_room(0, keep=name)
+            self.instrumentation.observe("model_load", seconds, model=name)
+            self.instrumentation.count("model_loads")
+            if unloaded:
+                release_memory()
+            return value
+
+    def _make_room(self, needed, keep):
+        """Unload least recently used models until `needed` more bytes fit; returns whether any were"""
+        unloaded = False
+        for name in list(self._entries):
+            if self.resident_bytes() + needed <= self.memory_budget:
+                return unloaded
+            entry = self._entries[name]
+            if name != keep and entry.value is not None and not entry.pinned and entry.bytes:
+                self._unload(entry)
+                unloaded = True
+        if self.resident_bytes() + needed > self.memory_budget:
+            print(f"Warning: resident models exceed the {self.memory_budget / 2**20:.0f} MB model memory budget "
+                  f"(pinned or in use)")
+        return unloaded
+
+    def _unload(self, entry):
+        """Drop the registry's and the callbacks' references; call release_memory() once the lock is released"""
+        entry.value = None
+        entry.unloads += 1
+        for callback in entry.callbacks:
+            method = callback()
+            if method is not None:
+                method()
+        entry.callbacks = [callback for callback in entry.callbacks if callback() is not None]
+        self.instrumentation.count("model_unloads")
+
+    def unload(self, name):
+        """Unload a model now (pinned or not); the next get() loads it again"""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry.value is None:
+                return
+            self._unload(entry)
+        release_memory()
+
+    def on_unload(self, name, callback):
+        """Call `callback` (a bound method, held weakly) whenever `name` is unloaded"""
+        with self._lock:
+            self._entry(name).callbacks.append(weakref.WeakMethod(callback))
+
+    def pin(self, name, pinned=True):
+        """Keep `name` resident once loaded, regardless of the budget"""
+        with self._lock:
+            self._entry(name).pinned = pinned
+
+    def unpin(self, name):
+        self.pin(name, pinned=False)
+
+    def is_resident(self, name):
+        entry = self._entries.get(name)
+        return entry is not None and entry.value is not None
+
+    def resident_bytes(self):
+        return sum(entry.bytes for entry in self._entries.values() if entry.value is not None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "memory_budget": self.memory_budget,
+                "resident_bytes": self.resident_bytes(),
+                "models": {
+                    name: {
+                        "resident": entry.value is not None,
+                        "pinned": entry.pinned,
+                        "bytes": entry.bytes,
+                        "requests": entry.requests,
+                        "loads": entry.loads,
+                        "unloads": entry.unloads,
+                        "load_seconds": entry.load_seconds,
+                        "last_load_seconds": entry.last_load_seconds
+                    }
+                    for name, entry in self._entries.items()
+                }
+            }
+
+    def clear(self):
+        """Unload every model, pinned ones included"""
+        with self._lock:
+            for entry in self._entries.values():
+                if entry.value is not None:
+                    self._unload(entry)
+        release_memory()
+
+
+# Shared by everything in the process that doesn't pass its own registry
+REGISTRY = ModelRegistry()
+
+
+def print_stats(stats):
+    print(f"Resident: {stats['resident_bytes'] / 2**20:.0f} MB of {stats['memory_budget'] / 2**20:.0f} MB budget")
+    for name, model in stats["models"].items():
+        print(f"  {name:<40} {'resident' if model['resident'] else 'unloaded':<9}"
+              f"{' pinned' if model['pinned'] else '':<8}{model['bytes'] / 2**20:8.1f} MB  "
+              f"{model['loads']} loads, {model['unloads']} unloads, {model['load_seconds']:.2f} s loading")
+
+
+def main():
+    from benchmark import tiny_clip
+    from mistral_working import LlavaSession, TINY_MODEL_ID, tiny_llava
+
+    parser = argparse.ArgumentParser(
+        description="Replay a mixed CLIP/LLaVA workload with tiny models and report model residency")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--llava-every", type=int, default=4, help="One LLaVA answer every N CLIP queries")
+    parser.add_argument("--budget-mb", type=float, default=None,
+                        help="Model memory budget (default: room for both tiny models)")
+    parser.add_argument("--pin", nargs="*", default=[], choices=["clip", "llava"], help="Models kept resident")
+    parser.add_argument("--image", default="images/test/test_burger1.png")
+    args = parser.parse_args()
+
+    import torch
+
+    registry = ModelRegistry(memory_budget=int(args.budget_mb * 2**20) if args.budget_mb else 1 << 40)
+    names = {"clip": "tiny-clip:vision", "llava": TINY_MODEL_ID}
+    loaders = {"clip": lambda: tiny_clip()[0], "llava": tiny_llava}
+    for name in args.pin:
+        registry.pin(names[name])
+    session = LlavaSession(model_id=names["llava"], registry=registry, loader=loaders["llava"])
+    pixel_values = torch.zeros(1, 3, 224, 224)
+
+    start = time.perf_counter()
+    for i in range(args.rounds):
+        with torch.inference_mode():
+            registry.get(names["clip"], loaders["clip"])(pixel_values=pixel_values)
+        if (i + 1) % args.llava_every == 0:
+            session.generate(args.image, "What dish is this?", max_new_tokens=4)
+    print(f"{args.rounds} CLIP queries and {args.rounds // args.llava_every} LLaVA answers "
+          f"in {time.perf_counter() - start:.2f} s")
+    print_stats(registry.stats())
+
+
+if __name__ == "__main__":
+    main()
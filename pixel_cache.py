@@ -0,0 +1,248 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from embedding_index import file_stat
+from feature_cache import content_hash, namespace_key
+from image_loader import DEFAULT_NUM_WORKERS, load_image
+
+DEFAULT_PIXEL_CACHE = "pixel_cache"
+PIXELS_FILE = "pixels.u8"
+META_FILE = "pixels.json"
+
+
+def image_processor_of(processor):
+    return getattr(processor, "image_processor", processor)
+
+
+def processor_fingerprint(processor):
+    """Hash of the preprocessing config; cached pixels are only valid for the config they were made with"""
+    return namespace_key(image_processor_of(processor).to_json_string())
+
+
+def resize_and_crop(processor, source):
+    """Decode an image and run CLIP preprocessing up to the center crop: a (3, H, W) uint8 RGB array"""
+    image = load_image(source)
+    image.load()
+    pixels = processor(images=image, do_rescale=False, do_normalize=False, return_tensors="np")["pixel_values"][0]
+    return np.clip(np.rint(pixels), 0, 255).astype(np.uint8)
+
+
+def normalization_table(processor):
+    """(3, 256) float32 lookup of rescale + normalize for every channel value.
+
+    Same arithmetic as the processor (rescale in float64, cast, normalize in
+    float32), so looking pixels up gives bit-identical pixel_values.
+    """
+    image_processor = image_processor_of(processor)
+    levels = (np.arange(256, dtype=np.float64) * image_processor.rescale_factor).astype(np.float32)
+    mean = np.asarray(image_processor.image_mean, dtype=np.float32)[:, None]
+    std = np.asarray(image_processor.image_std, dtype=np.float32)[:, None]
+    return (levels[None, :] - mean) / std
+
+
+class PixelCache:
+    """Pre-resized, center-cropped uint8 RGB images in one memory-mapped file.
+
+    Decoding a full-size PNG only for the processor to shrink it to 224x224
+    dominates preprocessing. The cache stores each image once, after the
+    resize and crop, as a (3, H, W) uint8 row of `pixels.u8`; `pixels.json`
+    maps content hashes to rows and remembers each path's (mtime, size), so
+    an unchanged file is found without reading it. A hit costs one 150 KB
+    page-cache read and a table lookup for rescale + normalize instead of a
+    decode and resize. The cache is only used with the preprocessing config
+    it was built for (see `open`).
+    """
+
+    def __init__(self, directory, pixels, meta, processor=None):
+        self.directory = Path(directory)
+        self.pixels = pixels
+        self.meta = meta
+        self.rows = meta["rows"]
+        self.paths = meta["paths"]
+        self.table = normalization_table(processor) if processor is not None else None
+
+    def __reduce__(self):
+        # Re-open by path in worker processes instead of pickling the mapped pixels
+        return _reopen, (str(self.directory), self.table)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @staticmethod
+    def exists(directory):
+        return (Path(directory) / META_FILE).exists()
+
+    @classmethod
+    def load(cls, directory, processor=None):
+        directory = Path(directory)
+        with open(directory / META_FILE, 'r') as f:
+            meta = json.load(f)
+        pixels = None
+        if meta["num_rows"]:
+            pixels = np.memmap(directory / PIXELS_FILE, dtype=np.uint8, mode='r',
+                               shape=(meta["num_rows"], 3, *meta["crop_size"]))
+        return cls(directory, pixels, meta, processor)
+
+    @classmethod
+    def open(cls, directory, processor):
+        """The cache at directory, or None if there is none or it was built with another preprocessing config"""
+        if directory is None or not cls.exists(directory):
+            return None
+        cache = cls.load(directory, processor)
+        if cache.meta["processor"] != processor_fingerprint(processor):
+            print(f"Pixel cache at {directory} was built with a different preprocessing config; ignoring it. "
+                  f"Rebuild it with pixel_cache.py.")
+            return None
+        return cache
+
+    def lookup(self, source):
+        """Row of source in the cache, or None"""
+        if isinstance(source, (bytes, bytearray)):
+            return self.rows.get(content_hash(source))
+        if not isinstance(source, (str, Path)):
+            return None
+        key = os.path.abspath(source)
+        try:
+            stat = list(file_stat(source))
+        except OSError:
+            return None
+        entry = self.paths.get(key)
+        if entry is not None and entry[:2] == stat:
+            return self.rows.get(entry[2])
+        # Touched, copied or moved: fall back to the content hash
+        return self.rows.get(content_hash(source))
+
+    def get_uint8(self, source):
+        row = self.lookup(source)
+        return None if row is None else self.pixels[row]
+
+    def get(self, source):
+        """Normalized (3, H, W) float32 pixel_values of source, or None on a miss"""
+        pixels = self.get_uint8(source)
+        if pixels is None:
+            return None
+        table = self.table
+        return np.stack([table[channel][pixels[channel]] for channel in range(3)])
+
+
+def _reopen(directory, table):
+    cache = PixelCache.load(directory)
+    cache.table = table
+    return cache
+
+
+def update_pixel_cache(directory, processor, sources, num_workers=DEFAULT_NUM_WORKERS, full=False):
+    """Add every source path not yet in the cache at directory; returns a summary dict.
+
+    Only new content is decoded; rows are appended to pixels.u8 and the
+    metadata is written last, so readers never see a row that isn't there.
+    A cache built with another preprocessing config (or `full`) is rebuilt.
+    """
+    directory = Path(directory)
+    fingerprint = processor_fingerprint(processor)
+    crop_size = image_processor_of(processor).crop_size
+    crop_size = [crop_size["height"], crop_size["width"]]
+    meta = None
+    if not full and PixelCache.exists(directory):
+        meta = PixelCache.load(directory).meta
+        if meta["processor"] != fingerprint or meta["crop_size"] != crop_size:
+            meta = None
+    if meta is None:
+        meta = {"processor": fingerprint, "crop_size": crop_size, "num_rows": 0, "rows": {}, "paths": {}}
+
+    summary = {"unchanged": 0, "added": 0, "relinked": 0}
+    pending = {}
+    for source in dict.fromkeys(str(source) for source in sources):
+        key = os.path.abspath(source)
+        stat = list(file_stat(source))
+        entry = meta["paths"].get(key)
+        if entry is not None and entry[:2] == stat and entry[2] in meta["rows"]:
+            summary["unchanged"] += 1
+            continue
+        digest = content_hash(source)
+        meta["paths"][key] = stat + [digest]
+        if digest in meta["rows"]:
+            summary["relinked"] += 1
+        elif digest not in pending:
+            pending[digest] = source
+
+    directory.mkdir(parents=True, exist_ok=True)
+    pixels_path = directory / PIXELS_FILE
+    if meta["num_rows"]:
+        # Drop rows an interrupted run appended without recording them
+        os.truncate(pixels_path, meta["num_rows"] * 3 * crop_size[0] * crop_size[1])
+        target = pixels_path
+    else:
+        # A rebuild goes to a new file: readers may still have the old one mapped
+        target = directory / (PIXELS_FILE + ".tmp")
+    with open(target, 'ab' if target == pixels_path else 'wb') as f, \
+            ThreadPoolExecutor(max(1, num_workers)) as executor:
+        for digest, pixels in zip(pending, executor.map(lambda s: resize_and_crop(processor, s), pending.values())):
+            f.write(pixels.tobytes())
+            meta["rows"][digest] = meta["num_rows"]
+            meta["num_rows"] += 1
+            summary["added"] += 1
+    if target != pixels_path:
+        os.replace(target, pixels_path)
+
+    tmp = directory / (META_FILE + ".tmp")
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, directory / META_FILE)
+    summary["rows"] = meta["num_rows"]
+    return summary
+
+
+def main():
+    from main import MODEL_NAME, DEFAULT_DATASET_FILE, DEFAULT_SNAPSHOT_DIR, read_inputs
+    from food_dataset import FoodDataset
+    from model_loader import load_processor
+
+    parser = argparse.ArgumentParser(description="Cache gallery and test images pre-resized and center-cropped")
+    parser.add_argument("--dataset", default=DEFAULT_DATASET_FILE)
+    parser.add_argument("--include", nargs="*", default=["images/test"],
+                        help="Extra image directories, glob patterns or JSONL manifests to cache")
+    parser.add_argument("--output", default=DEFAULT_PIXEL_CACHE)
+    parser.add_argument("--num-workers", type=int, default=DEFAULT_NUM_WORKERS)
+    parser.add_argument("--full", action="store_true", help="Rebuild instead of adding only new images")
+    args = parser.parse_args()
+
+    processor = load_processor(MODEL_NAME, DEFAULT_SNAPSHOT_DIR)
+    dataset = FoodDataset(args.dataset)
+    dataset.load_dataset()
+    sources = [path for sample in dataset.samples for path in sample["image_paths"]]
+    for extra in args.include:
+        sources += [image_path for image_path, _ in read_inputs(extra)]
+    if not sources:
+        print("No images to cache.")
+        return
+
+    start = time.perf_counter()
+    summary = update_pixel_cache(args.output, processor, sources, args.num_workers, args.full)
+    print(f"Pixel cache at {args.output}: {summary['added']} added, {summary['relinked']} relinked, "
+          f"{summary['unchanged']} unchanged, {summary['rows']} rows ({time.perf_counter() - start:.1f}s)")
+
+    # Compare the fast path with full decoding on a few images
+    cache = PixelCache.open(args.output, processor)
+    sample = list(dict.fromkeys(sources))[:16]
+    start = time.perf_counter()
+    expected = [processor(images=load_image(source), return_tensors="np")["pixel_values"][0] for source in sample]
+    decode_ms = (time.perf_counter() - start) / len(sample) * 1000
+    start = time.perf_counter()
+    cached = [cache.get(source) for source in sample]
+    cached_ms = (time.perf_counter() - start) / len(sample) * 1000
+    max_diff = max(float(np.abs(a - b).max()) for a, b in zip(expected, cached))
+    source_bytes = sum(os.path.getsize(source) for source in sample)
+    print(f"Decode + preprocess: {decode_ms:.2f} ms/image, cached: {cached_ms:.2f} ms/image "
+          f"({decode_ms / cached_ms:.0f}x faster); reads {cached[0].size / 1024:.0f} KB instead of "
+          f"{source_bytes / len(sample) / 1024:.0f} KB per image; max difference {max_diff:.1e}")
+
+
+if __name__ == "__main__":
+    main()
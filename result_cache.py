@@ -0,0 +1,240 @@
+import argparse
+import io
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from feature_cache import content_hash
+from image_hash import HashIndex, dhash
+from instrumentation import NullInstrumentation
+
+DEFAULT_MAX_ENTRIES = 10_000
+DEFAULT_TTL = 3600
+# dHash bits two uploads may differ in and still count as the same photo
+DEFAULT_MAX_DISTANCE = 4
+
+
+def normalize_title(vague_title):
+    return " ".join((vague_title or "").lower().split())
+
+
+class CacheKey:
+    """One query as seen by the cache: image digest, query options and (lazily) the image's dHash"""
+
+    __slots__ = ("digest", "options", "_image", "_dhash")
+
+    def __init__(self, image, vague_title, top_k=3, aggregation="max"):
+        self.digest = content_hash(image)
+        self.options = (normalize_title(vague_title), top_k, aggregation)
+        self._image = image
+        self._dhash = None
+
+    @property
+    def dhash(self):
+        """dHash of the image, or 0 if it can't be decoded (computed on first use)"""
+        if self._image is not None:
+            try:
+                self._dhash = dhash(self._image)
+            except Exception:
+                self._dhash = 0
+            self._image = None
+        return self._dhash
+
+
+class ResultCache:
+    """LRU + TTL cache of generate_instructions results for repeated uploads.
+
+    A query is answered from the cache when an earlier one had the same
+    vague title and options and either the same image bytes (a SHA-256 dict
+    lookup, microseconds) or, with `max_distance`, an image whose dHash is
+    within max_distance bits (a re-share, screenshot or recompressed copy;
+    costs a reduced-size decode but no model). Entries expire `ttl` seconds
+    after they were stored and the least recently used ones are evicted past
+    `max_entries`. Call `clear` whenever the gallery changes.
+
+    Cached results are shared between hits and must not be modified.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, max_distance=DEFAULT_MAX_DISTANCE,
+                 instrumentation=None, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.instrumentation = instrumentation or NullInstrumentation()
+        self.clock = clock
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        # (digest, options) -> (result, dhash, expires), least recently used first
+        self._entries = OrderedDict()
+        # options -> HashIndex of dHash -> digest, for near-duplicate lookups
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, image, vague_title, top_k=3, aggregation="max"):
+        return CacheKey(image, vague_title, top_k, aggregation)
+
+    def get(self, key, near=True):
+        """Cached result for key, or None.
+
+        `near=False` only tries the exact byte match and does not count a miss:
+        it is meant as a cheap first check before a full lookup.
+        """
+        with self.instrumentation.stage("result_cache_lookup"):
+            result = self._get_exact(key)
+            if result is not None:
+                self.hits += 1
+                self.instrumentation.count("result_cache_hits")
+                return result
+            if near and self.max_distance is not None:
+                result = self._get_near(key)
+                if result is not None:
+                    self.near_hits += 1
+                    self.instrumentation.count("result_cache_near_hits")
+                    return result
+            if near:
+                self.misses += 1
+                self.instrumentation.count("result_cache_misses")
+        return None
+
+    def _get_exact(self, key):
+        with self._lock:
+            return self._lookup((key.digest, key.options))
+
+    def _get_near(self, key):
+        hash_value = key.dhash
+        if not hash_value:
+            return None
+        with self._lock:
+            hashes = self._hashes.get(key.options)
+            found = hashes.find(hash_value) if hashes is not None else None
+            if found is None:
+                return None
+            return self._lookup((found[1], key.options))
+
+    def _lookup(self, entry_key):
+        entry = self._entries.get(entry_key)
+        if entry is None:
+            return None
+        if entry[2] <= self.clock():
+            self._remove(entry_key)
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(entry_key)
+        return entry[0]
+
+    def put(self, key, result):
+        """Store the result of key's query (None results are not cached)"""
+        if result is None:
+            return
+        hash_value = key.dhash if self.max_distance is not None else 0
+        entry_key = (key.digest, key.options)
+        with self._lock:
+            if entry_key in self._entries:
+                self._remove(entry_key)
+            self._entries[entry_key] = (result, hash_value, self.clock() + self.ttl)
+            if hash_value:
+                hashes = self._hashes.get(key.options)
+                if hashes is None:
+                    hashes = self._hashes[key.options] = HashIndex(self.max_distance)
+                hashes.add(hash_value, key.digest)
+            self._evict()
+
+    def _evict(self):
+        now = self.clock()
+        while self._entries:
+            entry_key, (_, _, expires) = next(iter(self._entries.items()))
+            if len(self._entries) > self.max_entries:
+                self.evictions += 1
+            elif expires <= now:
+                self.expirations += 1
+            else:
+                break
+            self._remove(entry_key)
+
+    def _remove(self, entry_key):
+        _, hash_value, _ = self._entries.pop(entry_key)
+        digest, options = entry_key
+        hashes = self._hashes.get(options)
+        # Another image with the same dHash may have taken the slot since
+        if hashes is not None and hashes.values.get(hash_value) == digest:
+            hashes.remove(hash_value)
+            if not len(hashes):
+                del self._hashes[options]
+
+    def stats(self):
+        lookups = self.hits + self.near_hits + self.misses
+        return {
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.near_hits) / lookups if lookups else 0.0,
+            "expirations": self.expirations,
+            "evictions": self.evictions,
+            "entries": len(self._entries)
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._hashes.clear()
+
+
+def recompress(source, quality):
+    """JPEG re-encode of an image, as a re-shared or recompressed upload would look"""
+    from image_loader import load_image
+
+    buffer = io.BytesIO()
+    load_image(source).convert("RGB").save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def main():
+    from main import FoodInstructionGenerator, DEFAULT_INDEX_DIR, DEFAULT_DATASET_FILE, read_inputs
+
+    parser = argparse.ArgumentParser(
+        description="Replay queries and their recompressed copies through the result cache")
+    parser.add_argument("--input", default="images/test", help="Image directory, glob pattern or JSONL manifest")
+    parser.add_argument("--title", default="", help="Vague title used for directory/glob inputs")
+    parser.add_argument("--jpeg-quality", type=int, default=80, help="Quality of the near-duplicate copies")
+    parser.add_argument("--max-distance", type=int, default=DEFAULT_MAX_DISTANCE)
+    parser.add_argument("--dataset", default=DEFAULT_DATASET_FILE)
+    parser.add_argument("--index-dir", default=DEFAULT_INDEX_DIR)
+    args = parser.parse_args()
+
+    generator = FoodInstructionGenerator(index_dir=args.index_dir, dataset_file=args.dataset)
+    cache = ResultCache(max_distance=args.max_distance)
+    queries = [(Path(path).read_bytes(), title) for path, title in read_inputs(args.input, args.title)]
+    if not queries:
+        print("No images found.")
+        return
+    copies = [(recompress(image, args.jpeg_quality), title) for image, title in queries]
+
+    # First pass misses, the repeat hits exactly and the recompressed copies should hit by dHash
+    timings = {}
+    for label, pass_queries in (("miss", queries), ("exact hit", queries), ("near hit", copies)):
+        times = timings.setdefault(label, [])
+        for image, title in pass_queries:
+            start = time.perf_counter()
+            key = cache.key(image, title)
+            result = cache.get(key)
+            if result is None:
+                result = generator.generate_instructions(image, title)
+                cache.put(key, result)
+            times.append(time.perf_counter() - start)
+    for label, times in timings.items():
+        times.sort()
+        print(f"{label:>10}: median {times[len(times) // 2] * 1e6:10.0f} us/query")
+    stats = cache.stats()
+    print(f"{stats['hits']} exact hits, {stats['near_hits']} near hits, {stats['misses']} misses "
+          f"({stats['hit_rate']:.0%} hit rate)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,426 @@
+import argparse
+import asyncio
+import email.parser
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+from main import FoodInstructionGenerator, DEFAULT_INDEX_DIR, DEFAULT_DATASET_FILE, MODEL_NAME
+from image_loader import load_image
+from instrumentation import Instrumentation
+from result_cache import ResultCache, DEFAULT_MAX_ENTRIES, DEFAULT_TTL, DEFAULT_MAX_DISTANCE
+
+MAX_BODY_BYTES = 32 << 20
+DESCRIBE_PROMPT = "What dish is this? List its main ingredients and give step-by-step cooking instructions."
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class MicroBatcher:
+    """Coalesce concurrent requests into batches for the encoder.
+
+    Requests queue up while a batch is running. The next batch starts as soon
+    as max_batch_size requests are waiting, or max_wait_ms after the first
+    one arrived, whichever comes first. Batches run on dedicated threads so
+    the event loop keeps accepting requests: one at a time by default, or up
+    to `concurrency` at once when `generator` is a WorkerPool with several
+    worker processes.
+    """
+
+    def __init__(self, generator, max_batch_size=16, max_wait_ms=10, top_k=3, aggregation="max", concurrency=1):
+        self.generator = generator
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.top_k = top_k
+        self.aggregation = aggregation
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="encoder")
+        self.concurrency = concurrency
+        self._slots = None
+        self._dispatching = set()
+        self.batches = 0
+        self.requests = 0
+        self._task = None
+
+    def start(self):
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        self.executor.shutdown(wait=False)
+
+    async def submit(self, image, vague_title):
+        """Queue one (image bytes, vague title) query and wait for its result"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        future.enqueued = loop.time()
+        await self.queue.put((image, vague_title, future))
+        return await future
+
+    async def run(self, fn, *args):
+        """Run fn on the encoder thread, between batches"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def _process(self, batch):
+        """Results of a batch, in order; if the batch fails, each query is retried on its own and the
+        ones that still fail get their exception in place of a result"""
+        pairs = [(image, vague_title) for image, vague_title, _ in batch]
+        try:
+            return list(self.generator.generate_instructions_batch(pairs, batch_size=len(pairs), top_k=self.top_k,
+                                                                   aggregation=self.aggregation))
+        except Exception:
+            if len(pairs) == 1:
+                raise
+        self.generator.instrumentation.count("batch_retries")
+        results = []
+        for pair in pairs:
+            try:
+                results.extend(self.generator.generate_instructions_batch([pair], batch_size=1, top_k=self.top_k,
+                                                                          aggregation=self.aggregation))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Start collecting the next batch once a slot is free to run it
+            await self._slots.acquire()
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self.batches += 1
+            self.requests += len(batch)
+            instrumentation = self.generator.instrumentation
+            started = loop.time()
+            for _, _, future in batch:
+                instrumentation.observe("queue_wait", started - future.enqueued)
+            instrumentation.count("batches")
+            task = loop.create_task(self._dispatch(batch))
+            # The loop only keeps weak references to tasks
+            self._dispatching.add(task)
+            task.add_done_callback(self._dispatching.discard)
+
+    async def _dispatch(self, batch):
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self.executor, self._process, batch)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+        for (_, _, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        stats = {
+            "requests": self.requests,
+            "batches": self.batches,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+            "queued": self.queue.qsize()
+        }
+        if hasattr(self.generator, "stats"):
+            # Per-worker load of a WorkerPool
+            stats["workers"] = self.generator.stats()
+        return stats
+
+def parse_upload(content_type, body, query):
+    """Return (image_bytes, vague_title) from a multipart form or a raw image body.
+
+    Multipart uploads use the fields "image" (file) and "title". Raw bodies
+    take the title from the ?title= query parameter.
+    """
+    title = query.get("title", [""])[0]
+    if content_type.startswith("multipart/form-data"):
+        message = email.parser.BytesParser().parsebytes(
+            b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+        if not message.is_multipart():
+            raise HTTPError(400, "Malformed multipart body")
+        image = None
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            if name == "image":
+                image = part.get_payload(decode=True)
+            elif name == "title":
+                title = part.get_payload(decode=True).decode("utf-8").strip()
+        if not image:
+            raise HTTPError(400, "Missing 'image' field")
+        return image, title
+    if not body:
+        raise HTTPError(400, "Empty request body")
+    return body, title
+
+def validate_image(image):
+    """Decode an upload fully, so undecodable or truncated images are rejected before they are batched"""
+    try:
+        load_image(image).load()
+    except Exception as e:
+        raise HTTPError(400, f"Could not decode image: {e}")
+
+class FoodService:
+    """Minimal HTTP/1.1 front end: POST /generate, POST /reload, GET /health and GET /metrics
+
+    With a `result_cache`, repeated uploads are answered before they reach
+    the batcher: exact byte matches on the event loop, near-duplicates after
+    a dHash computed on a helper thread.
+
+    With `llava` (a mistral_working.LlavaSession), POST /describe streams
+    LLaVA's answer about the upload as server-sent events while it is being
+    generated; a client that disconnects cancels the generation.
+
+    `registry` is the model_registry.ModelRegistry whose residency, load
+    counts and load times /health reports.
+    """
+
+    def __init__(self, batcher, result_cache=None, llava=None, registry=None):
+        self.batcher = batcher
+        self.result_cache = result_cache
+        self.llava = llava
+        self.registry = registry
+        self.started = time.time()
+
+    async def generate(self, image, vague_title):
+        cache = self.result_cache
+        loop = asyncio.get_running_loop()
+        if cache is None:
+            # A bad upload fails on its own with a 400 instead of failing the batch it would join
+            await loop.run_in_executor(None, validate_image, image)
+            return await self.batcher.submit(image, vague_title)
+        key = cache.key(image, vague_title, self.batcher.top_k, self.batcher.aggregation)
+        result = cache.get(key, near=False)
+        if result is None:
+            if cache.max_distance is None:
+                result = cache.get(key)
+            else:
+                # Decoding for the dHash would stall the event loop
+                result = await loop.run_in_executor(None, cache.get, key)
+        if result is None:
+            await loop.run_in_executor(None, validate_image, image)
+            result = await self.batcher.submit(image, vague_title)
+            cache.put(key, result)
+        return result
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY_BYTES:
+                    await self.respond(writer, 413, {"error": "Request body too large"}, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                status, payload = await self.route(method, target, headers, body)
+                if hasattr(payload, "__aiter__"):
+                    # Event streams have no length; the connection closes when they end
+                    await self.send_events(writer, payload)
+                    break
+                keep_alive = headers.get("connection", "keep-alive").lower() != "close"
+                await self.respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, target, headers, body):
+        url = urlsplit(target)
+        try:
+            if url.path == "/health" and method == "GET":
+                health = {"status": "ok", "uptime_s": time.time() - self.started, **self.batcher.stats()}
+                if self.result_cache is not None:
+                    health["result_cache"] = self.result_cache.stats()
+                if self.llava is not None:
+                    health["llava"] = self.llava.stats()
+                if self.registry is not None:
+                    health["models"] = self.registry.stats()
+                return 200, health
+            if url.path == "/metrics" and method == "GET":
+                # Prometheus text exposition format
+                return 200, self.batcher.generator.instrumentation.prometheus()
+            if url.path == "/generate" and method == "POST":
+                image, vague_title = parse_upload(headers.get("content-type", ""), body, parse_qs(url.query))
+                result = await self.generate(image, vague_title)
+                if result is None:
+                    return 404, {"error": "No suitable match found in dataset"}
+                return 200, {key: value for key, value in result.items() if key != "best_match"}
+            if url.path == "/describe" and method == "POST":
+                if self.llava is None:
+                    raise HTTPError(404, "LLaVA is not enabled (start the service with --llava)")
+                query = parse_qs(url.query)
+                image, vague_title = parse_upload(headers.get("content-type", ""), body, query)
+                prompt = query.get("prompt", [DESCRIBE_PROMPT])[0]
+                if vague_title:
+                    prompt = f"The dish is described as '{vague_title}'. {prompt}"
+                await asyncio.get_running_loop().run_in_executor(None, validate_image, image)
+                return 200, self.llava.stream(image, prompt)
+            if url.path == "/reload" and method == "POST":
+                # Re-read the dataset and encode only the images that were added or changed
+                summary = await self.batcher.run(self.batcher.generator.refresh)
+                if self.result_cache is not None:
+                    self.result_cache.clear()
+                return 200, summary
+            return 404, {"error": f"No route for {method} {url.path}"}
+        except HTTPError as e:
+            return e.status, {"error": str(e)}
+        except Exception as e:
+            return 500, {"error": str(e)}
+
+    async def respond(self, writer, status, payload, keep_alive=True):
+        """Send a JSON payload, or a str payload as plain text"""
+        if isinstance(payload, str):
+            body, content_type = payload.encode(), "text/plain; version=0.0.4"
+        else:
+            body, content_type = json.dumps(payload).encode(), "application/json"
+        reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large",
+                  500: "Internal Server Error"}.get(status, "")
+        head = (f"HTTP/1.1 {status} {reason}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode() + body)
+        await writer.drain()
+
+    async def send_events(self, writer, stream):
+        """Send a TextStream as server-sent events: one `data` event per text chunk, then a `done` event
+        with the result's token counts and timings (or an `error` event)"""
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Connection: close\r\n\r\n")
+        try:
+            try:
+                async for chunk in stream:
+                    writer.write(f"data: {json.dumps({'text': chunk})}\n\n".encode())
+                    await writer.drain()
+                event, payload = "done", stream.result
+            except Exception as e:
+                event, payload = "error", {"error": str(e)}
+            writer.write(f"event: {event}\ndata: {json.dumps(payload)}\n\n".encode())
+            await writer.drain()
+        finally:
+            # Stop generating for a client that went away
+            stream.cancel()
+
+async def serve(args):
+    print("Loading model and index...")
+    instrumentation = None
+    if not args.no_instrumentation:
+        instrumentation = Instrumentation(trace_path=args.trace, profile_dir=args.profile_dir)
+    generator = FoodInstructionGenerator(index_dir=args.index_dir, dataset_file=args.dataset,
+                                         execution_mode=args.execution_mode, instrumentation=instrumentation)
+    registry = generator.registry
+    registry.instrumentation = generator.instrumentation
+    if args.memory_budget_gb:
+        registry.memory_budget = int(args.memory_budget_gb * 2**30)
+    # Every /generate needs CLIP; only /describe may have to wait for a reload of LLaVA
+    for part in ("processor", "vision", "text"):
+        registry.pin(f"{MODEL_NAME}:{part}")
+    # Models load lazily; do it before accepting requests so the first one isn't slow
+    generator.load_models()
+    backend, concurrency = generator, 1
+    if args.workers > 1:
+        from worker_pool import WorkerPool
+
+        backend = WorkerPool(generator, args.workers, args.threads_per_worker).start()
+        concurrency = args.workers
+        print(f"Started {args.workers} worker processes sharing one copy of the model")
+    batcher = MicroBatcher(backend, args.max_batch_size, args.max_wait_ms, args.top_k, concurrency=concurrency)
+    batcher.start()
+    result_cache = None
+    if args.result_cache_size:
+        max_distance = args.near_duplicate_distance if args.near_duplicate_distance >= 0 else None
+        result_cache = ResultCache(args.result_cache_size, args.result_cache_ttl, max_distance,
+                                   instrumentation=generator.instrumentation)
+    llava = None
+    if args.llava or args.tiny_llava:
+        from mistral_working import LlavaSession, MODEL_ID, TINY_MODEL_ID, tiny_llava
+
+        model_id, loader = (TINY_MODEL_ID, tiny_llava) if args.tiny_llava else (MODEL_ID, None)
+        llava = LlavaSession(model_id, loader=loader, max_new_tokens=args.llava_max_new_tokens, registry=registry)
+        # Load now rather than on the first request
+        llava.model
+        print("Loaded LLaVA for POST /describe")
+    service = FoodService(batcher, result_cache, llava, registry)
+    server = await asyncio.start_server(service.handle_connection, args.host, args.port)
+    print(f"Serving on http://{args.host}:{args.port} (max batch {args.max_batch_size}, "
+          f"max wait {args.max_wait_ms} ms)")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await batcher.stop()
+        if backend is not generator:
+            backend.close()
+        generator.instrumentation.close()
+
+def main():
+    from main import EXECUTION_MODES
+
+    parser = argparse.ArgumentParser(description="HTTP service for FoodInstructionGenerator with micro-batching")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--max-wait-ms", type=float, default=10)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--execution-mode", choices=EXECUTION_MODES, default="inference")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes sharing the model weights and gallery (see worker_pool.py)")
+    parser.add_argument("--threads-per-worker", type=int, help="Default: each worker's share of the cores")
+    parser.add_argument("--result-cache-size", type=int, default=DEFAULT_MAX_ENTRIES,
+                        help="Results kept for repeated uploads (0 disables the result cache)")
+    parser.add_argument("--result-cache-ttl", type=float, default=DEFAULT_TTL, help="Seconds a cached result is valid")
+    parser.add_argument("--near-duplicate-distance", type=int, default=DEFAULT_MAX_DISTANCE,
+                        help="dHash bits a cached upload may differ by (-1: exact bytes only)")
+    parser.add_argument("--llava", action="store_true",
+                        help="Load LLaVA and stream its answers from POST /describe as server-sent events")
+    parser.add_argument("--tiny-llava", action="store_true",
+                        help="Like --llava with a tiny random model (for testing; output is gibberish)")
+    parser.add_argument("--llava-max-new-tokens", type=int, default=150)
+    parser.add_argument("--memory-budget-gb", type=float,
+                        help="Memory the loaded models may use before unpinned ones are unloaded "
+                             "(default: 75%% of physical memory)")
+    parser.add_argument("--dataset", default=DEFAULT_DATASET_FILE)
+    parser.add_argument("--index-dir", default=DEFAULT_INDEX_DIR)
+    parser.add_argument("--trace", help="Append per-stage timings to this JSONL file")
+    parser.add_argument("--profile-dir", help="Where torch.profiler captures are written")
+    parser.add_argument("--no-instrumentation", action="store_true",
+                        help="Disable stage timers and the /metrics endpoint")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import numpy as np
+
+AGGREGATIONS = ("max", "mean", "vote")
+
+
+def l2_normalize(matrix):
+    """Scale each row of a 2-D array to unit length"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+class SimilarityEngine:
+    """Batched scoring of query features against the whole gallery.
+
+    The gallery is a (num_rows, dim) matrix where each row is one image and
+    `row_samples[i]` is the dataset sample that image belongs to. Queries are
+    scored against every row with one matrix multiply, fused with per-sample
+    title scores and then aggregated into one score per sample (dish).
+
+    With a `search_index` (see ann_index.py) only its `num_candidates` best
+    rows per query are scored and aggregated, instead of the whole gallery.
+    """
+
+    def __init__(self, gallery, row_samples, num_samples=None, image_weight=0.7, title_weight=0.3,
+                 search_index=None, num_candidates=256, normalized=False):
+        # The dense gallery copy is only needed for exact scoring. A `normalized` gallery
+        # (e.g. one shared between worker processes) is used as-is, without a private copy.
+        if search_index is not None:
+            self.gallery = None
+        else:
+            self.gallery = gallery if normalized else l2_normalize(gallery)
+        self.search_index = search_index
+        self.num_candidates = num_candidates
+        self.row_samples = np.asarray(row_samples, dtype=np.int64)
+        if num_samples is None:
+            num_samples = int(self.row_samples.max()) + 1 if len(self.row_samples) else 0
+        self.num_samples = num_samples
+        self.image_weight = image_weight
+        self.title_weight = title_weight
+
+        # Group rows by sample once so per-sample reductions are a single reduceat
+        self._order = np.argsort(self.row_samples, kind="stable")
+        grouped = self.row_samples[self._order]
+        self._present, self._starts, self._counts = np.unique(grouped, return_index=True, return_counts=True)
+
+    @classmethod
+    def from_index(cls, index, num_samples=None, gallery=None, **kwargs):
+        """Engine over the live (not tombstoned) rows of an EmbeddingIndex.
+
+        `gallery` is an already normalized copy of those rows to use instead.
+        """
+        if gallery is not None:
+            return cls(gallery, index.live_row_samples(), num_samples=num_samples, normalized=True, **kwargs)
+        return cls(index.live_embeddings(), index.live_row_samples(), num_samples=num_samples, **kwargs)
+
+    def image_scores(self, queries):
+        """Cosine similarity of each query against each gallery row, shape (num_queries, num_rows)"""
+        queries = l2_normalize(np.atleast_2d(queries))
+        return queries @ self.gallery.T
+
+    def fuse(self, image_scores, title_scores=None):
+        """Weighted image/title score per gallery row.
+
+        `title_scores` has one column per sample and is broadcast to the rows
+        belonging to that sample.
+        """
+        fused = self.image_weight * image_scores
+        if title_scores is not None and self.title_weight:
+            title_scores = np.atleast_2d(np.asarray(title_scores, dtype=np.float32))
+            fused = fused + self.title_weight * title_scores[:, self.row_samples]
+        return fused
+
+    def aggregate(self, row_scores, method="max", vote_n=None):
+        """Reduce per-row scores to per-sample scores, shape (num_queries, num_samples).
+
+        - "max": best image of each dish
+        - "mean": average over the images of each dish
+        - "vote": fraction of the `vote_n` best rows that belong to each dish
+        Samples without any gallery rows score -inf.
+        """
+        if method not in AGGREGATIONS:
+            raise ValueError(f"Unknown aggregation '{method}', expected one of {AGGREGATIONS}")
+        row_scores = np.atleast_2d(row_scores)
+        num_queries = row_scores.shape[0]
+        scores = np.full((num_queries, self.num_samples), -np.inf, dtype=np.float32)
+        if row_scores.shape[1] == 0:
+            return scores
+
+        if method == "vote":
+            n = min(vote_n or 10, row_scores.shape[1])
+            top_rows = np.argpartition(-row_scores, n - 1, axis=1)[:, :n]
+            # Offset each query's samples so one bincount counts every query at once
+            voted = self.row_samples[top_rows] + np.arange(num_queries)[:, None] * self.num_samples
+            votes = np.bincount(voted.ravel(), minlength=num_queries * self.num_samples)
+            votes = votes.reshape(num_queries, self.num_samples).astype(np.float32) / n
+            scores[:, self._present] = votes[:, self._present]
+            return scores
+
+        grouped = row_scores[:, self._order]
+        if method == "max":
+            reduced = np.maximum.reduceat(grouped, self._starts, axis=1)
+        else:
+            reduced = np.add.reduceat(grouped, self._starts, axis=1) / self._counts
+        scores[:, self._present] = reduced
+        return scores
+
+    def aggregate_candidates(self, rows, image_scores, title_scores=None, method="max", vote_n=None):
+        """Like fuse + aggregate, but over (num_queries, num_candidates) retrieved rows only.
+
+        Rows are expected best first and may be padded with -1. "mean" averages
+        over the retrieved rows of each dish.
+        """
+        if method not in AGGREGATIONS:
+            raise ValueError(f"Unknown aggregation '{method}', expected one of {AGGREGATIONS}")
+        num_queries = rows.shape[0]
+        valid = rows >= 0
+        query_idx = np.broadcast_to(np.arange(num_queries)[:, None], rows.shape)[valid]
+        samples = self.row_samples[rows[valid]]
+        fused = self.image_weight * image_scores[valid]
+        if title_scores is not None and self.title_weight:
+            title_scores = np.atleast_2d(np.asarray(title_scores, dtype=np.float32))
+            fused = fused + self.title_weight * title_scores[query_idx, samples]
+
+        scores = np.full((num_queries, self.num_samples), -np.inf, dtype=np.float32)
+        if method == "max":
+            np.maximum.at(scores, (query_idx, samples), fused)
+        elif method == "mean":
+            sums = np.zeros_like(scores)
+            counts = np.zeros_like(scores)
+            np.add.at(sums, (query_idx, samples), fused)
+            np.add.at(counts, (query_idx, samples), 1)
+            np.divide(sums, counts, out=scores, where=counts > 0)
+        else:
+            # Re-rank candidates by fused score, then vote with the best n of each query
+            fused_matrix = np.full(rows.shape, -np.inf, dtype=np.float32)
+            fused_matrix[valid] = fused
+            order = np.argsort(-fused_matrix, axis=1, kind="stable")[:, :vote_n or 10]
+            voters = np.take_along_axis(valid, order, axis=1)
+            voted_rows = np.take_along_axis(rows, order, axis=1)[voters]
+            voted_queries = np.broadcast_to(np.arange(num_queries)[:, None], order.shape)[voters]
+            counts = np.zeros_like(scores)
+            np.add.at(counts, (voted_queries, self.row_samples[voted_rows]), 1)
+            scores = np.where(counts > 0, counts / np.maximum(voters.sum(axis=1, keepdims=True), 1), scores)
+            scores[:, self._present] = np.maximum(scores[:, self._present], 0)
+        return scores
+
+    def top_k(self, queries, title_scores=None, k=5, aggregation="max", vote_n=None):
+        """Return (sample_indices, scores), each of shape (num_queries, k), best first.
+
+        Ties (common with voting) are broken by the best single-image score.
+        """
+        if self.search_index is not None:
+            rows, image_scores = self.search_index.search(queries, self.num_candidates)
+            scores = self.aggregate_candidates(rows, image_scores, title_scores, aggregation, vote_n)
+            tiebreak = scores if aggregation == "max" else \
+                self.aggregate_candidates(rows, image_scores, title_scores, "max")
+        else:
+            row_scores = self.fuse(self.image_scores(queries), title_scores)
+            scores = self.aggregate(row_scores, aggregation, vote_n)
+            tiebreak = scores if aggregation == "max" else self.aggregate(row_scores, "max")
+        return self.rank(scores, tiebreak, k)
+
+    @staticmethod
+    def rank(scores, tiebreak, k):
+        """Top-k columns of each row of `scores`, ties broken by `tiebreak`; returns (indices, scores)"""
+        k = min(k, scores.shape[1])
+        # lexsort sorts ascending by the last key first
+        order = np.lexsort((-tiebreak, -scores), axis=-1)[:, :k]
+        return order, np.take_along_axis(scores, order, axis=1)
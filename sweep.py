@@ -0,0 +1,113 @@
+import argparse
+import itertools
+import json
+import time
+
+import numpy as np
+
+from main import FoodInstructionGenerator, DEFAULT_BATCH_SIZE
+from evaluate_accuracy import TEST_PATTERN, load_test_cases
+
+NORMALIZATIONS = ("none", "zscore", "minmax", "softmax")
+
+def normalize_scores(scores, method, temperature=1.0):
+    """Rescale each query's scores (rows) so image and title terms are comparable"""
+    if method == "none":
+        return scores
+    if method == "zscore":
+        return (scores - scores.mean(axis=1, keepdims=True)) / np.maximum(scores.std(axis=1, keepdims=True), 1e-6)
+    if method == "minmax":
+        low = scores.min(axis=1, keepdims=True)
+        return (scores - low) / np.maximum(scores.max(axis=1, keepdims=True) - low, 1e-6)
+    if method == "softmax":
+        shifted = np.exp((scores - scores.max(axis=1, keepdims=True)) / temperature)
+        return shifted / shifted.sum(axis=1, keepdims=True)
+    raise ValueError(f"Unknown normalization '{method}', expected one of {NORMALIZATIONS}")
+
+def compute_score_matrices(generator, cases, batch_size):
+    """Query x gallery image similarities and query x sample title similarities, computed once"""
+    features = generator.encode_images([image_path for image_path, _, _ in cases], batch_size)
+    vague_titles = [vague_title for _, _, vague_title in cases]
+    image_scores = generator.engine.image_scores(features)
+
+    title_scores = {"overlap": np.array([[generator.calculate_text_similarity(vague_title, sample["vague_title"])
+                                          for sample in generator.dataset.samples]
+                                         for vague_title in vague_titles], dtype=np.float32)}
+    if generator.title_similarity == "clip":
+        title_scores["clip"] = generator.batch_title_similarities(vague_titles)
+    return image_scores, title_scores
+
+def sweep(engine, image_scores, title_scores, correct, weights, normalizations, temperatures, aggregations, top_k):
+    """Accuracy of every configuration, evaluated purely with array ops on the cached matrices"""
+    results = []
+    settings = [(norm, temperature) for norm in normalizations
+                for temperature in (temperatures if norm == "softmax" else [None])]
+    for (norm, temperature), (title_source, titles) in itertools.product(settings, title_scores.items()):
+        image_norm = normalize_scores(image_scores, norm, temperature)
+        title_norm = normalize_scores(titles, norm, temperature)[:, engine.row_samples]
+        for image_weight in weights:
+            row_scores = image_weight * image_norm + (1 - image_weight) * title_norm
+            best_row = engine.aggregate(row_scores, "max")
+            for aggregation, vote_n in aggregations:
+                scores = best_row if aggregation == "max" else engine.aggregate(row_scores, aggregation, vote_n)
+                ranked, _ = engine.rank(scores, best_row, top_k)
+                hits = np.take_along_axis(correct, ranked, axis=1)
+                results.append({
+                    "image_weight": round(float(image_weight), 4),
+                    "title_weight": round(float(1 - image_weight), 4),
+                    "title_similarity": title_source,
+                    "normalization": norm,
+                    "temperature": temperature,
+                    "aggregation": aggregation if aggregation != "vote" else f"vote@{vote_n}",
+                    "accuracy": float(hits[:, 0].mean()),
+                    "top_k_accuracy": float(hits.any(axis=1).mean())
+                })
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep fusion weights, normalization and aggregation on cached scores")
+    parser.add_argument("--pattern", default=TEST_PATTERN)
+    parser.add_argument("--manifest", help='JSONL of {"image", "label", "title"} test cases')
+    parser.add_argument("--weights", type=float, nargs="+", default=list(np.linspace(0, 1, 11)),
+                        help="Image weights to try (title weight is 1 - image weight)")
+    parser.add_argument("--normalizations", nargs="+", choices=NORMALIZATIONS, default=list(NORMALIZATIONS))
+    parser.add_argument("--temperatures", type=float, nargs="+", default=[0.01, 0.05, 0.1])
+    parser.add_argument("--vote-n", type=int, nargs="+", default=[5, 10])
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--output", default="sweep_report.json")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    generator = FoodInstructionGenerator()
+    cases = load_test_cases(generator.dataset, args.pattern, args.manifest)
+    if not cases or generator.engine.num_samples == 0:
+        print("Nothing to evaluate: no test images or an empty dataset.")
+        return
+    image_scores, title_scores = compute_score_matrices(generator, cases, args.batch_size)
+    correct = np.array([[food_item in sample["actual_name"].lower() for sample in generator.dataset.samples]
+                        for _, food_item, _ in cases])
+    setup_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    aggregations = [("max", None), ("mean", None)] + [("vote", n) for n in args.vote_n]
+    results = sweep(generator.engine, image_scores, title_scores, correct, args.weights,
+                    args.normalizations, args.temperatures, aggregations, args.top_k)
+    sweep_time = time.perf_counter() - start
+
+    results.sort(key=lambda result: (-result["accuracy"], -result["top_k_accuracy"]))
+    print(f"{len(results)} configurations on {len(cases)} images in {sweep_time:.2f}s "
+          f"(score matrices: {setup_time:.2f}s)\n")
+    print(f"{'img w':>6} {'title':<8} {'norm':<8} {'temp':>5} {'agg':<8} {'acc':>6} {'top-k':>6}")
+    for result in results[:15]:
+        temperature = f"{result['temperature']:.2f}" if result["temperature"] else "-"
+        print(f"{result['image_weight']:>6.2f} {result['title_similarity']:<8} {result['normalization']:<8} "
+              f"{temperature:>5} {result['aggregation']:<8} {result['accuracy']:>6.2f} {result['top_k_accuracy']:>6.2f}")
+
+    with open(args.output, 'w') as f:
+        json.dump({"num_images": len(cases), "setup_s": setup_time, "sweep_s": sweep_time,
+                   "results": results}, f, indent=4)
+    print(f"\nFull results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,29 @@
 from food_dataset import FoodDataset
-from transformers import AutoProcessor, CLIPVisionModel
+from embedding_index import EmbeddingIndex
+from similarity import SimilarityEngine
+from model_loader import load_processor, load_vision_model
+from model_registry import REGISTRY
 from PIL import Image
 import torch
 from pathlib import Path
 
+MODEL_NAME = "openai/clip-vit-base-patch32"
+
 class FoodInstructionGenerator:
     def __init__(self):
-        # Initialize vision model and processor
-        self.vision_model = CLIPVisionModel.from_pretrained("openai/clip-vit-base-patch32",local_files_only=True)
-        self.processor = AutoProcessor.from_pretrained("openai/clip-vit-base-patch32",local_files_only=True)
         self.dataset = FoodDataset()
         self.dataset.load_dataset()
+        self.engine = None
+
+    # Vision model and processor come from the shared model registry, so they are loaded
+    # once per process (and shared with main.FoodInstructionGenerator)
+    @property
+    def vision_model(self):
+        return REGISTRY.get(f"{MODEL_NAME}:vision", lambda: load_vision_model(MODEL_NAME))
+
+    @property
+    def processor(self):
+        return REGISTRY.get(f"{MODEL_NAME}:processor", lambda: load_processor(MODEL_NAME))
 
     def process_image(self, image_path):
         """Process a single image and return its features"""
@@ -51,24 +64,27 @@ class FoodInstructionGenerator:
             return None'''
     def generate_instructions(self, image_path, vague_title):
         """Generate cooking instructions for a new image-title pair"""
+        if self.engine is None:
+            # Encode the gallery once; image similarity only
+            def encode(sample_images):
+                with torch.no_grad():
+                    return torch.cat([self.process_image(path) for path in sample_images]).numpy()
+            index = EmbeddingIndex.build(self.dataset, encode)
+            self.engine = SimilarityEngine.from_index(index, num_samples=len(self.dataset.samples),
+                                                      image_weight=1.0, title_weight=0.0)
+
         # Process new image
-        image_features = self.process_image(image_path)
-    
+        with torch.no_grad():
+            image_features = self.process_image(image_path).numpy()
+
         # Find most similar example from dataset
-        best_match = None
-        best_similarity = -1
+        if self.engine.num_samples:
+            sample_indices, scores = self.engine.top_k(image_features, k=1)
+            best_match = self.dataset.samples[sample_indices[0][0]]
+            matched_similarity = float(scores[0][0])
+        else:
+            best_match = None
 
-        for sample in self.dataset.samples:
-            # Process each sample image and compare
-            for sample_image in sample["image_paths"]:
-                sample_features = self.process_image(sample_image)
-                similarity = torch.cosine_similarity(image_features, sample_features)
-            
-                if similarity > best_similarity:
-                    best_similarity = similarity
-                    best_match = sample
-                    matched_similarity = similarity.item()  # Convert tensor to number
-        
         if best_match:
             return {
                 "title": best_match["actual_name"],
@@ -0,0 +1,373 @@
+import argparse
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+import torch.multiprocessing
+
+from main import (FoodInstructionGenerator, DEFAULT_BATCH_SIZE, DEFAULT_DATASET_FILE, DEFAULT_INDEX_DIR,
+                  EXECUTION_MODES, TITLE_SIMILARITIES, COMPACT_RATIO, batched, read_inputs)
+from embedding_index import EmbeddingIndex
+from instrumentation import current_pss, current_rss
+
+# Seconds to wait for a worker to load before giving up
+START_TIMEOUT = 300
+
+
+def available_cores():
+    """CPU ids this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cores(cores, num_workers):
+    """Give each worker a disjoint slice of cores (round-robin single cores when there are more workers)"""
+    if num_workers <= len(cores):
+        return [[int(core) for core in chunk] for chunk in np.array_split(cores, num_workers)]
+    return [[cores[i % len(cores)]] for i in range(num_workers)]
+
+
+def _attach_index(generator, index_dir, gallery):
+    generator.set_index(EmbeddingIndex.load(index_dir), gallery=None if gallery is None else gallery.numpy())
+
+
+def _worker_main(worker_id, cores, threads, models, gallery, index_dir, options, tasks, results):
+    """Worker process: serve requests from `tasks` with a generator built on the shared models"""
+    try:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+        torch.set_num_threads(threads)
+        generator = FoodInstructionGenerator(index_dir=None, models=models, num_workers=threads, **options)
+        generator.index_dir = index_dir
+        generator.load_models()
+        _attach_index(generator, index_dir, gallery)
+    except Exception:
+        results.put((None, worker_id, False, traceback.format_exc(), 0.0))
+        return
+    results.put((None, worker_id, True, {"pid": os.getpid(), "cores": cores, "threads": threads}, 0.0))
+
+    while True:
+        message = tasks.get()
+        if message is None:
+            break
+        kind, request_id, payload = message
+        start = time.perf_counter()
+        try:
+            if kind == "batch":
+                pairs, top_k, aggregation = payload
+                value = list(generator.generate_instructions_batch(pairs, len(pairs), top_k, aggregation))
+            elif kind == "reload":
+                generator.dataset.load_dataset()
+                _attach_index(generator, index_dir, payload)
+                value = len(generator.index)
+            elif kind == "memory":
+                value = {"rss_bytes": current_rss(), "pss_bytes": current_pss()}
+            else:
+                raise ValueError(f"Unknown request '{kind}'")
+            results.put((request_id, worker_id, True, value, time.perf_counter() - start))
+        except Exception as e:
+            results.put((request_id, worker_id, False, f"{type(e).__name__}: {e}", time.perf_counter() - start))
+
+
+class WorkerPool:
+    """Serve one generator's models from N worker processes.
+
+    The parent `generator` owns the models and the gallery index. On start its
+    vision and text towers and its normalized gallery matrix are moved into
+    shared memory and handed to spawned workers, which map them zero-copy
+    instead of loading their own copies; per worker only the interpreter,
+    activations and the (small) title matrix are private. Each worker is
+    pinned to its own slice of the cores with a matching torch thread count.
+
+    Requests go to the worker with the fewest outstanding requests.
+    `generate_instructions_batch` and `refresh` mirror the generator's, so a
+    pool can stand in for it (see service.py --workers).
+
+    int8, trace and compile execution modes build their encoder inside each
+    worker, so they keep a private copy of the converted weights.
+    """
+
+    def __init__(self, generator, num_workers=None, threads_per_worker=None):
+        self.generator = generator
+        self.instrumentation = generator.instrumentation
+        cores = available_cores()
+        self.num_workers = num_workers or len(cores)
+        self.core_sets = split_cores(cores, self.num_workers)
+        self.threads = [threads_per_worker or len(core_set) for core_set in self.core_sets]
+        self.processes = []
+        self.tasks = []
+        self.results = None
+        self.workers = []
+        self.pending = [0] * self.num_workers
+        self.requests = [0] * self.num_workers
+        self.gallery = None
+        self._futures = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._collector = None
+        self._closed = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _settle_index(self):
+        """Finish pending compaction so workers never compact (and rewrite) the index themselves"""
+        generator = self.generator
+        if generator.index.tombstone_ratio > COMPACT_RATIO:
+            generator.compact_index(background=False)
+
+    def _share_gallery(self):
+        """Move the engine's normalized gallery into shared memory (None for approximate search)"""
+        engine = self.generator.engine
+        if engine.gallery is None:
+            return None
+        self.gallery = torch.from_numpy(np.ascontiguousarray(engine.gallery)).share_memory_()
+        # The parent scores with the shared copy too, so there is only one
+        engine.gallery = self.gallery.numpy()
+        return self.gallery
+
+    def start(self):
+        generator = self.generator
+        if generator.index_dir is None or generator.index is None:
+            raise ValueError("WorkerPool needs a generator with a gallery index directory")
+        generator.load_models()
+        self._settle_index()
+        if not EmbeddingIndex.exists(generator.index_dir):
+            generator.index.save(generator.index_dir)
+
+        vision_model = generator.vision_model.share_memory()
+        text_model = generator.text_model.share_memory() if generator.text_model is not None else None
+        models = (vision_model, generator.processor, text_model)
+        gallery = self._share_gallery()
+        options = {
+            "feature_cache": str(generator.feature_cache.path) if generator.feature_cache is not None else None,
+            "model_name": generator.model_name,
+            "execution_mode": generator.execution_mode,
+            "title_similarity": generator.title_similarity,
+            "dataset_file": generator.dataset.dataset_file,
+            "search_backend": generator.search_backend,
+            "nprobe": generator.nprobe,
+            "nlist": generator.nlist,
+            "snapshot_dir": generator.snapshot_dir,
+            "pixel_cache": generator.pixel_cache_dir
+        }
+
+        # spawn, not fork: workers must not inherit the parent's OpenMP thread pool
+        context = torch.multiprocessing.get_context("spawn")
+        self.results = context.Queue()
+        for worker_id, (cores, threads) in enumerate(zip(self.core_sets, self.threads)):
+            tasks = context.Queue()
+            process = context.Process(target=_worker_main, name=f"food-worker-{worker_id}", daemon=True,
+                                      args=(worker_id, cores, threads, models, gallery, generator.index_dir,
+                                            options, tasks, self.results))
+            process.start()
+            self.tasks.append(tasks)
+            self.processes.append(process)
+
+        self.workers = [None] * self.num_workers
+        deadline = time.monotonic() + START_TIMEOUT
+        while None in self.workers:
+            try:
+                _, worker_id, ok, info, _ = self.results.get(timeout=1)
+            except queue.Empty:
+                dead = [p.name for p in self.processes if p.exitcode is not None]
+                if dead or time.monotonic() > deadline:
+                    self.close()
+                    raise RuntimeError(f"Workers failed to start: {', '.join(dead) or 'timed out'}")
+                continue
+            if not ok:
+                self.close()
+                raise RuntimeError(f"Worker {worker_id} failed to start:\n{info}")
+            self.workers[worker_id] = info
+
+        self._collector = threading.Thread(target=self._collect, name="worker-results", daemon=True)
+        self._collector.start()
+        return self
+
+    def _collect(self):
+        while not self._closed:
+            try:
+                request_id, worker_id, ok, value, seconds = self.results.get(timeout=1)
+            except queue.Empty:
+                self._fail_dead_workers()
+                continue
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                future, _ = self._futures.pop(request_id, (None, None))
+                self.pending[worker_id] -= 1
+            self.instrumentation.observe("worker_request", seconds, worker=worker_id)
+            if future is None:
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(RuntimeError(f"Worker {worker_id}: {value}"))
+
+    def _fail_dead_workers(self):
+        for worker_id, process in enumerate(self.processes):
+            if process.exitcode is None:
+                continue
+            with self._lock:
+                lost = [request_id for request_id, (_, owner) in self._futures.items() if owner == worker_id]
+                futures = [self._futures.pop(request_id)[0] for request_id in lost]
+            for future in futures:
+                future.set_exception(RuntimeError(f"Worker {worker_id} exited with code {process.exitcode}"))
+
+    def _send(self, kind, payload, worker_id=None):
+        if self._closed or self._collector is None:
+            raise RuntimeError("WorkerPool is not running")
+        future = Future()
+        with self._lock:
+            if worker_id is None:
+                # Least outstanding requests
+                live = [i for i, process in enumerate(self.processes) if process.exitcode is None]
+                if not live:
+                    raise RuntimeError("All workers have exited")
+                worker_id = min(live, key=self.pending.__getitem__)
+            request_id = next(self._ids)
+            self._futures[request_id] = (future, worker_id)
+            self.pending[worker_id] += 1
+            self.requests[worker_id] += 1
+        self.tasks[worker_id].put((kind, request_id, payload))
+        return future
+
+    def submit(self, pairs, top_k=3, aggregation="max"):
+        """Match a list of (image, vague_title) pairs on the least busy worker; returns a Future of the results"""
+        return self._send("batch", (list(pairs), top_k, aggregation))
+
+    def generate_instructions_batch(self, pairs, batch_size=DEFAULT_BATCH_SIZE, top_k=3, aggregation="max"):
+        """Like FoodInstructionGenerator.generate_instructions_batch, with batches spread over the workers"""
+        in_flight = deque()
+        for batch in batched(pairs, batch_size):
+            in_flight.append(self.submit(batch, top_k, aggregation))
+            self.instrumentation.count("queries", len(batch))
+            # Keep every worker busy without reading the whole input ahead
+            if len(in_flight) > 2 * self.num_workers:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
+
+    def broadcast(self, kind, payload=None):
+        """Send a request to every worker and wait for all the answers"""
+        futures = [self._send(kind, payload, worker_id) for worker_id in range(self.num_workers)]
+        return [future.result() for future in futures]
+
+    def refresh(self, batch_size=DEFAULT_BATCH_SIZE):
+        """Update the gallery index in the parent, then have every worker reload it"""
+        summary = self.generator.refresh(batch_size)
+        self._settle_index()
+        self.broadcast("reload", self._share_gallery())
+        return summary
+
+    def memory(self):
+        """Current RSS and PSS of each worker; PSS splits the shared weights between them"""
+        return self.broadcast("memory")
+
+    def stats(self):
+        with self._lock:
+            return [{**info, "requests": requests, "pending": pending}
+                    for info, requests, pending in zip(self.workers, self.requests, self.pending)]
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for tasks in self.tasks:
+            tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.exitcode is None:
+                process.terminate()
+        if self._collector is not None:
+            self._collector.join()
+        with self._lock:
+            futures = [future for future, _ in self._futures.values()]
+            self._futures.clear()
+        for future in futures:
+            future.set_exception(RuntimeError("WorkerPool closed"))
+
+
+def measure_scaling(generator, pairs, worker_counts, batch_size=DEFAULT_BATCH_SIZE, threads_per_worker=None):
+    """Throughput of the same workload with each number of workers"""
+    results = []
+    for num_workers in worker_counts:
+        with WorkerPool(generator, num_workers, threads_per_worker) as pool:
+            # One warm-up request per worker (first forward pass, lazy allocations)
+            for future in [pool.submit(pairs[:1]) for _ in range(num_workers)]:
+                future.result()
+            start = time.perf_counter()
+            count = sum(1 for _ in pool.generate_instructions_batch(pairs, batch_size))
+            seconds = time.perf_counter() - start
+            memory = pool.memory()
+        throughput = count / seconds
+        baseline = results[0]["images_per_s"] if results else throughput
+        results.append({
+            "workers": num_workers,
+            "threads_per_worker": pool.threads,
+            "images": count,
+            "seconds": seconds,
+            "images_per_s": throughput,
+            "speedup": throughput / baseline,
+            "efficiency": throughput / baseline / (num_workers / results[0]["workers"] if results else 1),
+            "worker_rss_bytes": sum(m["rss_bytes"] or 0 for m in memory),
+            "worker_pss_bytes": sum(m["pss_bytes"] or 0 for m in memory)
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure throughput scaling of the shared-memory worker pool")
+    parser.add_argument("--input", default="images/test", help="Image directory, glob pattern or JSONL manifest")
+    parser.add_argument("--title", default="")
+    parser.add_argument("--repeat", type=int, default=4, help="Pass over the inputs this many times")
+    parser.add_argument("--max-workers", type=int, default=len(available_cores()))
+    parser.add_argument("--threads-per-worker", type=int, help="Default: the worker's share of the cores")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--execution-mode", choices=EXECUTION_MODES, default="inference")
+    parser.add_argument("--title-similarity", choices=TITLE_SIMILARITIES, default="clip")
+    parser.add_argument("--dataset", default=DEFAULT_DATASET_FILE)
+    parser.add_argument("--index-dir", default=DEFAULT_INDEX_DIR)
+    parser.add_argument("--output", help="Also write the results as JSON")
+    args = parser.parse_args()
+
+    pairs = list(read_inputs(args.input, args.title)) * args.repeat
+    if not pairs:
+        print(f"No images found for {args.input}")
+        return
+    # No feature cache: every image must go through the workers' vision forward
+    generator = FoodInstructionGenerator(index_dir=args.index_dir, feature_cache=None,
+                                         execution_mode=args.execution_mode,
+                                         title_similarity=args.title_similarity, dataset_file=args.dataset)
+    worker_counts = sorted({2 ** i for i in range(args.max_workers.bit_length()) if 2 ** i <= args.max_workers}
+                           | {args.max_workers})
+    print(f"Matching {len(pairs)} images with {', '.join(map(str, worker_counts))} workers "
+          f"({len(available_cores())} cores available)...\n")
+    results = measure_scaling(generator, pairs, worker_counts, args.batch_size, args.threads_per_worker)
+
+    print(f"{'workers':>7} {'threads':>8} {'img/s':>8} {'speedup':>8} {'effic.':>7} {'RSS MB':>8} {'PSS MB':>8}")
+    for result in results:
+        print(f"{result['workers']:>7} {'/'.join(map(str, result['threads_per_worker'])):>8} "
+              f"{result['images_per_s']:>8.1f} {result['speedup']:>7.2f}x {result['efficiency']:>7.0%} "
+              f"{result['worker_rss_bytes'] / 2**20:>8.0f} {result['worker_pss_bytes'] / 2**20:>8.0f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"cores": len(available_cores()), "results": results}, f, indent=4)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()